@@ -1,14 +1,596 @@
-from flask import Flask, render_template_string, request, redirect, jsonify
+from flask import Flask, render_template_string, request, redirect, jsonify, g, has_request_context, Response, send_file, stream_with_context
 import uuid
+import bisect
 import json
+import csv
+import io
+import re
 import os
-from datetime import datetime
+import time
+import threading
+import sys
+import atexit
+import cProfile
+import marshal
+import mmap
+import array
+import struct
+import heapq
+import itertools
+import random
+import unicodedata
+import zlib
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from werkzeug.middleware.proxy_fix import ProxyFix
+from forecast import simulate as simulate_forecast
 
 app = Flask(__name__)
 
+# Render などのプロキシの後ろで動かすときは、その段数を PROXY_COUNT に指定する
+# （プロキシが付け足した分の X-Forwarded-For だけを request.remote_addr に使い、クライアントが書いた値は信用しない）
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', '0'))
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
+# 計測（/metrics で Prometheus テキスト形式を出力）
+# METRICS_LOG=1 のときはリクエストごとの計測結果をJSONで標準出力に書く
+METRICS_LOG = os.environ.get('METRICS_LOG') == '1'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+HISTOGRAMS = {}  # (メトリクス名, ラベル) → [各バケットの件数..., 合計, 件数]
+HISTOGRAM_BUCKETS = {}  # メトリクス名 → バケット境界
+COUNTERS = {}
+METRICS_LOCK = threading.Lock()
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """ヒストグラムに値を1件追加"""
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        h = HISTOGRAMS.get(key)
+        if h is None:
+            HISTOGRAM_BUCKETS.setdefault(name, buckets)
+            h = HISTOGRAMS[key] = [0] * len(buckets) + [0.0, 0]
+        for i, b in enumerate(buckets):
+            if value <= b:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+@contextmanager
+def stage(name):
+    """処理区間（db / render / aggregate など）の所要時間を計測"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("furima_stage_duration_seconds", elapsed, stage=name)
+        if has_request_context():
+            stages = g.setdefault("stages", {})
+            stages[name] = stages.get(name, 0) + elapsed
+
+def timed(stage_name):
+    """関数全体を stage() で計測するデコレータ"""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.get("start_time", time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    observe("furima_request_duration_seconds", elapsed, route=route, method=request.method)
+    increment("furima_requests_total", route=route, method=request.method, status=str(response.status_code))
+    size = response.content_length if not response.is_streamed else None
+    if size is not None:
+        observe("furima_response_size_bytes", size, buckets=SIZE_BUCKETS, route=route)
+    if request.content_length:
+        observe("furima_request_size_bytes", request.content_length, buckets=SIZE_BUCKETS, route=route)
+    if METRICS_LOG:
+        print(json.dumps({
+            "time": datetime.now().isoformat(),
+            "method": request.method,
+            "route": route,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 2),
+            "stages_ms": {k: round(v * 1000, 2) for k, v in g.get("stages", {}).items()},
+            "response_bytes": size,
+            "items": len(ACCOUNT.DATA),
+        }, ensure_ascii=False), flush=True)
+    return response
+
+# プロファイリング（PROFILE=1 で常時、または X-Profile ヘッダーに PROFILE_TOKEN を付けたリクエストだけ）
+# 保存したプロファイルの閲覧には PROFILE_TOKEN の設定が必要
+PROFILE_ENABLED = os.environ.get('PROFILE') == '1'
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '20'))
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILES = deque(maxlen=PROFILE_KEEP)
+PROFILE_COUNTER = 0
+PROFILE_STATE = threading.local()
+
+def profile_authorized():
+    """プロファイル閲覧の権限（X-Profile ヘッダーのトークン一致のみ。トークン未設定なら誰にも見せない）
+    URL のクエリはアクセスログやブラウザの履歴に残るので、トークンはヘッダーでだけ受け取る"""
+    return bool(PROFILE_TOKEN) and request.headers.get('X-Profile') == PROFILE_TOKEN
+
+def profiling_active():
+    if PROFILE_ENABLED:
+        return True
+    return bool(PROFILE_TOKEN) and has_request_context() and request.headers.get('X-Profile') == PROFILE_TOKEN
+
+def sample_stacks(thread_id, stop, counts):
+    """対象スレッドのスタックを一定間隔でサンプリング（collapsed stacks 形式）"""
+    while not stop.wait(PROFILE_SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            counts[";".join(reversed(stack))] += 1
+
+def profiled(func):
+    """有効なときだけ cProfile とスタックサンプリングで計測し、直近 PROFILE_KEEP 件を保存"""
+    def wrapper(*args, **kwargs):
+        # 無効時・入れ子の呼び出しはそのまま実行
+        if getattr(PROFILE_STATE, 'running', False) or not profiling_active():
+            return func(*args, **kwargs)
+        global PROFILE_COUNTER
+        PROFILE_STATE.running = True
+        profiler = cProfile.Profile()
+        counts = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop, counts), daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            stop.set()
+            sampler.join()
+            PROFILE_STATE.running = False
+            profiler.create_stats()
+            with METRICS_LOCK:
+                PROFILE_COUNTER += 1
+                PROFILES.append({
+                    "id": PROFILE_COUNTER,
+                    "function": func.__name__,
+                    "time": datetime.now().isoformat(),
+                    "duration_ms": round(elapsed * 1000, 2),
+                    "pstats": marshal.dumps(profiler.stats),
+                    "collapsed": counts,
+                })
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+SELL_FEES = {
+    "ラクマ": 0.10,
+    "ヤフーフリマ": 0.05,
+    "メルカリ": 0.10
+}
+
+# 手数料ルール（販売サイトごとに適用開始日・料率・固定額）と見込み計算の設定
+# 保存されたルールがなければ SELL_FEES から作る
+DEFAULT_FEE_SETTINGS = {
+    "rules": [{"site": site, "since": "2000-01-01", "percent": rate, "fixed": 0} for site, rate in SELL_FEES.items()],
+    "estimate": {"percent": 0.075, "fixed": 0},  # 未売却の見込み手数料
+    "default_shipping": 300,  # 未売却の見込み送料
+    "shipping_defaults": {},  # カテゴリ別の見込み送料
+}
+
+def parse_fee_settings(body):
+    """手数料設定を検証して正規化（不正なら ValueError）"""
+    if body is not None and not isinstance(body, dict):
+        raise ValueError("手数料設定はJSONオブジェクトで指定してください")
+    settings = dict(DEFAULT_FEE_SETTINGS, **{k: v for k, v in (body or {}).items() if k in DEFAULT_FEE_SETTINGS})
+    if not isinstance(settings["rules"], list):
+        raise ValueError("rules は手数料ルールの配列で指定してください")
+    rules = []
+    for r in settings["rules"]:
+        try:
+            since = datetime.strptime(r.get("since") or "2000-01-01", "%Y-%m-%d").strftime("%Y-%m-%d")
+            rule = {"site": str(r["site"]), "since": since,
+                    "percent": float(r.get("percent", 0)), "fixed": float(r.get("fixed", 0))}
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValueError(f"手数料ルールの形式が正しくありません: {r}")
+        if not 0 <= rule["percent"] < 1:
+            raise ValueError(f"手数料率は0〜1で指定してください: {r}")
+        rules.append(rule)
+    try:
+        estimate = {"percent": float(settings["estimate"].get("percent", 0)), "fixed": float(settings["estimate"].get("fixed", 0))}
+        shipping_defaults = {str(k): float(v) for k, v in settings["shipping_defaults"].items()}
+        default_shipping = float(settings["default_shipping"])
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("見込み計算の設定が正しくありません")
+    return {
+        "rules": sorted(rules, key=lambda r: (r["site"], r["since"])),
+        "estimate": estimate,
+        "default_shipping": default_shipping,
+        "shipping_defaults": shipping_defaults,
+    }
+
+# 手数料・利益・利益率の丸め（calculate_profit・SQLite の再計算・PostgreSQL の items_derived ビューで共通）
+# PostgreSQL の ROUND(numeric) と同じく、float を15桁の10進数にしてから計算し、0.5 は切り上げる
+# （Python の round() は偶数丸めで、¥125 の10% が 12 と 13 に食い違う）
+def to_decimal(value):
+    """float → Decimal（PostgreSQL の float8 → numeric と同じく有効15桁）"""
+    return Decimal(f"{value or 0:.15g}")
+
+def round_half_up(value, places=0):
+    return float(value.quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP))
+
+def fee_amount(sell, percent, fixed):
+    """手数料 = 販売価格 × 手数料率 + 固定額（円未満は四捨五入）"""
+    return round_half_up(to_decimal(sell) * to_decimal(percent) + to_decimal(fixed))
+
+def profit_amount(sell, buy, ship, fee):
+    """利益 = 販売価格 - 仕入れ価格 - 送料 - 手数料（円未満は四捨五入）"""
+    return round_half_up(to_decimal(sell) - to_decimal(buy) - to_decimal(ship) - to_decimal(fee))
+
+def profit_rate(profit, buy):
+    """利益率（%、小数1桁で四捨五入）"""
+    return round_half_up(to_decimal(profit) / to_decimal(buy) * 100, 1) if buy and buy > 0 else 0
+
+# 商品のカラム（items テーブルの列順）
+ITEM_COLUMNS = ("id", "buy_platform", "category", "name", "buy_date", "sell_date",
+                "buy_price", "sell_price", "shipping", "fee", "profit", "rate", "sell_site")
+STRING_COLUMNS = ("id", "buy_platform", "category", "name", "buy_date", "sell_date", "sell_site")
+NUMBER_COLUMNS = ("buy_price", "sell_price", "shipping", "fee", "profit", "rate")
+
+# バイナリスナップショット（列指向）
+# ヘッダー | 文字列テーブル（文字単位のオフセット + UTF-8本体）| 文字列列（uint32の添字）| 数値列（float64）
+# 同じ文字列（カテゴリ・日付など）は1回だけ格納し、mmap して読み込む
+SNAPSHOT_MAGIC = b'FRMS'
+SNAPSHOT_HEADER = struct.Struct('<4sIIIQ')  # magic, 形式バージョン, 件数, 文字列数, 文字列本体のバイト数
+
+def snapshot_supported(items):
+    """スナップショットに入る形（決まったカラムだけ・数値は数値）かどうか"""
+    columns = set(ITEM_COLUMNS)
+    for d in items:
+        if d.keys() != columns:
+            return False
+        for c in STRING_COLUMNS:
+            if d[c] is not None and not isinstance(d[c], str):
+                return False
+        for c in NUMBER_COLUMNS:
+            if not isinstance(d[c], (int, float)) or isinstance(d[c], bool):
+                return False
+    return True
+
+def write_snapshot(path, items):
+    """商品一覧を列指向のバイナリスナップショットに書き出す"""
+    strings = {None: 0, "": 1}  # 0 は None、1 は空文字
+    string_cols = []
+    for c in STRING_COLUMNS:
+        string_cols.append(array.array('I', (strings.setdefault(d[c], len(strings)) for d in items)))
+    # 本体は一括でデコードしてから文字単位で切り出せるよう、オフセットは文字数で持つ
+    texts = list(strings)[2:]
+    offsets = array.array('Q', [0, 0, 0])
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+    blob = ''.join(texts).encode('utf-8')
+    
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 1, len(items), len(strings), len(blob)))
+        f.write(offsets.tobytes())
+        f.write(blob)
+        f.write(b'\0' * (-len(blob) % 8))  # 数値列を8バイト境界に揃える
+        for col in string_cols:
+            f.write(col.tobytes())
+        f.write(b'\0' * (-(4 * len(items) * len(string_cols)) % 8))
+        for c in NUMBER_COLUMNS:
+            f.write(array.array('d', (d[c] for d in items)).tobytes())
+    os.replace(tmp, path)
+
+def read_snapshot(path):
+    """スナップショットを mmap して商品一覧に戻す"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            magic, fmt, count, nstrings, blob_len = SNAPSHOT_HEADER.unpack_from(mm, 0)
+            if magic != SNAPSHOT_MAGIC or fmt != 1:
+                raise ValueError("unknown snapshot format")
+            pos = SNAPSHOT_HEADER.size
+            offsets = view[pos:pos + 8 * (nstrings + 1)].cast('Q')
+            pos += 8 * (nstrings + 1)
+            blob = view[pos:pos + blob_len]
+            text = str(blob, 'utf-8')
+            bounds = offsets.tolist()
+            strings = [None, ""] + [text[bounds[i]:bounds[i + 1]] for i in range(2, nstrings)]
+            offsets.release()
+            blob.release()
+            pos += blob_len + (-blob_len % 8)
+            
+            columns = []
+            for _ in STRING_COLUMNS:
+                col = view[pos:pos + 4 * count].cast('I')
+                columns.append(list(map(strings.__getitem__, col)))
+                col.release()
+                pos += 4 * count
+            pos += -(4 * count * len(STRING_COLUMNS)) % 8
+            for _ in NUMBER_COLUMNS:
+                col = view[pos:pos + 8 * count].cast('d')
+                columns.append(col.tolist())
+                col.release()
+                pos += 8 * count
+        finally:
+            view.release()
+    keys = STRING_COLUMNS + NUMBER_COLUMNS
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
 # 環境変数でデータベースURLを取得（Renderで自動設定される）
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
+# 読み取り用のレプリカ（カンマ区切りで複数指定可、DATABASE_URL があるときだけ使う）
+DATABASE_REPLICA_URLS = [u.strip() for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if u.strip()]
+# 書き込んだクライアントはこの秒数だけプライマリから読む（レプリカの遅延で自分の変更が見えなくならないように）
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', '5'))
+
+def mark_write():
+    """このリクエストで書き込んだことを記録（以降の読み取りはプライマリへ）"""
+    if has_request_context():
+        g.wrote = True
+
+def read_your_writes():
+    """プライマリから読むべきか（このリクエストか直前のリクエストで書き込んだ）"""
+    if not has_request_context():
+        return False
+    if g.get("wrote"):
+        return True
+    try:
+        return float(request.cookies.get("primary_until", 0)) > time.time()
+    except ValueError:
+        return False
+
+@app.after_request
+def stick_to_primary(response):
+    if g.get("wrote") and USE_DATABASE and DATABASE_REPLICA_URLS:
+        response.set_cookie("primary_until", str(time.time() + REPLICA_STICKY_SECONDS),
+                            max_age=int(REPLICA_STICKY_SECONDS) + 1, httponly=True, samesite="Lax")
+    return response
+
+# アカウント（出品者）ごとのデータ
+# 商品データ・変更フィード・書き込みキュー・集計用の索引はアカウントごとに Account に持ち、
+# 処理中のアカウントの分を ACCOUNT.DATA のように参照する（リクエスト・ジョブ・書き込みスレッドがそれぞれ切り替える）
+# 読み込んだアカウントは最近使った順に最大 MAX_ACCOUNTS 件まで残し、使われていないものから追い出す
+# 保存先は PostgreSQL では account_id 列で分け、SQLite・JSON ではアカウントごとのディレクトリ（accounts/<ID>/）に分ける
+DEFAULT_ACCOUNT = 'default'  # 従来のデータ（account_id 列の既定値・カレントディレクトリのファイル）
+ACCOUNT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# 認証プロキシがアカウントIDを渡すヘッダー名。未設定なら既定のアカウントだけを使う
+# （アカウントIDを利用者が自由に指定できると他の出品者のデータを読み書きできるので、認証済みのヘッダーでしか切り替えない）
+ACCOUNT_HEADER = os.environ.get('ACCOUNT_HEADER')
+# 全アカウント共通の設定（手数料ルール）を変えるためのトークン（ACCOUNT_HEADER 設定時だけ必要）
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+MAX_ACCOUNTS = int(os.environ.get('MAX_ACCOUNTS', '16'))
+ACCOUNTS_DIR = os.environ.get('ACCOUNTS_DIR', 'accounts')
+
+class Account:
+    """1アカウント分の商品データ・変更フィード・書き込みキュー・集計用の索引"""
+    
+    def __init__(self, account_id):
+        self.id = account_id
+        self.users = 0  # 使用中のリクエスト・ジョブの数（0 のものだけ追い出せる）
+        self.loaded = False
+        self.LOAD_LOCK = threading.Lock()
+        self.DATA = []
+        # 変更フィード
+        # VERSIONS: 商品ID → {"version": 最終変更バージョン, "deleted": 削除済みか}（削除はトゥームストーンとして残す）
+        # CHANGE_LOG: (バージョン, 商品ID) をバージョン順に並べたもの。since 以降を二分探索で取り出す
+        self.VERSIONS = {}
+        self.CHANGE_LOG = []
+        self.VERSION = 0
+        self.VERSIONS_LOCK = threading.Lock()
+        # 書き込みキュー
+        self.WRITE_LOCK = threading.RLock()  # ストレージへの書き込みを直列化
+        # DATA の追加・削除・差し替えを直列化（読み取りはロックなし）。両方取るときは WRITE_LOCK を先に取る
+        # 変更は DATA_LOCK の中で persist(wait=False) まで済ませ、書き込み完了はロックの外で wait_written() で待つ
+        self.DATA_LOCK = threading.RLock()
+        self.PENDING_PUTS = {}  # 商品ID → 保存する商品のコピー
+        self.PENDING_DELETES = set()
+        self.PENDING_VERSIONS = set()
+        self.WRITE_SEQ = 0  # 積まれた書き込みの通し番号
+        self.FLUSHED_SEQ = 0  # 書き込み済みの通し番号
+        self.FAILED_SEQ = 0  # 書き込みに失敗した通し番号（この番号までの変更はキューに戻して再試行中）
+        self.WRITE_ERROR = None  # 最後の書き込みエラー
+        self.JOURNAL_LINES = 0  # JSONファイル保存時のジャーナルの行数
+        self.VERSIONS_JOURNAL_LINES = 0  # 同じく変更フィードのジャーナルの行数
+        self.SQLITE_LOCAL = threading.local()  # SQLite保存時のスレッドごとの接続
+        # 集計用の索引（rebuild_indexes() で作る）
+        self.ARCHIVE_SUMMARY = None
+        self.ROLLUPS = {}  # 期間 → バケット → {項目: 値}
+        self.ROLLUP_CONTRIB = {}  # 商品ID → [(期間, バケット, 項目, 値), ...]
+        self.ROLLUP_LOCK = threading.Lock()
+        self.UNSOLD_BY_DATE = {}  # キー → [(購入日, 商品ID), ...]（購入日順）
+        self.DAYS_TO_SELL = {}  # キー → [売却までの日数, ...]（昇順）
+        self.SELL_THROUGH = {}  # キー → [売却件数, 全件数]
+        self.INVENTORY_ITEMS = {}  # 商品ID → 索引に入れた内容（削除用）
+        self.INVENTORY_LOCK = threading.Lock()
+        self.PRICE_INDEX = {}  # キー → {"prices": [...], "multipliers": [...], "rates": [...]}
+        self.PRICE_ITEMS = {}  # 商品ID → 索引に入れた内容（削除用）
+        self.PRICE_LOCK = threading.Lock()
+        self.SIMILAR_BUCKETS = {}  # (帯の番号, 帯の値) → 署名の集合
+        self.SIMILAR_GROUPS = {}  # 署名 → {商品ID: (売却価格, 売却までの日数)}
+        self.SIMILAR_ITEMS = {}  # 商品ID → 署名（削除用）
+        self.SIMILAR_LOCK = threading.Lock()
+        self.FORECAST_CACHE = {}  # (バージョン, 件数, 手数料設定, 日付, 試行回数) → 結果（最新の1件だけ）
+    
+    def dirty(self):
+        """まだ書き込んでいない変更があるか"""
+        return self.WRITE_SEQ > self.FLUSHED_SEQ
+    
+    def ensure_loaded(self):
+        with self.LOAD_LOCK:
+            if not self.loaded:
+                with use_account(self):
+                    load_account()
+                self.loaded = True
+
+class CurrentAccount:
+    """処理中のアカウントの状態（ACCOUNT.DATA のように使う）"""
+    
+    def __getattr__(self, name):
+        return getattr(current_account(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(current_account(), name, value)
+
+ACCOUNT = CurrentAccount()
+ACCOUNT_LOCAL = threading.local()
+ACCOUNTS = OrderedDict()  # アカウントID → Account（最近使った順）
+ACCOUNTS_LOCK = threading.Lock()
+# 既定のアカウントは起動時に読み込み、追い出さない
+ACCOUNTS[DEFAULT_ACCOUNT] = DEFAULT_ACCOUNT_STATE = Account(DEFAULT_ACCOUNT)
+
+def current_account():
+    """処理中のアカウント（リクエスト・ジョブの外では既定のアカウント）"""
+    return getattr(ACCOUNT_LOCAL, "account", None) or DEFAULT_ACCOUNT_STATE
+
+@contextmanager
+def use_account(account):
+    """このスレッドの処理中のアカウントを一時的に切り替える"""
+    previous = getattr(ACCOUNT_LOCAL, "account", None)
+    ACCOUNT_LOCAL.account = account
+    try:
+        yield account
+    finally:
+        ACCOUNT_LOCAL.account = previous
+
+def acquire_account(account_id):
+    """アカウントを使い始める（メモリになければ読み込む）。使い終わったら release_account() を呼ぶ"""
+    with ACCOUNTS_LOCK:
+        account = ACCOUNTS.get(account_id)
+        if account is None:
+            account = ACCOUNTS[account_id] = Account(account_id)
+            increment("furima_account_loads_total")
+        ACCOUNTS.move_to_end(account_id)
+        account.users += 1
+    try:
+        account.ensure_loaded()
+    except Exception:
+        release_account(account)
+        raise
+    return account
+
+def hold_account(account):
+    """使用中のアカウントをジョブなどでも使う（使い終わったら release_account()）"""
+    with ACCOUNTS_LOCK:
+        account.users += 1
+    return account
+
+def release_account(account):
+    with ACCOUNTS_LOCK:
+        account.users -= 1
+        evict_accounts()
+
+def evict_accounts():
+    """読み込んだアカウントが MAX_ACCOUNTS を超えていれば、使われていないものを古い順に追い出す（ACCOUNTS_LOCK を持って呼ぶ）"""
+    for account_id, account in list(ACCOUNTS.items()):
+        if len(ACCOUNTS) <= MAX_ACCOUNTS:
+            break
+        # 使用中・書き込み待ちの変更があるものは残す
+        if account is DEFAULT_ACCOUNT_STATE or account.users or account.dirty():
+            continue
+        del ACCOUNTS[account_id]
+        increment("furima_account_evictions_total")
+
+def account_path(path, account=None):
+    """アカウントのファイルの場所（既定のアカウントは従来の場所、それ以外は同じディレクトリの accounts/<ID>/ の下）"""
+    account = account or current_account()
+    if account.id == DEFAULT_ACCOUNT:
+        return path
+    return os.path.join(os.path.dirname(path), ACCOUNTS_DIR, account.id, os.path.basename(path))
+
+def account_dirs(path):
+    """ファイル保存時のアカウントのID一覧（既定のアカウントと accounts/ の下のディレクトリ）"""
+    root = os.path.join(os.path.dirname(path), ACCOUNTS_DIR)
+    try:
+        names = {n for n in os.listdir(root) if ACCOUNT_ID_PATTERN.match(n) and os.path.isdir(os.path.join(root, n))}
+    except FileNotFoundError:
+        names = set()
+    return sorted(names | {DEFAULT_ACCOUNT})
+
+def account_key(key):
+    """アカウントごとの設定のキー（手数料ルールなど全体の設定はそのままのキーを使う）"""
+    return key if ACCOUNT.id == DEFAULT_ACCOUNT else f"{key}@{ACCOUNT.id}"
+
+def request_account_id():
+    """リクエストのアカウントID（ACCOUNT_HEADER 未設定なら既定のアカウント、不正なら None）"""
+    if not ACCOUNT_HEADER:
+        return DEFAULT_ACCOUNT
+    account_id = request.headers.get(ACCOUNT_HEADER, "")
+    return account_id if ACCOUNT_ID_PATTERN.match(account_id) else None
+
+def admin_authorized():
+    """全アカウント共通の設定を変える権限（アカウントを分けていなければ誰でも、分けているときはトークン一致のみ）"""
+    if not ACCOUNT_HEADER:
+        return True
+    return bool(ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.before_request
+def bind_account():
+    if request.endpoint in ("metrics", "static"):
+        return None
+    if ACCOUNT_HEADER and not request.headers.get(ACCOUNT_HEADER):
+        return jsonify({"error": "アカウントが指定されていません"}), 401
+    account_id = request_account_id()
+    if account_id is None:
+        return jsonify({"error": "アカウントIDが不正です"}), 400
+    g.account = acquire_account(account_id)
+    ACCOUNT_LOCAL.account = g.account
+
+@app.teardown_request
+def release_request_account(exc=None):
+    account = g.pop("account", None)
+    ACCOUNT_LOCAL.account = None
+    if account is not None:
+        release_account(account)
+
+def event_row(event):
+    """変更履歴1件をテーブルの行に（変更前・変更後はJSON文字列で持つ）"""
+    return dict(event, before=json.dumps(event["before"], ensure_ascii=False),
+                after=json.dumps(event["after"], ensure_ascii=False))
+
+def event_from_row(row):
+    ts = row["ts"]
+    return {
+        "ts": ts.isoformat(timespec="milliseconds") if isinstance(ts, datetime) else ts,
+        "actor": row["actor"],
+        "op": row["op"],
+        "item_id": row["item_id"],
+        "before": json.loads(row["before"]) if row["before"] else None,
+        "after": json.loads(row["after"]) if row["after"] else None,
+    }
+
 # データ保存方法を選択
 USE_DATABASE = DATABASE_URL is not None
 
@@ -16,13 +598,34 @@ if USE_DATABASE:
     # PostgreSQLを使用
     try:
         import psycopg2
-        from psycopg2.extras import RealDictCursor
+        from psycopg2.extras import RealDictCursor, execute_batch
         
         def get_db_connection():
             # Render の DATABASE_URL は postgres:// で始まるが、psycopg2 は postgresql:// を要求する
             db_url = DATABASE_URL.replace('postgres://', 'postgresql://', 1) if DATABASE_URL.startswith('postgres://') else DATABASE_URL
             return psycopg2.connect(db_url, cursor_factory=RealDictCursor)
         
+        replica_turn = itertools.count()  # レプリカを順番に使うためのカウンタ
+        
+        def get_read_connection():
+            """読み取り専用の接続（レプリカを順に試し、つながらなければプライマリ）"""
+            if DATABASE_REPLICA_URLS and not read_your_writes():
+                start = next(replica_turn)
+                for i in range(len(DATABASE_REPLICA_URLS)):
+                    url = DATABASE_REPLICA_URLS[(start + i) % len(DATABASE_REPLICA_URLS)]
+                    if url.startswith('postgres://'):
+                        url = url.replace('postgres://', 'postgresql://', 1)
+                    try:
+                        conn = psycopg2.connect(url, cursor_factory=RealDictCursor, connect_timeout=3)
+                        conn.set_session(readonly=True)
+                        increment("furima_db_reads_total", target="replica")
+                        return conn
+                    except psycopg2.OperationalError as e:
+                        print(f"Replica connection error: {e}")
+                        increment("furima_storage_errors_total", op="replica")
+            increment("furima_db_reads_total", target="primary")
+            return get_db_connection()
+        
         def init_db():
             """データベーステーブルを初期化"""
             conn = get_db_connection()
@@ -44,45 +647,470 @@ if USE_DATABASE:
                     sell_site VARCHAR(100)
                 )
             ''')
+            # アカウントごとに分ける（既存の行は既定のアカウント）
+            use_account_key(cur, 'items')
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_items_account ON items (account_id, buy_date)')
+            # 変更フィード用（商品ごとの最新バージョンと削除済みフラグ）
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS item_versions (
+                    id VARCHAR(255) PRIMARY KEY,
+                    version BIGINT NOT NULL,
+                    deleted BOOLEAN NOT NULL DEFAULT FALSE
+                )
+            ''')
+            use_account_key(cur, 'item_versions')
+            # 手数料ルール（items_derived ビューから参照）
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS fee_rules (
+                    site VARCHAR(100) NOT NULL,
+                    since VARCHAR(20) NOT NULL,
+                    percent FLOAT NOT NULL,
+                    fixed FLOAT NOT NULL,
+                    PRIMARY KEY (site, since)
+                )
+            ''')
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_items_sell_site_date ON items (sell_site, sell_date)')
+            # アーカイブ済みの商品（fee / profit / rate はアーカイブ時点の値のまま）
+            cur.execute('CREATE TABLE IF NOT EXISTS items_archive (LIKE items INCLUDING ALL)')
+            use_account_key(cur, 'items_archive')
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_items_archive_sell_date ON items_archive (sell_date)')
+            # fee / profit / rate をデータベース側で計算するビュー（列順は items と同じ、最後に account_id）
+            # numeric で計算して四捨五入する（calculate_profit の fee_amount / profit_amount / profit_rate と同じ値になる）
+            cur.execute('''
+                CREATE OR REPLACE VIEW items_derived AS
+                SELECT i.id, i.buy_platform, i.category, i.name, i.buy_date, i.sell_date,
+                       i.buy_price, i.sell_price, i.shipping, f.fee, p.profit,
+                       CASE WHEN i.buy_price > 0 THEN ROUND(p.profit::numeric / i.buy_price::numeric * 100, 1)::float8 ELSE 0 END AS rate,
+                       i.sell_site, i.account_id
+                FROM items i
+                LEFT JOIN LATERAL (
+                    SELECT r.percent, r.fixed FROM fee_rules r
+                    WHERE r.site = i.sell_site
+                      AND r.since <= COALESCE(NULLIF(i.sell_date, ''), CURRENT_DATE::text)
+                    ORDER BY r.since DESC LIMIT 1
+                ) r ON TRUE
+                CROSS JOIN LATERAL (
+                    SELECT COALESCE(i.sell_site, '') <> '' AND i.sell_price > 0 AS sold
+                ) s
+                CROSS JOIN LATERAL (
+                    SELECT CASE WHEN s.sold
+                           THEN ROUND(i.sell_price::numeric * COALESCE(r.percent, 0)::numeric + COALESCE(r.fixed, 0)::numeric, 0)::float8
+                           ELSE 0 END AS fee
+                ) f
+                CROSS JOIN LATERAL (
+                    SELECT CASE WHEN s.sold
+                           THEN ROUND(i.sell_price::numeric - i.buy_price::numeric - COALESCE(i.shipping, 0)::numeric - f.fee::numeric, 0)::float8
+                           ELSE 0 END AS profit
+                ) p
+            ''')
+            # 手数料ルールなどの設定
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    key VARCHAR(100) PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+            # バックグラウンドジョブの状態
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id VARCHAR(255) PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+            ''')
+            # 変更履歴（追記のみ）。商品ごとの履歴を新しい順に引けるようにする
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS item_events (
+                    seq BIGSERIAL PRIMARY KEY,
+                    ts TIMESTAMP NOT NULL,
+                    actor VARCHAR(255),
+                    op VARCHAR(20) NOT NULL,
+                    item_id VARCHAR(255),
+                    before TEXT,
+                    after TEXT
+                )
+            ''')
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_item_events_item ON item_events (item_id, seq)')
+            cur.execute(f"ALTER TABLE item_events ADD COLUMN IF NOT EXISTS account_id VARCHAR(64) NOT NULL DEFAULT '{DEFAULT_ACCOUNT}'")
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_item_events_account ON item_events (account_id, seq)')
             conn.commit()
             cur.close()
             conn.close()
         
+        def use_account_key(cur, table):
+            """表に account_id 列を足し、主キーを (account_id, id) にする（アカウントごとに別のID空間）"""
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS account_id VARCHAR(64) NOT NULL DEFAULT '{DEFAULT_ACCOUNT}'")
+            cur.execute("SELECT conname, array_length(conkey, 1) AS columns FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", (table,))
+            key = cur.fetchone()
+            if key and key['columns'] == 1:
+                cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT {key["conname"]}, ADD PRIMARY KEY (account_id, id)')
+        
+        @profiled
+        @timed("db")
         def load_data():
             """データベースからデータを読み込む"""
-            global DATA
             try:
                 conn = get_db_connection()
                 cur = conn.cursor()
                 # buy_dateがNULLの場合は最後に表示
-                cur.execute('SELECT * FROM items ORDER BY COALESCE(buy_date, \'9999-12-31\') DESC')
+                # fee / profit / rate は手数料ルールからビューで計算した値を使う
+                cur.execute(f'SELECT {ITEM_SELECT} FROM items_derived WHERE account_id = %s ORDER BY COALESCE(buy_date, \'9999-12-31\') DESC',
+                            (ACCOUNT.id,))
                 rows = cur.fetchall()
-                DATA = [dict(row) for row in rows]
+                ACCOUNT.DATA = [dict(row) for row in rows]
                 cur.close()
                 conn.close()
             except Exception as e:
                 print(f"Database error: {e}")
-                DATA = []
+                increment("furima_storage_errors_total", op="load")
+                ACCOUNT.DATA = []
         
-        def save_data():
-            """データベースを更新（全件削除して再挿入）"""
+        @profiled
+        @timed("db")
+        def save_data(progress=None):
+            """データベースを更新（全件削除して再挿入。1トランザクションで、失敗したら例外を送出）"""
+            conn = get_db_connection()
             try:
-                conn = get_db_connection()
                 cur = conn.cursor()
-                cur.execute('DELETE FROM items')
-                for item in DATA:
-                    cur.execute('''
-                        INSERT INTO items VALUES (
-                            %(id)s, %(buy_platform)s, %(category)s, %(name)s,
+                cur.execute('DELETE FROM items WHERE account_id = %s', (ACCOUNT.id,))
+                for i, item in enumerate(ACCOUNT.DATA):
+                    cur.execute(item_insert_sql('items'), dict(item, account_id=ACCOUNT.id))
+                    if progress and i % 500 == 0:
+                        progress(i, len(ACCOUNT.DATA))
+                conn.commit()
+                cur.close()
+            except BaseException as e:
+                # キャンセル・失敗時は何も書き込まず、呼び出し元に伝える（復元ジョブは failed になる）
+                conn.rollback()
+                if not isinstance(e, JobCancelled):
+                    print(f"Database save error: {e}")
+                    increment("furima_storage_errors_total", op="save")
+                raise
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def apply_changes(puts, deletes):
+            """変更のあった商品だけを1トランザクションで反映（write-behind のまとめ書き用。失敗したら例外を送出）"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                if deletes:
+                    cur.execute('DELETE FROM items WHERE account_id = %s AND id = ANY(%s)', (ACCOUNT.id, list(deletes)))
+                if puts:
+                    execute_batch(cur, '''
+                        INSERT INTO items (account_id, id, buy_platform, category, name, buy_date, sell_date,
+                                           buy_price, sell_price, shipping, fee, profit, rate, sell_site)
+                        VALUES (
+                            %(account_id)s, %(id)s, %(buy_platform)s, %(category)s, %(name)s,
                             %(buy_date)s, %(sell_date)s, %(buy_price)s, %(sell_price)s,
                             %(shipping)s, %(fee)s, %(profit)s, %(rate)s, %(sell_site)s
                         )
-                    ''', item)
+                        ON CONFLICT (account_id, id) DO UPDATE SET
+                            buy_platform = EXCLUDED.buy_platform, category = EXCLUDED.category,
+                            name = EXCLUDED.name, buy_date = EXCLUDED.buy_date, sell_date = EXCLUDED.sell_date,
+                            buy_price = EXCLUDED.buy_price, sell_price = EXCLUDED.sell_price,
+                            shipping = EXCLUDED.shipping, fee = EXCLUDED.fee, profit = EXCLUDED.profit,
+                            rate = EXCLUDED.rate, sell_site = EXCLUDED.sell_site
+                    ''', account_rows(puts))
+                conn.commit()
+                cur.close()
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def load_versions():
+            """変更フィードのバージョン情報を読み込む"""
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute('SELECT id, version, deleted FROM item_versions WHERE account_id = %s', (ACCOUNT.id,))
+                ACCOUNT.VERSIONS = {row['id']: {"version": row['version'], "deleted": row['deleted']} for row in cur.fetchall()}
+                cur.close()
+                conn.close()
+            except Exception as e:
+                print(f"Database error: {e}")
+                increment("furima_storage_errors_total", op="load")
+                ACCOUNT.VERSIONS = {}
+        
+        @timed("db")
+        def save_versions(ids):
+            """変更のあった商品のバージョン情報だけをUPSERT（失敗したら例外を送出）"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                for item_id in ids:
+                    cur.execute('''
+                        INSERT INTO item_versions (account_id, id, version, deleted) VALUES (%s, %s, %s, %s)
+                        ON CONFLICT (account_id, id) DO UPDATE SET version = EXCLUDED.version, deleted = EXCLUDED.deleted
+                    ''', (ACCOUNT.id, item_id, ACCOUNT.VERSIONS[item_id]["version"], ACCOUNT.VERSIONS[item_id]["deleted"]))
+                conn.commit()
+                cur.close()
+            finally:
+                conn.close()
+        
+        def save_job(job):
+            """ジョブの状態を保存（他のワーカーからもポーリングできるように）"""
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute('''
+                    INSERT INTO jobs (id, data, updated_at) VALUES (%s, %s, NOW())
+                    ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+                ''', (job["id"], json.dumps(job_public(job), ensure_ascii=False)))
+                # 古いジョブは削除
+                cur.execute("DELETE FROM jobs WHERE updated_at < NOW() - INTERVAL '7 days'")
+                conn.commit()
+                cur.close()
+                conn.close()
+            except Exception as e:
+                print(f"Database save error: {e}")
+                increment("furima_storage_errors_total", op="save")
+        
+        def load_job(job_id, primary=False):
+            """ジョブの状態を読み込む（読んで書き戻すときは primary=True）"""
+            try:
+                conn = get_db_connection() if primary else get_read_connection()
+                cur = conn.cursor()
+                cur.execute('SELECT data FROM jobs WHERE id = %s', (job_id,))
+                row = cur.fetchone()
+                cur.close()
+                conn.close()
+                if row is None and not primary and DATABASE_REPLICA_URLS:
+                    # 作成直後でレプリカにまだ届いていないことがある
+                    return load_job(job_id, primary=True)
+                return json.loads(row['data']) if row else None
+            except Exception as e:
+                print(f"Database error: {e}")
+                increment("furima_storage_errors_total", op="load")
+                return None
+        
+        @timed("db")
+        def save_events(events):
+            """変更履歴をまとめて追記"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                execute_batch(cur, '''
+                    INSERT INTO item_events (account_id, ts, actor, op, item_id, before, after)
+                    VALUES (%(account_id)s, %(ts)s, %(actor)s, %(op)s, %(item_id)s, %(before)s, %(after)s)
+                ''', account_rows(event_row(e) for e in events))
+                conn.commit()
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def load_events(item_id=None, limit=100, primary=False):
+            """変更履歴を新しい順に読み込む（item_id 指定時はその商品と全体の復元だけ。primary ならレプリカを使わない）"""
+            where = "AND (item_id = %(item_id)s OR (item_id IS NULL AND op = 'restore'))" if item_id else ''
+            conn = get_db_connection() if primary else get_read_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute(f'''
+                    SELECT ts, actor, op, item_id, before, after FROM item_events
+                    WHERE account_id = %(account_id)s {where}
+                    ORDER BY seq DESC LIMIT %(limit)s
+                ''', {"account_id": ACCOUNT.id, "item_id": item_id, "limit": limit})
+                return [event_from_row(row) for row in cur.fetchall()]
+            finally:
+                conn.close()
+        
+        def iter_items(filters):
+            """条件に合う商品をサーバー側カーソルで EXPORT_CHUNK_ROWS 件ずつ読み込む（エクスポート用）"""
+            where = ["account_id = %(account_id)s"]
+            if filters["categories"]:
+                where.append("category = ANY(%(categories)s)")
+            if filters["platforms"]:
+                where.append("buy_platform = ANY(%(platforms)s)")
+            if filters["sites"]:
+                where.append("sell_site = ANY(%(sites)s)")
+            if filters["status"] == "sold":
+                where.append("COALESCE(sell_site, '') <> ''")
+            elif filters["status"] == "unsold":
+                where.append("COALESCE(sell_site, '') = ''")
+            # date は buy_date か sell_date（export_filters() で検証済み）
+            if filters["from"]:
+                where.append(f"{filters['date']} >= %(from)s")
+            if filters["to"]:
+                where.append(f"{filters['date']} <= %(to)s")
+            if filters["q"]:
+                where.append("strpos(name, %(q)s) > 0")
+            conn = get_read_connection()
+            try:
+                # 名前付きカーソルはサーバー側に結果を置き、itersize 件ずつ取りに行く
+                cur = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+                cur.itersize = EXPORT_CHUNK_ROWS
+                cur.execute(f'''
+                    SELECT {ITEM_SELECT} FROM items_derived WHERE {' AND '.join(where)}
+                    ORDER BY COALESCE(buy_date, '9999-12-31') DESC
+                ''', dict(filters, account_id=ACCOUNT.id))
+                yield from cur
+                cur.close()
+            finally:
+                conn.close()
+        
+        def load_setting(key):
+            """設定（JSON）を読み込む"""
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute('SELECT value FROM settings WHERE key = %s', (key,))
+                row = cur.fetchone()
+                cur.close()
+                conn.close()
+                return json.loads(row['value']) if row else None
+            except Exception as e:
+                print(f"Database error: {e}")
+                increment("furima_storage_errors_total", op="load")
+                return None
+        
+        def save_setting(key, value):
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                cur.execute('''
+                    INSERT INTO settings (key, value) VALUES (%s, %s)
+                    ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                ''', (key, json.dumps(value, ensure_ascii=False)))
+                conn.commit()
+                cur.close()
+                conn.close()
+            except Exception as e:
+                print(f"Database save error: {e}")
+                increment("furima_storage_errors_total", op="save")
+        
+        ITEM_SELECT = ', '.join(ITEM_COLUMNS)  # account_id を除いた商品の列
+        
+        def list_accounts():
+            """商品のあるアカウントのID（既定のアカウントは常に含める）"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT DISTINCT account_id FROM items')
+                return sorted({row['account_id'] for row in cur.fetchall()} | {DEFAULT_ACCOUNT})
+            finally:
+                conn.close()
+        
+        def item_insert_sql(table):
+            return f'''
+                INSERT INTO {table} (account_id, id, buy_platform, category, name, buy_date, sell_date,
+                                     buy_price, sell_price, shipping, fee, profit, rate, sell_site)
+                VALUES (
+                    %(account_id)s, %(id)s, %(buy_platform)s, %(category)s, %(name)s,
+                    %(buy_date)s, %(sell_date)s, %(buy_price)s, %(sell_price)s,
+                    %(shipping)s, %(fee)s, %(profit)s, %(rate)s, %(sell_site)s
+                )
+                ON CONFLICT (account_id, id) DO NOTHING
+            '''
+        
+        def account_rows(rows):
+            """行に処理中のアカウントIDを付ける"""
+            return [dict(row, account_id=ACCOUNT.id) for row in rows]
+        
+        def save_archive_summary(cur, summary):
+            cur.execute('''
+                INSERT INTO settings (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            ''', (account_key('archive_summary'), json.dumps(summary, ensure_ascii=False)))
+        
+        def load_archive_summary():
+            return load_setting(account_key('archive_summary'))
+        
+        @timed("db")
+        def load_archive(ids=None, since=None):
+            """アーカイブ済みの商品を読み込む（ids・売却日 since 以降で絞り込み）"""
+            conditions = ['account_id = %(account_id)s']
+            if ids is not None:
+                conditions.append('id = ANY(%(ids)s)')
+            if since:
+                conditions.append('sell_date >= %(since)s')
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute(f'SELECT {ITEM_SELECT} FROM items_archive WHERE {" AND ".join(conditions)} ORDER BY sell_date',
+                            {"account_id": ACCOUNT.id, "ids": list(ids or []), "since": since})
+                return [dict(row) for row in cur.fetchall()]
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def archive_items(items, summary):
+            """商品をアーカイブ表に移し、アーカイブの集計値も同じトランザクションで保存"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                execute_batch(cur, item_insert_sql('items_archive'), account_rows(items))
+                cur.execute('DELETE FROM items WHERE account_id = %s AND id = ANY(%s)', (ACCOUNT.id, [d["id"] for d in items]))
+                save_archive_summary(cur, summary)
+                conn.commit()
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def unarchive_items(items, summary):
+            """アーカイブから商品を戻す"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                execute_batch(cur, item_insert_sql('items'), account_rows(items))
+                cur.execute('DELETE FROM items_archive WHERE account_id = %s AND id = ANY(%s)', (ACCOUNT.id, [d["id"] for d in items]))
+                save_archive_summary(cur, summary)
+                conn.commit()
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def replace_archive(items, summary):
+            """アーカイブを丸ごと置き換える（復元用）"""
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute('DELETE FROM items_archive WHERE account_id = %s', (ACCOUNT.id,))
+                execute_batch(cur, item_insert_sql('items_archive'), account_rows(items))
+                save_archive_summary(cur, summary)
+                conn.commit()
+            finally:
+                conn.close()
+        
+        @timed("db")
+        def save_fee_rules(rules):
+            """手数料ルールを fee_rules に反映（起動時と手数料ルールの変更時だけ。全アカウント共通）"""
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                # 複数のワーカーが同時に起動しても削除と追加が入り混じらないよう、表をロックしてから入れ替える
+                cur.execute('LOCK TABLE fee_rules IN EXCLUSIVE MODE')
+                cur.execute('DELETE FROM fee_rules')
+                execute_batch(cur, 'INSERT INTO fee_rules VALUES (%(site)s, %(since)s, %(percent)s, %(fixed)s)', rules)
                 conn.commit()
                 cur.close()
                 conn.close()
             except Exception as e:
                 print(f"Database save error: {e}")
+                increment("furima_storage_errors_total", op="save")
+        
+        def recompute_derived(rules, sites=None, all_accounts=False):
+            """保存済みの fee/profit/rate をビューの値（save_fee_rules() で反映した手数料ルール）に揃える
+            対象は処理中のアカウント（all_accounts なら全アカウント）"""
+            where = 'AND i.sell_site = ANY(%(only)s)' if sites else ''
+            if not all_accounts:
+                where += ' AND i.account_id = %(account_id)s'
+            try:
+                conn = get_db_connection()
+                cur = conn.cursor()
+                # 値が変わる行だけを1回のUPDATEで更新（ビューを読む側は常に最新なので外部ツール向け）
+                cur.execute(f'''
+                    UPDATE items i SET fee = d.fee, profit = d.profit, rate = d.rate
+                    FROM items_derived d
+                    WHERE d.account_id = i.account_id AND i.id = d.id {where}
+                      AND (i.fee, i.profit, i.rate) IS DISTINCT FROM (d.fee, d.profit, d.rate)
+                ''', {"account_id": ACCOUNT.id, "only": list(sites or [])})
+                conn.commit()
+                cur.close()
+                conn.close()
+            except Exception as e:
+                print(f"Database save error: {e}")
+                increment("furima_storage_errors_total", op="save")
         
         # データベース初期化
         init_db()
@@ -107,30 +1135,1607 @@ if USE_DATABASE:
         print("psycopg2 not installed, falling back to JSON file")
         USE_DATABASE = False
 
-if not USE_DATABASE:
+# DATABASE_URL がなく STORAGE=sqlite のときはSQLiteファイルに保存（単一サーバー向け）
+USE_SQLITE = not USE_DATABASE and os.environ.get('STORAGE') == 'sqlite'
+
+if USE_SQLITE:
+    import sqlite3
+    
+    SQLITE_PATH = os.environ.get('SQLITE_PATH', 'data.db')
+    # 同じSQL文字列を使い回すことで sqlite3 のステートメントキャッシュが効く
+    INSERT_ITEM_SQL = 'INSERT OR REPLACE INTO items VALUES (%s)' % ', '.join(':' + c for c in ITEM_COLUMNS)
+    INSERT_ARCHIVE_SQL = 'INSERT OR REPLACE INTO items_archive VALUES (%s)' % ', '.join(':' + c for c in ITEM_COLUMNS)
+    
+    def get_sqlite_connection(account=None):
+        """アカウントのファイルへの接続をスレッドごとに使い回す（設定・ジョブは既定のアカウントのファイルに置く）"""
+        account = account or current_account()
+        conn = getattr(account.SQLITE_LOCAL, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(account_path(SQLITE_PATH, account), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # 再計算のSQLでも calculate_profit と同じ丸めを使う
+            conn.create_function('fee_amount', 3, fee_amount, deterministic=True)
+            conn.create_function('profit_amount', 4, profit_amount, deterministic=True)
+            conn.create_function('profit_rate', 2, profit_rate, deterministic=True)
+            account.SQLITE_LOCAL.conn = conn
+        return conn
+    
+    def init_sqlite():
+        """SQLiteのテーブルとインデックスを初期化"""
+        conn = get_sqlite_connection()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS items (
+                    id TEXT PRIMARY KEY,
+                    buy_platform TEXT,
+                    category TEXT,
+                    name TEXT,
+                    buy_date TEXT,
+                    sell_date TEXT,
+                    buy_price REAL,
+                    sell_price REAL,
+                    shipping REAL,
+                    fee REAL,
+                    profit REAL,
+                    rate REAL,
+                    sell_site TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_buy_date ON items (buy_date)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_category ON items (category)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_buy_platform ON items (buy_platform)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_sell_site ON items (sell_site)')
+            # アーカイブ済みの商品（列は items と同じ）
+            conn.execute('CREATE TABLE IF NOT EXISTS items_archive AS SELECT * FROM items WHERE 0')
+            conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_items_archive_id ON items_archive (id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_archive_sell_date ON items_archive (sell_date)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS item_versions (
+                    id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS item_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts TEXT NOT NULL,
+                    actor TEXT,
+                    op TEXT NOT NULL,
+                    item_id TEXT,
+                    before TEXT,
+                    after TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_item_events_item ON item_events (item_id, seq)')
+    
+    def item_row(item):
+        return {c: item.get(c) for c in ITEM_COLUMNS}
+    
+    @profiled
+    @timed("db")
+    def load_data():
+        """SQLiteからデータを読み込む"""
+        rows = get_sqlite_connection().execute(
+            "SELECT * FROM items ORDER BY COALESCE(buy_date, '9999-12-31') DESC").fetchall()
+        ACCOUNT.DATA = [dict(row) for row in rows]
+    
+    @profiled
+    @timed("db")
+    def save_data(progress=None):
+        """全件を書き直す（復元用）"""
+        conn = get_sqlite_connection()
+        try:
+            with conn:
+                conn.execute('DELETE FROM items')
+                for start in range(0, len(ACCOUNT.DATA), 500):
+                    conn.executemany(INSERT_ITEM_SQL, [item_row(d) for d in ACCOUNT.DATA[start:start + 500]])
+                    if progress:
+                        progress(start, len(ACCOUNT.DATA))
+        except JobCancelled:
+            # with を抜けるときにロールバック済み
+            raise
+    
+    @timed("db")
+    def apply_changes(puts, deletes):
+        """変更のあった商品だけを1トランザクションで反映"""
+        conn = get_sqlite_connection()
+        with conn:
+            conn.executemany('DELETE FROM items WHERE id = ?', [(item_id,) for item_id in deletes])
+            conn.executemany(INSERT_ITEM_SQL, [item_row(d) for d in puts])
+    
+    @timed("db")
+    def load_versions():
+        rows = get_sqlite_connection().execute('SELECT id, version, deleted FROM item_versions').fetchall()
+        ACCOUNT.VERSIONS = {row['id']: {"version": row['version'], "deleted": bool(row['deleted'])} for row in rows}
+    
+    @timed("db")
+    def save_versions(ids):
+        conn = get_sqlite_connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO item_versions VALUES (?, ?, ?)',
+                             [(i, ACCOUNT.VERSIONS[i]["version"], int(ACCOUNT.VERSIONS[i]["deleted"])) for i in ids])
+    
+    def save_job(job):
+        conn = get_sqlite_connection(DEFAULT_ACCOUNT_STATE)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)',
+                         (job["id"], json.dumps(job_public(job), ensure_ascii=False), datetime.now().isoformat()))
+    
+    def load_job(job_id, primary=False):
+        row = get_sqlite_connection(DEFAULT_ACCOUNT_STATE).execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    @timed("db")
+    def save_events(events):
+        """変更履歴をまとめて追記"""
+        conn = get_sqlite_connection()
+        with conn:
+            conn.executemany('''
+                INSERT INTO item_events (ts, actor, op, item_id, before, after)
+                VALUES (:ts, :actor, :op, :item_id, :before, :after)
+            ''', [event_row(e) for e in events])
+    
+    @timed("db")
+    def load_events(item_id=None, limit=100, primary=False):
+        """変更履歴を新しい順に読み込む（item_id 指定時はその商品と全体の復元だけ）"""
+        where = "WHERE item_id = :item_id OR (item_id IS NULL AND op = 'restore')" if item_id else ''
+        rows = get_sqlite_connection().execute(f'''
+            SELECT ts, actor, op, item_id, before, after FROM item_events {where}
+            ORDER BY seq DESC LIMIT :limit
+        ''', {"item_id": item_id, "limit": limit}).fetchall()
+        return [event_from_row(row) for row in rows]
+    
+    def load_setting(key):
+        row = get_sqlite_connection(DEFAULT_ACCOUNT_STATE).execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return json.loads(row['value']) if row else None
+    
+    def save_setting(key, value):
+        conn = get_sqlite_connection(DEFAULT_ACCOUNT_STATE)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, json.dumps(value, ensure_ascii=False)))
+    
+    # アーカイブの集計値はアーカイブと同じトランザクションで書けるように、アカウントのファイルの settings に置く
+    def save_archive_summary(conn, summary):
+        conn.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', ('archive_summary', json.dumps(summary, ensure_ascii=False)))
+    
+    def load_archive_summary():
+        row = get_sqlite_connection().execute("SELECT value FROM settings WHERE key = 'archive_summary'").fetchone()
+        return json.loads(row['value']) if row else None
+    
+    def list_accounts():
+        """データのあるアカウントのID（既定のアカウントと accounts/ の下のディレクトリ）"""
+        return account_dirs(SQLITE_PATH)
+    
+    @timed("db")
+    def load_archive(ids=None, since=None):
+        """アーカイブ済みの商品を読み込む（ids・売却日 since 以降で絞り込み）"""
+        conditions, params = [], []
+        if ids is not None:
+            conditions.append('id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(list(ids)))
+        if since:
+            conditions.append('sell_date >= ?')
+            params.append(since)
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        rows = get_sqlite_connection().execute(f'SELECT * FROM items_archive {where} ORDER BY sell_date', params).fetchall()
+        return [dict(row) for row in rows]
+    
+    @timed("db")
+    def archive_items(items, summary):
+        """商品をアーカイブ表に移し、アーカイブの集計値も同じトランザクションで保存"""
+        conn = get_sqlite_connection()
+        with conn:
+            conn.executemany(INSERT_ARCHIVE_SQL, [item_row(d) for d in items])
+            conn.executemany('DELETE FROM items WHERE id = ?', [(d["id"],) for d in items])
+            save_archive_summary(conn, summary)
+    
+    @timed("db")
+    def unarchive_items(items, summary):
+        """アーカイブから商品を戻す"""
+        conn = get_sqlite_connection()
+        with conn:
+            conn.executemany(INSERT_ITEM_SQL, [item_row(d) for d in items])
+            conn.executemany('DELETE FROM items_archive WHERE id = ?', [(d["id"],) for d in items])
+            save_archive_summary(conn, summary)
+    
+    @timed("db")
+    def replace_archive(items, summary):
+        """アーカイブを丸ごと置き換える（復元用）"""
+        conn = get_sqlite_connection()
+        with conn:
+            conn.execute('DELETE FROM items_archive')
+            conn.executemany(INSERT_ARCHIVE_SQL, [item_row(d) for d in items])
+            save_archive_summary(conn, summary)
+    
+    @timed("db")
+    def recompute_derived(rules, sites=None):
+        """手数料ルールから fee/profit/rate をUPDATE文でまとめて再計算（1トランザクション）"""
+        where = 'WHERE sell_site IN (%s)' % ','.join('?' * len(sites)) if sites else ''
+        params = list(sites or [])
+        rule_sql = '''
+            SELECT {col} FROM fee_rules_tmp r
+            WHERE r.site = items.sell_site AND r.since <= COALESCE(NULLIF(items.sell_date, ''), date('now'))
+            ORDER BY r.since DESC LIMIT 1
+        '''
+        conn = get_sqlite_connection()
+        with conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS fee_rules_tmp (site TEXT, since TEXT, percent REAL, fixed REAL)')
+            conn.execute('DELETE FROM fee_rules_tmp')
+            conn.executemany('INSERT INTO fee_rules_tmp VALUES (:site, :since, :percent, :fixed)', rules)
+            # SET 内の式は更新前の値を見るので、fee → profit → rate の順に分けて更新する
+            conn.execute(f'''
+                UPDATE items SET fee = CASE WHEN COALESCE(sell_site, '') <> '' AND sell_price > 0
+                    THEN fee_amount(sell_price, COALESCE(({rule_sql.format(col="percent")}), 0),
+                                    COALESCE(({rule_sql.format(col="fixed")}), 0))
+                    ELSE 0 END {where}
+            ''', params)
+            conn.execute(f'''
+                UPDATE items SET profit = CASE WHEN COALESCE(sell_site, '') <> '' AND sell_price > 0
+                    THEN profit_amount(sell_price, buy_price, shipping, fee) ELSE 0 END {where}
+            ''', params)
+            conn.execute(f'''
+                UPDATE items SET rate = profit_rate(profit, buy_price) {where}
+            ''', params)
+    
+    init_sqlite()
+
+if not USE_DATABASE and not USE_SQLITE:
     # JSONファイルを使用（ローカル開発用）
     DATA_FILE = 'data.json'
     
-    def save_data():
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(DATA, f, ensure_ascii=False, indent=2)
+    # 個別の変更は data.journal に追記し、JOURNAL_COMPACT 行たまったら data.json に書き直す
+    JOURNAL_FILE = 'data.journal'
+    JOURNAL_COMPACT = int(os.environ.get('JOURNAL_COMPACT', '1000'))
     
+    # 書き直し（コンパクション）のたびに data.snap も作り、起動時はJSONより先にこちらを読む
+    SNAPSHOT_FILE = 'data.snap'
+    
+    @profiled
+    @timed("db")
+    def save_data(progress=None):
+        items = list(ACCOUNT.DATA)
+        tmp = account_path(DATA_FILE) + '.tmp'
+        try:
+            # 500件ごとに進捗を知らせる（キャンセルされたら書きかけを消し、data.json は元のまま）
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write("[\n")
+                for start in range(0, len(items), 500):
+                    if start:
+                        f.write(",\n")
+                    f.write(",\n".join(json.dumps(d, ensure_ascii=False) for d in items[start:start + 500]))
+                    if progress:
+                        progress(start, len(items))
+                f.write("\n]\n")
+        except BaseException:
+            os.remove(tmp)
+            raise
+        os.replace(tmp, account_path(DATA_FILE))
+        if snapshot_supported(items):
+            write_snapshot(account_path(SNAPSHOT_FILE), items)
+        elif os.path.exists(account_path(SNAPSHOT_FILE)):
+            os.remove(account_path(SNAPSHOT_FILE))
+        if os.path.exists(account_path(JOURNAL_FILE)):
+            os.remove(account_path(JOURNAL_FILE))
+        ACCOUNT.JOURNAL_LINES = 0
+    
+    def snapshot_fresh():
+        """data.snap が data.json と同じかそれより新しいか"""
+        try:
+            return os.path.getmtime(account_path(SNAPSHOT_FILE)) >= os.path.getmtime(account_path(DATA_FILE))
+        except OSError:
+            return False
+    
+    @profiled
+    @timed("db")
     def load_data():
-        global DATA
+        ACCOUNT.DATA = None
+        if snapshot_fresh():
+            try:
+                ACCOUNT.DATA = read_snapshot(account_path(SNAPSHOT_FILE))
+            except (OSError, ValueError, struct.error) as e:
+                print(f"Snapshot load error: {e}")
+        if ACCOUNT.DATA is None:
+            try:
+                with open(account_path(DATA_FILE), 'r', encoding='utf-8') as f:
+                    ACCOUNT.DATA = json.load(f)
+            except FileNotFoundError:
+                ACCOUNT.DATA = []
+        # ジャーナルを再生
+        ACCOUNT.JOURNAL_LINES = 0
+        try:
+            with open(account_path(JOURNAL_FILE), 'r', encoding='utf-8') as f:
+                items = {d.get("id"): d for d in ACCOUNT.DATA}
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # 書き込み途中で落ちた最終行
+                    if entry["op"] == "put":
+                        items[entry["item"]["id"]] = entry["item"]
+                    else:
+                        items.pop(entry["id"], None)
+                    ACCOUNT.JOURNAL_LINES += 1
+                ACCOUNT.DATA = list(items.values())
+        except FileNotFoundError:
+            pass
+    
+    @timed("db")
+    def apply_changes(puts, deletes):
+        """変更のあった商品だけをジャーナルに1回で追記"""
+        lines = [json.dumps({"op": "del", "id": item_id}, ensure_ascii=False) for item_id in deletes]
+        lines += [json.dumps({"op": "put", "item": item}, ensure_ascii=False) for item in puts]
+        with open(account_path(JOURNAL_FILE), 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        ACCOUNT.JOURNAL_LINES += len(lines)
+        if ACCOUNT.JOURNAL_LINES >= JOURNAL_COMPACT:
+            save_data()
+    
+    # 変更フィードのバージョンも versions.journal に追記し、JOURNAL_COMPACT 行たまったら versions.json に書き直す
+    VERSIONS_FILE = 'versions.json'
+    VERSIONS_JOURNAL_FILE = 'versions.journal'
+    
+    @timed("db")
+    def save_versions(ids):
+        """変更のあった商品のバージョンだけを追記"""
+        lines = []
+        for item_id in ids:
+            entry = ACCOUNT.VERSIONS.get(item_id)
+            if entry is not None:
+                lines.append(json.dumps({"id": item_id, **entry}, ensure_ascii=False))
+        if lines:
+            with open(account_path(VERSIONS_JOURNAL_FILE), 'a', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        ACCOUNT.VERSIONS_JOURNAL_LINES += len(lines)
+        if ACCOUNT.VERSIONS_JOURNAL_LINES >= JOURNAL_COMPACT:
+            compact_versions()
+    
+    def compact_versions():
+        # リクエスト側で更新中でも壊れないようにコピーしてから書く
+        snapshot = ACCOUNT.VERSIONS.copy()
+        tmp = account_path(VERSIONS_FILE) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp, account_path(VERSIONS_FILE))
+        if os.path.exists(account_path(VERSIONS_JOURNAL_FILE)):
+            os.remove(account_path(VERSIONS_JOURNAL_FILE))
+        ACCOUNT.VERSIONS_JOURNAL_LINES = 0
+    
+    @timed("db")
+    def load_versions():
+        try:
+            with open(account_path(VERSIONS_FILE), 'r', encoding='utf-8') as f:
+                ACCOUNT.VERSIONS = json.load(f)
+        except FileNotFoundError:
+            ACCOUNT.VERSIONS = {}
+        # ジャーナルを再生
+        ACCOUNT.VERSIONS_JOURNAL_LINES = 0
+        try:
+            with open(account_path(VERSIONS_JOURNAL_FILE), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # 書き込み途中で落ちた最終行
+                    ACCOUNT.VERSIONS[entry.pop("id")] = entry
+                    ACCOUNT.VERSIONS_JOURNAL_LINES += 1
+        except FileNotFoundError:
+            pass
+    
+    SETTINGS_FILE = 'settings.json'
+    
+    def load_setting(key):
+        try:
+            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f).get(key)
+        except FileNotFoundError:
+            return None
+    
+    def save_setting(key, value):
+        # 読んで書き戻す間に他のスレッドの変更を消さないようロックし、途中で落ちても壊れないよう置き換えで書く
+        with SETTINGS_FILE_LOCK:
+            try:
+                with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except FileNotFoundError:
+                settings = {}
+            settings[key] = value
+            tmp = SETTINGS_FILE + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(settings, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, SETTINGS_FILE)
+    
+    SETTINGS_FILE_LOCK = threading.Lock()
+    
+    JOBS_FILE = 'jobs.json'
+    JOBS_KEEP = 100
+    
+    def read_jobs_file():
+        try:
+            with open(JOBS_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+    
+    def save_job(job):
+        with JOBS_FILE_LOCK:
+            jobs = read_jobs_file()
+            jobs[job["id"]] = job_public(job)
+            # 古いジョブから削除（バックアップのファイルも消す）
+            for old_id in sorted(jobs, key=lambda k: jobs[k]["created_at"])[:-JOBS_KEEP]:
+                del jobs[old_id]
+                remove_job_result(old_id)
+            with open(JOBS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(jobs, f, ensure_ascii=False)
+    
+    def load_job(job_id, primary=False):
+        with JOBS_FILE_LOCK:
+            return read_jobs_file().get(job_id)
+    
+    JOBS_FILE_LOCK = threading.Lock()
+    
+    # 変更履歴は1行1件のJSONで events.log に追記し、AUDIT_ROTATE_MB を超えたら events.log.1, .2 … にずらす
+    EVENTS_FILE = 'events.log'
+    AUDIT_ROTATE_BYTES = int(float(os.environ.get('AUDIT_ROTATE_MB', '10')) * 1024 * 1024)
+    AUDIT_KEEP = int(os.environ.get('AUDIT_KEEP', '5'))
+    
+    def reversed_lines(path, block_size=65536):
+        """ファイルの行を末尾から順に返す（後ろからブロック単位で読み、全体は読み込まない）"""
+        with open(path, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            rest = b''
+            while pos > 0:
+                size = min(block_size, pos)
+                pos -= size
+                f.seek(pos)
+                lines = (f.read(size) + rest).split(b'\n')
+                rest = lines.pop(0)  # ブロックの先頭は前の行の途中かもしれない
+                for line in reversed(lines):
+                    if line:
+                        yield line.decode('utf-8', errors='replace')
+            if rest:
+                yield rest.decode('utf-8', errors='replace')
+    
+    def event_files():
+        """新しい順の変更履歴ファイル"""
+        path = account_path(EVENTS_FILE)
+        return [path] + [f"{path}.{i}" for i in range(1, AUDIT_KEEP + 1)]
+    
+    def rotate_events():
+        files = event_files()
+        for older, newer in zip(reversed(files), list(reversed(files))[1:]):
+            if os.path.exists(newer):
+                os.replace(newer, older)
+    
+    @timed("db")
+    def save_events(events):
+        """変更履歴をまとめて追記"""
+        try:
+            if os.path.getsize(account_path(EVENTS_FILE)) >= AUDIT_ROTATE_BYTES:
+                rotate_events()
+        except FileNotFoundError:
+            pass
+        with open(account_path(EVENTS_FILE), 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events))
+    
+    @timed("db")
+    def load_events(item_id=None, limit=100, primary=False):
+        """変更履歴を新しい順に読み込む（item_id 指定時はその商品と全体の復元だけ）"""
+        events = []
+        for path in event_files():
+            if not os.path.exists(path):
+                continue
+            # 新しいファイルの末尾から必要な分だけ読む（limit 件そろったら古いファイルは開かない）
+            for line in reversed_lines(path):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で落ちた行
+                if item_id and event["item_id"] != item_id and not (event["item_id"] is None and event["op"] == "restore"):
+                    continue
+                events.append(event)
+                if len(events) >= limit:
+                    return events
+        return events
+    
+    ARCHIVE_FILE = 'data.archive.json'
+    ARCHIVE_SUMMARY_FILE = 'data.archive.summary.json'  # アーカイブの集計値（アカウントごと）
+    
+    def write_archive(items):
+        tmp = account_path(ARCHIVE_FILE) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp, account_path(ARCHIVE_FILE))
+    
+    def write_archive_summary(summary):
+        tmp = account_path(ARCHIVE_SUMMARY_FILE) + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+        os.replace(tmp, account_path(ARCHIVE_SUMMARY_FILE))
+    
+    @timed("db")
+    def load_archive(ids=None, since=None):
+        """アーカイブ済みの商品を読み込む（ids・売却日 since 以降で絞り込み）"""
+        try:
+            with open(account_path(ARCHIVE_FILE), 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return []
+        if ids is not None:
+            ids = set(ids)
+            items = [d for d in items if d.get("id") in ids]
+        if since:
+            items = [d for d in items if (d.get("sell_date") or "") >= since]
+        return items
+    
+    @timed("db")
+    def archive_items(items, summary):
+        """商品をアーカイブファイルに移す（DATA からは外してある前提で data.json を書き直す）"""
+        write_archive(load_archive() + items)
+        write_archive_summary(summary)
+        save_data()
+    
+    @timed("db")
+    def unarchive_items(items, summary):
+        """アーカイブから商品を戻す（DATA には戻してある前提）"""
+        ids = {d["id"] for d in items}
+        write_archive([d for d in load_archive() if d.get("id") not in ids])
+        write_archive_summary(summary)
+        save_data()
+    
+    @timed("db")
+    def replace_archive(items, summary):
+        """アーカイブを丸ごと置き換える（復元用）"""
+        write_archive(items)
+        write_archive_summary(summary)
+    
+    def load_archive_summary():
+        try:
+            with open(account_path(ARCHIVE_SUMMARY_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # 以前は settings.json に保存していた
+            return load_setting("archive_summary") if ACCOUNT.id == DEFAULT_ACCOUNT else None
+    
+    def list_accounts():
+        """データのあるアカウントのID（既定のアカウントと accounts/ の下のディレクトリ）"""
+        return account_dirs(DATA_FILE)
+
+# 変更フィード（アカウントの VERSIONS・CHANGE_LOG・VERSION）
+def record_changes(ids, deleted=False):
+    """商品の変更（または削除）を記録し、バージョンを進める。保存すべきIDを返す（persist(versions=...) に渡す）"""
+    account = current_account()
+    ids = list(ids)
+    with account.VERSIONS_LOCK:
+        for item_id in ids:
+            account.VERSION += 1
+            account.VERSIONS[item_id] = {"version": account.VERSION, "deleted": deleted}
+            account.CHANGE_LOG.append((account.VERSION, item_id))
+        # 同じ商品の古いエントリが溜まったら詰め直す
+        if len(account.CHANGE_LOG) > 2 * len(account.VERSIONS) + 100:
+            account.CHANGE_LOG = sorted((v["version"], item_id) for item_id, v in account.VERSIONS.items())
+    return ids
+
+# 書き込みの遅延・まとめ書き（write-behind）
+# 個別の変更は専用スレッドが WRITE_WINDOW_MS の間まとめて1回で書き込む
+# WRITE_MODE=commit: 書き込み完了まで待って応答（既定） / enqueue: キューに積んだらすぐ応答
+WRITE_MODE = os.environ.get('WRITE_MODE', 'commit')
+WRITE_WINDOW = float(os.environ.get('WRITE_WINDOW_MS', '5')) / 1000
+BATCH_BUCKETS = (1, 2, 5, 10, 50, 100, 1000, 10000)
+# 書き込みキュー（PENDING_*・WRITE_SEQ・FLUSHED_SEQ）と WRITE_LOCK・DATA_LOCK はアカウントごと
+WRITE_RETRY = float(os.environ.get('WRITE_RETRY_MS', '1000')) / 1000
+WRITE_COND = threading.Condition()
+DIRTY_ACCOUNTS = set()  # 書き込み待ちの変更があるアカウント
+
+class WriteError(Exception):
+    """変更を保存できなかった（変更はキューに残り、書き込みスレッドが再試行する）"""
+
+@app.errorhandler(WriteError)
+def write_failed(e):
+    return jsonify({"error": f"保存に失敗しました。時間をおいて確認してください: {e}"}), 503
+
+def persist(puts=(), deletes=(), versions=(), wait=None):
+    """変更を書き込みキューに積む（commit モードなら書き込み完了まで待つ）。通し番号を返す"""
+    account = current_account()
+    mark_write()
+    ensure_writer()
+    if puts or deletes:
+        update_indexes(puts, deletes)
+    with WRITE_COND:
+        for item in puts:
+            account.PENDING_PUTS[item["id"]] = dict(item)
+            account.PENDING_DELETES.discard(item["id"])
+        for item_id in deletes:
+            account.PENDING_PUTS.pop(item_id, None)
+            account.PENDING_DELETES.add(item_id)
+        account.PENDING_VERSIONS.update(versions)
+        account.WRITE_SEQ += 1
+        seq = account.WRITE_SEQ
+        DIRTY_ACCOUNTS.add(account)
+        WRITE_COND.notify_all()
+    wait_written(seq, wait)
+    return seq
+
+def wait_written(seq, wait=None):
+    """通し番号 seq までの書き込みを待つ（wait 省略時は commit モードのときだけ）。失敗したら WriteError"""
+    account = current_account()
+    if wait if wait is not None else WRITE_MODE == 'commit':
+        with WRITE_COND:
+            WRITE_COND.wait_for(lambda: account.FLUSHED_SEQ >= seq or account.FAILED_SEQ >= seq)
+            if account.FLUSHED_SEQ < seq:
+                raise WriteError(str(account.WRITE_ERROR))
+
+def flush_pending():
+    """キューに溜まった変更をまとめて書き込む（失敗したら変更をキューに戻して WriteError）"""
+    account = current_account()
+    with account.WRITE_LOCK:
+        with WRITE_COND:
+            puts = list(account.PENDING_PUTS.values())
+            deletes = list(account.PENDING_DELETES)
+            versions = list(account.PENDING_VERSIONS)
+            account.PENDING_PUTS.clear()
+            account.PENDING_DELETES.clear()
+            account.PENDING_VERSIONS.clear()
+            seq = account.WRITE_SEQ
+            DIRTY_ACCOUNTS.discard(account)
+        try:
+            if puts or deletes:
+                apply_changes(puts, deletes)
+                observe("furima_write_batch_size", len(puts) + len(deletes), buckets=BATCH_BUCKETS)
+            if versions:
+                save_versions(versions)
+        except Exception as e:
+            print(f"Write-behind error: {e}")
+            increment("furima_storage_errors_total", op="save")
+            with WRITE_COND:
+                # 取り出した後に積まれた新しい変更を優先し、それ以外をキューに戻す
+                for item in puts:
+                    if item["id"] not in account.PENDING_PUTS and item["id"] not in account.PENDING_DELETES:
+                        account.PENDING_PUTS[item["id"]] = item
+                for item_id in deletes:
+                    if item_id not in account.PENDING_PUTS and item_id not in account.PENDING_DELETES:
+                        account.PENDING_DELETES.add(item_id)
+                account.PENDING_VERSIONS.update(versions)
+                DIRTY_ACCOUNTS.add(account)
+                account.FAILED_SEQ = max(account.FAILED_SEQ, seq)
+                account.WRITE_ERROR = e
+                WRITE_COND.notify_all()
+            raise WriteError(str(e)) from e
+        with WRITE_COND:
+            account.FLUSHED_SEQ = max(account.FLUSHED_SEQ, seq)
+            WRITE_COND.notify_all()
+
+def flush_accounts():
+    """書き込み待ちの変更があるアカウントを順に書き込む。全部書けたら True"""
+    with WRITE_COND:
+        accounts = list(DIRTY_ACCOUNTS)
+    ok = True
+    for account in accounts:
+        with use_account(account):
+            try:
+                flush_pending()
+            except WriteError:
+                ok = False
+    return ok
+
+def full_save(progress=None):
+    """全件を書き直す（復元用）。保留中の個別変更もその後に反映する"""
+    with ACCOUNT.WRITE_LOCK:
+        save_data(progress=progress)
+        flush_pending()
+
+def writer_loop():
+    while True:
+        with WRITE_COND:
+            WRITE_COND.wait_for(lambda: DIRTY_ACCOUNTS)
+        # 同じ窓の中で届いた変更をまとめる
+        time.sleep(WRITE_WINDOW)
+        if not flush_accounts():
+            # 失敗した変更はキューに残っているので、少し待ってから再試行する
+            time.sleep(WRITE_RETRY)
+
+# 書き込みスレッドは最初の書き込みで起動する（プロセスごとに1つ）
+WRITER_PID = None
+WRITER_START_LOCK = threading.Lock()
+
+def ensure_writer():
+    """このプロセスの書き込みスレッド（商品・変更履歴）がなければ起動する"""
+    global WRITER_PID
+    if WRITER_PID == os.getpid():
+        return
+    with WRITER_START_LOCK:
+        if WRITER_PID != os.getpid():
+            threading.Thread(target=writer_loop, daemon=True, name='writer').start()
+            threading.Thread(target=audit_loop, daemon=True, name='audit').start()
+            WRITER_PID = os.getpid()
+
+atexit.register(flush_accounts)
+
+# 変更履歴（監査ログ）
+# 追加・編集・削除・復元などを「誰が・いつ・何を（変更前→変更後）」の形で追記のみのログに残す
+# リクエストではキューに積むだけで、専用スレッドが AUDIT_WINDOW_MS の間まとめて1回で書き込む（応答は待たせない）
+AUDIT_WINDOW = float(os.environ.get('AUDIT_WINDOW_MS', '200')) / 1000
+AUDIT_QUEUE = []  # (アカウント, 変更履歴)
+AUDIT_COND = threading.Condition()
+AUDIT_FLUSH_LOCK = threading.Lock()
+AUDIT_LOCAL = threading.local()  # ジョブの実行中は依頼したリクエストの操作者を持つ
+
+def current_actor():
+    """操作者（リクエストの送信元。ジョブでは依頼元、どちらでもなければ system）"""
+    if has_request_context():
+        # プロキシ経由の送信元は PROXY_COUNT の ProxyFix が remote_addr に入れる
+        return request.remote_addr or "unknown"
+    return getattr(AUDIT_LOCAL, "actor", None) or "system"
+
+def item_diff(before, after):
+    """変わった項目だけを (変更前, 変更後) で返す"""
+    keys = [c for c in ITEM_COLUMNS if before.get(c) != after.get(c)]
+    return {c: before.get(c) for c in keys}, {c: after.get(c) for c in keys}
+
+def audit(op, item_id, before=None, after=None):
+    """変更履歴を1件キューに積む（before / after は後から書き換えられないコピーを渡す）"""
+    event = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "actor": current_actor(),
+        "op": op,
+        "item_id": item_id,
+        "before": before,
+        "after": after,
+    }
+    ensure_writer()
+    with AUDIT_COND:
+        AUDIT_QUEUE.append((current_account(), event))
+        AUDIT_COND.notify()
+
+def audit_edit(op, before, after):
+    """変更前後の商品を比べ、変わった項目があれば履歴に残す"""
+    old, new = item_diff(before, after)
+    if new:
+        audit(op, after.get("id"), old, new)
+
+def audit_restore(old_ids, new_ids, archived):
+    """復元は全件の置き換えなので、商品ごとではなく件数だけを1件で残す（商品の履歴にも表示）"""
+    audit("restore", None, {"items": len(old_ids)},
+          {"items": len(new_ids), "added": len(new_ids - old_ids), "removed": len(old_ids - new_ids), "archived_items": archived})
+
+def flush_audit():
+    """キューに溜まった変更履歴をまとめて書き込む"""
+    with AUDIT_FLUSH_LOCK:
+        with AUDIT_COND:
+            events = AUDIT_QUEUE[:]
+            AUDIT_QUEUE.clear()
+        by_account = {}
+        for account, event in events:
+            by_account.setdefault(account, []).append(event)
+        for account, account_events in by_account.items():
+            try:
+                with use_account(account):
+                    save_events(account_events)
+                observe("furima_audit_batch_size", len(account_events), buckets=BATCH_BUCKETS)
+            except Exception as e:
+                print(f"Audit log error: {e}")
+                increment("furima_storage_errors_total", op="audit")
+
+def audit_loop():
+    while True:
+        with AUDIT_COND:
+            AUDIT_COND.wait_for(lambda: AUDIT_QUEUE)
+        time.sleep(AUDIT_WINDOW)
+        flush_audit()
+
+atexit.register(flush_audit)
+
+def apply_fee_settings(settings):
+    """サイトごとに適用開始日の昇順で並べた索引を作る（二分探索で該当ルールを引く）"""
+    global FEE_SETTINGS, FEE_RULE_INDEX
+    index = {}
+    for r in settings["rules"]:
+        sinces, rules = index.setdefault(r["site"], ([], []))
+        sinces.append(r["since"])
+        rules.append(r)
+    FEE_SETTINGS, FEE_RULE_INDEX = settings, index
+
+def fee_rule(site, sell_date=None):
+    """売却日時点で有効な手数料ルール"""
+    sinces, rules = FEE_RULE_INDEX.get(site, ((), ()))
+    i = bisect.bisect_right(sinces, sell_date or datetime.now().strftime("%Y-%m-%d")) - 1
+    return rules[i] if i >= 0 else None
+
+def calculate_profit(buy, sell, ship, site, sell_date=None):
+    """手数料・利益・利益率を計算（未売却なら全て0）"""
+    if site and sell > 0:
+        # 売却済みの場合：売却日時点の手数料ルールと実際の送料で計算
+        rule = fee_rule(site, sell_date)
+        fee = fee_amount(sell, rule["percent"], rule["fixed"]) if rule else 0
+        profit = profit_amount(sell, buy, ship, fee)
+        rate = profit_rate(profit, buy)
+        return fee, profit, rate
+    # 未売却の場合：利益は0（見込み利益は別途計算）
+    return 0, 0, 0
+
+def estimate_profit(sell, buy, category):
+    """未売却商品の見込み利益（見込み手数料・カテゴリ別の見込み送料で概算）"""
+    estimate = FEE_SETTINGS["estimate"]
+    shipping = FEE_SETTINGS["shipping_defaults"].get(category, FEE_SETTINGS["default_shipping"])
+    return sell - buy - (sell * estimate["percent"] + estimate["fixed"]) - shipping
+
+def estimate_note():
+    """見込み計算の前提（画面表示用）"""
+    estimate = FEE_SETTINGS["estimate"]
+    note = f"手数料{estimate['percent'] * 100:g}%"
+    if estimate["fixed"]:
+        note += f"+{estimate['fixed']:g}円"
+    return note + f"・送料{FEE_SETTINGS['default_shipping']:g}円で概算"
+
+apply_fee_settings(parse_fee_settings(load_setting("fee_rules")))
+
+if USE_DATABASE:
+    # 起動時に手数料ルールを反映し、保存済みの派生値を全アカウント分揃える（アカウントの読み込みのたびには行わない）
+    save_fee_rules(FEE_SETTINGS["rules"])
+    recompute_derived(FEE_SETTINGS["rules"], all_accounts=True)
+
+# 期間別集計（月・週）
+# 商品ごとの寄与分を覚えておき、追加・編集・削除のたびに差分だけ足し引きする
+# 売上・手数料・送料・利益・売却件数は売却日、仕入れ額・仕入件数は購入日で集計
+ROLLUP_PERIODS = ("month", "week")
+ROLLUP_FIELDS = ("revenue", "fees", "shipping", "profit", "sold", "spend", "bought")
+BUCKET_CACHE = {}
+
+def date_buckets(date_str):
+    """日付文字列 → {"month": "2024-05", "week": 週の月曜日}（不正な日付は None）"""
+    buckets = BUCKET_CACHE.get(date_str)
+    if buckets is None and date_str not in BUCKET_CACHE:
+        try:
+            d = datetime.strptime(date_str, "%Y-%m-%d")
+            buckets = {"month": date_str[:7], "week": (d - timedelta(days=d.weekday())).strftime("%Y-%m-%d")}
+        except (TypeError, ValueError):
+            buckets = None
+        BUCKET_CACHE[date_str] = buckets
+    return buckets
+
+def rollup_contributions(item):
+    contrib = []
+    bought = date_buckets(item.get("buy_date"))
+    if bought:
+        for period in ROLLUP_PERIODS:
+            contrib.append((period, bought[period], "spend", item.get("buy_price") or 0))
+            contrib.append((period, bought[period], "bought", 1))
+    sold = date_buckets(item.get("sell_date")) if item.get("sell_site") else None
+    if sold:
+        for period in ROLLUP_PERIODS:
+            bucket = sold[period]
+            contrib.append((period, bucket, "revenue", item.get("sell_price") or 0))
+            contrib.append((period, bucket, "fees", item.get("fee") or 0))
+            contrib.append((period, bucket, "shipping", item.get("shipping") or 0))
+            contrib.append((period, bucket, "profit", item.get("profit") or 0))
+            contrib.append((period, bucket, "sold", 1))
+    return contrib
+
+def apply_contributions(contrib, sign):
+    account = current_account()
+    for period, bucket, field, value in contrib:
+        totals = account.ROLLUPS[period].get(bucket)
+        if totals is None:
+            totals = account.ROLLUPS[period][bucket] = dict.fromkeys(ROLLUP_FIELDS, 0)
+        totals[field] += sign * value
+
+def update_rollups(puts=(), deletes=()):
+    """変更された商品の寄与分だけ入れ替える"""
+    account = current_account()
+    with account.ROLLUP_LOCK:
+        for item_id in deletes:
+            apply_contributions(account.ROLLUP_CONTRIB.pop(item_id, ()), -1)
+        for item in puts:
+            apply_contributions(account.ROLLUP_CONTRIB.pop(item["id"], ()), -1)
+            contrib = rollup_contributions(item)
+            apply_contributions(contrib, 1)
+            account.ROLLUP_CONTRIB[item["id"]] = contrib
+
+def rebuild_rollups():
+    """全件から作り直す（起動時・復元後など）"""
+    account = current_account()
+    with account.ROLLUP_LOCK:
+        account.ROLLUPS = {period: {} for period in ROLLUP_PERIODS}
+        account.ROLLUP_CONTRIB = {}
+        for item in account.DATA:
+            contrib = rollup_contributions(item)
+            apply_contributions(contrib, 1)
+            account.ROLLUP_CONTRIB[item.get("id")] = contrib
+        # アーカイブ済みの商品は保存しておいた集計値を足す
+        for period, buckets in account.ARCHIVE_SUMMARY["rollups"].items():
+            for bucket, totals in buckets.items():
+                apply_contributions([(period, bucket, field, value) for field, value in totals.items()], 1)
+
+# 在庫の滞留・売れ行き
+# 未売却商品は購入日でソートした索引（(購入日, ID) のリスト）を、売却済み商品は売却までの日数のソート済みリストを
+# 全体・カテゴリ別・購入先別に持つ。滞留日数の区分は二分探索、中央値は添字で求める
+AGE_BUCKETS = (30, 60, 90, 180)  # 0-30日, 31-60日, 61-90日, 91-180日, 181日以上
+ORDINAL_CACHE = {}
+
+def date_ordinal(date_str):
+    """日付文字列 → 通し日数（不正な日付は None）"""
+    ordinal = ORDINAL_CACHE.get(date_str)
+    if ordinal is None and date_str not in ORDINAL_CACHE:
+        try:
+            ordinal = datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+        except (TypeError, ValueError):
+            ordinal = None
+        ORDINAL_CACHE[date_str] = ordinal
+    return ordinal
+
+def inventory_entry(item):
+    keys = ("all", ("category", item.get("category")), ("platform", item.get("buy_platform")))
+    sold = bool(item.get("sell_site"))
+    buy_date = item.get("buy_date") if date_ordinal(item.get("buy_date")) else None
+    days = None
+    if sold and buy_date and date_ordinal(item.get("sell_date")):
+        days = date_ordinal(item.get("sell_date")) - date_ordinal(buy_date)
+    return keys, sold, buy_date, days
+
+def inventory_apply(item_id, entry, add):
+    account = current_account()
+    keys, sold, buy_date, days = entry
+    for key in keys:
+        counts = account.SELL_THROUGH.setdefault(key, [0, 0])
+        counts[0] += (1 if add else -1) * sold
+        counts[1] += 1 if add else -1
+        if not sold and buy_date:
+            index = account.UNSOLD_BY_DATE.setdefault(key, [])
+            if add:
+                bisect.insort(index, (buy_date, item_id))
+            else:
+                i = bisect.bisect_left(index, (buy_date, item_id))
+                if i < len(index) and index[i] == (buy_date, item_id):
+                    del index[i]
+        if days is not None:
+            index = account.DAYS_TO_SELL.setdefault(key, [])
+            if add:
+                bisect.insort(index, days)
+            else:
+                i = bisect.bisect_left(index, days)
+                if i < len(index) and index[i] == days:
+                    del index[i]
+
+def update_inventory(puts=(), deletes=()):
+    account = current_account()
+    with account.INVENTORY_LOCK:
+        for item_id in deletes:
+            if item_id in account.INVENTORY_ITEMS:
+                inventory_apply(item_id, account.INVENTORY_ITEMS.pop(item_id), add=False)
+        for item in puts:
+            if item["id"] in account.INVENTORY_ITEMS:
+                inventory_apply(item["id"], account.INVENTORY_ITEMS.pop(item["id"]), add=False)
+            entry = inventory_entry(item)
+            inventory_apply(item["id"], entry, add=True)
+            account.INVENTORY_ITEMS[item["id"]] = entry
+
+def rebuild_inventory():
+    account = current_account()
+    with account.INVENTORY_LOCK:
+        unsold, days_to_sell, counts, entries = {}, {}, {}, {}
+        for item in account.DATA:
+            entry = inventory_entry(item)
+            keys, sold, buy_date, days = entry
+            entries[item.get("id")] = entry
+            for key in keys:
+                c = counts.setdefault(key, [0, 0])
+                c[0] += sold
+                c[1] += 1
+                if not sold and buy_date:
+                    unsold.setdefault(key, []).append((buy_date, item.get("id")))
+                if days is not None:
+                    days_to_sell.setdefault(key, []).append(days)
+        for index in list(unsold.values()) + list(days_to_sell.values()):
+            index.sort()
+        for key, (sold, total) in account.ARCHIVE_SUMMARY["sell_through"].items():
+            key = json.loads(key)
+            c = counts.setdefault(tuple(key) if isinstance(key, list) else key, [0, 0])
+            c[0] += sold
+            c[1] += total
+        account.UNSOLD_BY_DATE, account.DAYS_TO_SELL, account.SELL_THROUGH, account.INVENTORY_ITEMS = unsold, days_to_sell, counts, entries
+
+def median_days(key):
+    """売却までの日数の中央値（データがなければ None）"""
+    days = ACCOUNT.DAYS_TO_SELL.get(key)
+    if not days:
+        return None
+    mid = len(days) // 2
+    return days[mid] if len(days) % 2 else (days[mid - 1] + days[mid]) / 2
+
+def age_counts(key, today):
+    """滞留日数の区分ごとの未売却件数（購入日の索引を二分探索）"""
+    index = ACCOUNT.UNSOLD_BY_DATE.get(key, [])
+    counts = []
+    upper = len(index)
+    for limit in AGE_BUCKETS:
+        cutoff = (today - timedelta(days=limit)).strftime("%Y-%m-%d")
+        lower = bisect.bisect_left(index, (cutoff,))
+        counts.append(upper - lower)
+        upper = lower
+    counts.append(upper)
+    return counts
+
+# 価格の索引（AI価格提案用）
+# カテゴリ別・カテゴリ×販売サイト別に、売却価格・売却倍率（売却価格/仕入れ価格）・利益率のソート済みリストを持つ
+# 追加・削除は二分探索で位置を求めて挿入・削除し、パーセンタイルは添字で求める
+PRICE_SERIES = ("prices", "multipliers", "rates")
+
+def price_entry(item):
+    sell = item.get("sell_price") or 0
+    if not item.get("sell_site") or sell <= 0:
+        return None
+    buy = item.get("buy_price") or 0
+    keys = (("category", item.get("category")), ("category_site", item.get("category"), item.get("sell_site")))
+    values = {"prices": sell, "multipliers": sell / buy if buy > 0 else None, "rates": item.get("rate") or 0}
+    return keys, values
+
+def price_apply(entry, add):
+    account = current_account()
+    keys, values = entry
+    for key in keys:
+        index = account.PRICE_INDEX.setdefault(key, {series: [] for series in PRICE_SERIES})
+        for series, value in values.items():
+            if value is None:
+                continue
+            if add:
+                bisect.insort(index[series], value)
+            else:
+                i = bisect.bisect_left(index[series], value)
+                if i < len(index[series]) and index[series][i] == value:
+                    del index[series][i]
+
+def update_prices(puts=(), deletes=()):
+    account = current_account()
+    with account.PRICE_LOCK:
+        for item_id in deletes:
+            entry = account.PRICE_ITEMS.pop(item_id, None)
+            if entry:
+                price_apply(entry, add=False)
+        for item in puts:
+            entry = account.PRICE_ITEMS.pop(item["id"], None)
+            if entry:
+                price_apply(entry, add=False)
+            entry = price_entry(item)
+            if entry:
+                price_apply(entry, add=True)
+                account.PRICE_ITEMS[item["id"]] = entry
+
+def rebuild_prices():
+    account = current_account()
+    with account.PRICE_LOCK:
+        index, entries = {}, {}
+        for item in account.DATA:
+            entry = price_entry(item)
+            if entry is None:
+                continue
+            entries[item.get("id")] = entry
+            keys, values = entry
+            for key in keys:
+                lists = index.setdefault(key, {series: [] for series in PRICE_SERIES})
+                for series, value in values.items():
+                    if value is not None:
+                        lists[series].append(value)
+        for lists in index.values():
+            for values in lists.values():
+                values.sort()
+        account.PRICE_INDEX, account.PRICE_ITEMS = index, entries
+
+def quantile(values, q):
+    """ソート済みリストの分位点（線形補間）"""
+    if not values:
+        return None
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def price_stats(key):
+    """P25・中央値・P75（売却価格・売却倍率・利益率）"""
+    account = current_account()
+    with account.PRICE_LOCK:
+        index = account.PRICE_INDEX.get(key)
+        if not index or not index["prices"]:
+            return None
+        return {
+            series: {"p25": quantile(values, 0.25), "median": quantile(values, 0.5), "p75": quantile(values, 0.75)}
+            for series, values in index.items()
+        } | {"count": len(index["prices"])}
+
+# 類似商品の索引（商品名の文字2-gramのMinHash署名をLSHのバケットに振り分ける）
+# 署名をSIMILAR_BANDS個の帯に分け、どれか1つの帯が一致した商品だけを候補にして類似度を比べる
+# 同じ署名の商品はまとめて持ち、候補の比較は異なる署名の数だけで済ませる
+SIMILAR_PERMS = 64
+SIMILAR_BANDS = 16
+SIMILAR_ROWS = SIMILAR_PERMS // SIMILAR_BANDS
+SIMILAR_MIN = float(os.environ.get('SIMILAR_MIN', '0.3'))  # これ未満の類似度は似ていないとみなす
+SIMILAR_K = int(os.environ.get('SIMILAR_K', '10'))
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_PARAMS = [(r.randrange(1, MINHASH_PRIME), r.randrange(MINHASH_PRIME)) for r in [random.Random(20240101)] for _ in range(SIMILAR_PERMS)]
+SHINGLE_HASHES = {}  # 2-gram → 各ハッシュ関数での値
+
+def name_shingles(name):
+    text = "".join(unicodedata.normalize("NFKC", name or "").lower().split())
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def minhash(name):
+    """商品名のMinHash署名（名前が空ならNone）"""
+    vectors = []
+    for shingle in name_shingles(name):
+        vector = SHINGLE_HASHES.get(shingle)
+        if vector is None:
+            x = zlib.crc32(shingle.encode("utf-8"))
+            vector = SHINGLE_HASHES[shingle] = tuple((a * x + b) % MINHASH_PRIME for a, b in MINHASH_PARAMS)
+        vectors.append(vector)
+    if not vectors:
+        return None
+    return tuple(map(min, zip(*vectors)))
+
+def signature_bands(signature):
+    return [(band, signature[band * SIMILAR_ROWS:(band + 1) * SIMILAR_ROWS]) for band in range(SIMILAR_BANDS)]
+
+def similar_entry(item, signatures=None):
+    sell = item.get("sell_price") or 0
+    if not item.get("sell_site") or sell <= 0:
+        return None
+    name = item.get("name")
+    if signatures is None:
+        signature = minhash(name)
+    elif name in signatures:
+        signature = signatures[name]
+    else:
+        signature = signatures[name] = minhash(name)
+    if signature is None:
+        return None
+    days = None
+    if date_ordinal(item.get("buy_date")) and date_ordinal(item.get("sell_date")):
+        days = date_ordinal(item.get("sell_date")) - date_ordinal(item.get("buy_date"))
+    return signature, (sell, days)
+
+def similar_add(item_id, signature, values):
+    account = current_account()
+    group = account.SIMILAR_GROUPS.get(signature)
+    if group is None:
+        group = account.SIMILAR_GROUPS[signature] = {}
+        for band in signature_bands(signature):
+            account.SIMILAR_BUCKETS.setdefault(band, set()).add(signature)
+    group[item_id] = values
+    account.SIMILAR_ITEMS[item_id] = signature
+
+def similar_remove(item_id):
+    account = current_account()
+    signature = account.SIMILAR_ITEMS.pop(item_id, None)
+    if signature is None:
+        return
+    group = account.SIMILAR_GROUPS[signature]
+    group.pop(item_id, None)
+    if not group:
+        del account.SIMILAR_GROUPS[signature]
+        for band in signature_bands(signature):
+            bucket = account.SIMILAR_BUCKETS[band]
+            bucket.discard(signature)
+            if not bucket:
+                del account.SIMILAR_BUCKETS[band]
+
+def update_similar(puts=(), deletes=()):
+    with ACCOUNT.SIMILAR_LOCK:
+        for item_id in deletes:
+            similar_remove(item_id)
+        for item in puts:
+            similar_remove(item["id"])
+            entry = similar_entry(item)
+            if entry:
+                similar_add(item["id"], *entry)
+
+def rebuild_similar():
+    account = current_account()
+    with account.SIMILAR_LOCK:
+        account.SIMILAR_BUCKETS.clear()
+        account.SIMILAR_GROUPS.clear()
+        account.SIMILAR_ITEMS.clear()
+        signatures = {}  # 同じ商品名は署名を使い回す
+        for item in account.DATA:
+            entry = similar_entry(item, signatures)
+            if entry:
+                similar_add(item.get("id"), *entry)
+
+def similar_items(name, k=SIMILAR_K, exclude=None):
+    """商品名が似ている売却済み商品を類似度の高い順に最大k件（[(類似度, 商品ID, 売却価格, 売却までの日数)]）"""
+    account = current_account()
+    signature = minhash(name)
+    if signature is None:
+        return []
+    with account.SIMILAR_LOCK:
+        candidates = set()
+        for band in signature_bands(signature):
+            candidates |= account.SIMILAR_BUCKETS.get(band, set())
+        scored = []
+        for candidate in candidates:
+            score = sum(a == b for a, b in zip(signature, candidate)) / SIMILAR_PERMS
+            if score >= SIMILAR_MIN:
+                scored.append((score, candidate))
+        results = []
+        for score, candidate in heapq.nlargest(k, scored, key=lambda x: x[0]):
+            for item_id, (sell, days) in account.SIMILAR_GROUPS[candidate].items():
+                if item_id == exclude:
+                    continue
+                results.append((score, item_id, sell, days))
+                if len(results) >= k:
+                    return results
+        return results
+
+# アーカイブ（売却から時間のたった商品を DATA から外して items_archive / data.archive.json に移す）
+# 移した商品の集計値は ARCHIVE_SUMMARY に足して保存しておき、ダッシュボード・期間別集計・売却率はこれを加えて
+# 全期間の値を出す。価格提案・売却日数の中央値などはホットな商品（最近の相場）だけから求める
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '365'))
+
+def empty_archive_summary():
+    return {
+        "count": 0,
+        "profit": 0,
+        "platform_rates": {},  # 購入先 → [利益率の合計, 件数]
+        "pies": {},  # 販売サイト → カテゴリ → 件数
+        "sell_through": {},  # 在庫の索引のキー（JSON文字列）→ [売却件数, 全件数]
+        "rollups": {period: {} for period in ROLLUP_PERIODS},  # 期間 → バケット → {項目: 値}
+    }
+
+def summarize_archive(summary, items, sign):
+    """アーカイブの集計値に商品を足す（sign=-1 なら引く）。元の辞書は変えずに新しい辞書を返す"""
+    summary = json.loads(json.dumps(summary))
+    for item in items:
+        summary["count"] += sign
+        summary["profit"] += sign * (item.get("profit") or 0)
+        if item.get("buy_platform"):
+            rates = summary["platform_rates"].setdefault(item.get("buy_platform"), [0, 0])
+            rates[0] += sign * (item.get("rate") or 0)
+            rates[1] += sign
+        pie = summary["pies"].setdefault(item.get("sell_site"), {})
+        pie[item.get("category")] = pie.get(item.get("category"), 0) + sign
+        for key in inventory_entry(item)[0]:
+            counts = summary["sell_through"].setdefault(json.dumps(key, ensure_ascii=False), [0, 0])
+            counts[0] += sign * bool(item.get("sell_site"))
+            counts[1] += sign
+        for period, bucket, field, value in rollup_contributions(item):
+            totals = summary["rollups"][period].setdefault(bucket, dict.fromkeys(ROLLUP_FIELDS, 0))
+            totals[field] += sign * value
+    # 戻して空になったものは消す
+    summary["platform_rates"] = {k: v for k, v in summary["platform_rates"].items() if v[1]}
+    summary["pies"] = {site: {c: n for c, n in pie.items() if n} for site, pie in summary["pies"].items()}
+    summary["pies"] = {site: pie for site, pie in summary["pies"].items() if pie}
+    summary["sell_through"] = {k: v for k, v in summary["sell_through"].items() if v[1]}
+    for period in ROLLUP_PERIODS:
+        summary["rollups"][period] = {b: t for b, t in summary["rollups"][period].items() if t["sold"] or t["bought"]}
+    return summary
+
+
+def update_indexes(puts=(), deletes=()):
+    """商品の変更を集計用の索引に反映"""
+    update_rollups(puts, deletes)
+    update_inventory(puts, deletes)
+    update_prices(puts, deletes)
+    update_similar(puts, deletes)
+
+def rebuild_indexes():
+    """全件から集計用の索引を作り直す（起動時・復元後など）"""
+    rebuild_rollups()
+    rebuild_inventory()
+    rebuild_prices()
+    rebuild_similar()
+
+# バックグラウンドジョブ（復元・バックアップ・再計算をリクエスト処理の外で実行）
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+JOB_RESULT_DIR = os.path.join(tempfile.gettempdir(), 'furima_jobs')
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL_DAYS', '7')) * 86400  # PostgreSQL のジョブの保存期間と同じ
+JOBS = {}  # このプロセスで受け付けたジョブ（終わったものは新しい JOBS_IN_MEMORY 件だけ残し、それより前は保存先から読む）
+JOBS_IN_MEMORY = int(os.environ.get('JOBS_IN_MEMORY', '100'))
+JOB_FUTURES = {}  # 実行待ち・実行中のジョブだけ
+
+class JobCancelled(Exception):
+    """ジョブがキャンセルされた"""
+
+def job_public(job):
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+def forget_finished_jobs():
+    """終わったジョブを古いものからメモリ上の一覧から外す（状態は save_job で保存済み）"""
+    finished = [job_id for job_id, job in list(JOBS.items()) if job["status"] not in ("queued", "running")]
+    for job_id in finished[:-JOBS_IN_MEMORY] if JOBS_IN_MEMORY else finished:
+        JOBS.pop(job_id, None)
+
+def submit_job(kind, func, *args):
+    """ジョブを登録してすぐに返す。func(job, *args) はワーカースレッドで、登録したアカウントのデータに対して実行される"""
+    now = datetime.now().isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "status": "queued",
+        "progress": 0.0,
+        "message": "",
+        "result": None,
+        "error": None,
+        "cancel_requested": False,
+        "created_at": now,
+        "updated_at": now,
+        "_last_saved": 0.0,
+        "account": ACCOUNT.id,
+        "_actor": current_actor(),
+        # 実行が終わるまでアカウントを追い出さない
+        "_account": hold_account(current_account()),
+    }
+    JOBS[job["id"]] = job
+    save_job(job)
+    
+    def run():
+        if job["cancel_requested"]:
+            job["status"] = "cancelled"
+            save_job(job)
+            release_account(job.pop("_account"))
+            forget_finished_jobs()
+            return
+        job["status"] = "running"
+        save_job(job)
+        AUDIT_LOCAL.actor = job["_actor"]
+        try:
+            with use_account(job["_account"]):
+                job["result"] = func(job, *args)
+            job["status"] = "done"
+            job["progress"] = 1.0
+            job["message"] = ""
+        except JobCancelled:
+            job["status"] = "cancelled"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            release_account(job.pop("_account"))
+        job["updated_at"] = datetime.now().isoformat()
+        save_job(job)
+        increment("furima_jobs_total", kind=kind, status=job["status"])
+        forget_finished_jobs()
+    
+    JOB_FUTURES[job["id"]] = future = JOB_EXECUTOR.submit(run)
+    # 終わった（キャンセルされた）ら外す。すでに終わっていればその場で呼ばれる
+    future.add_done_callback(lambda f: JOB_FUTURES.pop(job["id"], None))
+    return job
+
+def job_progress(job, done, total, message=""):
+    """進捗を更新し、キャンセルされていれば JobCancelled を送出"""
+    job["progress"] = round(done / total, 3) if total else 0.0
+    job["message"] = message
+    now = time.monotonic()
+    # 保存は0.5秒に1回まで（他ワーカーで受けたキャンセルもここで拾う）
+    if now - job["_last_saved"] >= 0.5:
+        job["_last_saved"] = now
+        job["updated_at"] = datetime.now().isoformat()
+        stored = load_job(job["id"], primary=True)
+        if stored and stored.get("cancel_requested"):
+            job["cancel_requested"] = True
+        save_job(job)
+    if job["cancel_requested"]:
+        raise JobCancelled()
+
+def get_job(job_id):
+    """ジョブの状態（別のアカウントのジョブは見えない）"""
+    job = JOBS.get(job_id)
+    job = job_public(job) if job else load_job(job_id)
+    if job is None or job.get("account", DEFAULT_ACCOUNT) != ACCOUNT.id:
+        return None
+    return job
+
+def run_restore(job, raw):
+    """バックアップJSONで全データを置き換える"""
+    job_progress(job, 0, 1, "読み込み中")
+    backup_data = json.loads(raw)
+    if 'items' not in backup_data:
+        raise ValueError("無効なバックアップファイル形式です")
+    with ACCOUNT.WRITE_LOCK, ACCOUNT.DATA_LOCK:
+        old_data = ACCOUNT.DATA
+        ACCOUNT.DATA = backup_data['items']
+        try:
+            full_save(progress=lambda done, total: job_progress(job, done, total, "保存中"))
+        except BaseException:
+            # キャンセル・保存の失敗時はメモリ上も元のデータに戻す
+            ACCOUNT.DATA = old_data
+            raise
+        restore_archive(backup_data.get('archived_items', []))
+        rebuild_indexes()
+        old_ids = {d.get("id") for d in old_data}
+        new_ids = {d.get("id") for d in ACCOUNT.DATA}
+        seq = persist(versions=record_changes(old_ids - new_ids, deleted=True) + record_changes(new_ids), wait=False)
+        audit_restore(old_ids, new_ids, len(backup_data.get('archived_items', [])))
+    wait_written(seq)
+    return {"items": len(ACCOUNT.DATA)}
+
+def remove_job_result(job_id):
+    try:
+        os.remove(os.path.join(JOB_RESULT_DIR, f"{job_id}.json"))
+    except FileNotFoundError:
+        pass
+
+def prune_job_results():
+    """保存期間 JOB_RESULT_TTL を過ぎたバックアップのファイルを消す"""
+    limit = time.time() - JOB_RESULT_TTL
+    for entry in os.scandir(JOB_RESULT_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def run_backup(job):
+    """バックアップJSONをファイルに書き出す（ダウンロードは /jobs/<id>/download）"""
+    os.makedirs(JOB_RESULT_DIR, exist_ok=True)
+    prune_job_results()
+    items = list(ACCOUNT.DATA)
+    path = os.path.join(JOB_RESULT_DIR, f"{job['id']}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"backup_date": %s, "items": [\n' % json.dumps(datetime.now().isoformat()))
+        for i, item in enumerate(items):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(item, ensure_ascii=False))
+            if i % 1000 == 0:
+                job_progress(job, i, len(items), "書き出し中")
+        # アーカイブ済みの商品も含める（復元時はアーカイブに戻す）
+        f.write('\n], "archived_items": [\n')
+        for i, item in enumerate(load_archive()):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(item, ensure_ascii=False))
+        f.write("\n]}\n")
+    return {"items": len(items), "filename": f"furima_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"}
+
+def restore_archive(items):
+    """アーカイブをバックアップの内容で置き換える（古いバックアップなら空にする）"""
+    summary = summarize_archive(empty_archive_summary(), items, 1)
+    replace_archive(items, summary)
+    ACCOUNT.ARCHIVE_SUMMARY = summary
+
+def run_archive(job, before):
+    """売却日が before より前の商品をアーカイブに移す"""
+    job_progress(job, 0, 1, "アーカイブ中")
+    with ACCOUNT.WRITE_LOCK, ACCOUNT.DATA_LOCK:
+        flush_pending()
+        moving = [d for d in ACCOUNT.DATA if d.get("sell_site") and d.get("sell_date") and d["sell_date"] < before]
+        if not moving:
+            return {"archived": 0, "archive_count": ACCOUNT.ARCHIVE_SUMMARY["count"]}
+        ids = {d["id"] for d in moving}
+        summary = summarize_archive(ACCOUNT.ARCHIVE_SUMMARY, moving, 1)
+        old_data = ACCOUNT.DATA
+        ACCOUNT.DATA = [d for d in ACCOUNT.DATA if d.get("id") not in ids]
+        try:
+            archive_items(moving, summary)
+        except Exception:
+            ACCOUNT.DATA = old_data
+            raise
+        ACCOUNT.ARCHIVE_SUMMARY = summary
+        for d in moving:
+            audit("archive", d["id"])
+        # 差分同期のクライアントからは削除として見える（戻したときにまた届く）
+        seq = persist(versions=record_changes(ids, deleted=True), wait=False)
+    rebuild_indexes()
+    wait_written(seq)
+    return {"archived": len(moving), "archive_count": summary["count"]}
+
+def run_unarchive(job, since=None, ids=None):
+    """アーカイブから商品を戻す（売却日が since 以降のもの、または ids で指定したもの）"""
+    job_progress(job, 0, 1, "読み込み中")
+    with ACCOUNT.WRITE_LOCK, ACCOUNT.DATA_LOCK:
+        flush_pending()
+        items = load_archive(ids=ids, since=since)
+        if not items:
+            return {"unarchived": 0, "archive_count": ACCOUNT.ARCHIVE_SUMMARY["count"]}
+        summary = summarize_archive(ACCOUNT.ARCHIVE_SUMMARY, items, -1)
+        old_data = ACCOUNT.DATA
+        ACCOUNT.DATA = ACCOUNT.DATA + items
+        try:
+            unarchive_items(items, summary)
+        except Exception:
+            ACCOUNT.DATA = old_data
+            raise
+        ACCOUNT.ARCHIVE_SUMMARY = summary
+        for d in items:
+            audit("unarchive", d["id"])
+        seq = persist(versions=record_changes(d["id"] for d in items), wait=False)
+    rebuild_indexes()
+    wait_written(seq)
+    return {"unarchived": len(items), "archive_count": summary["count"]}
+
+def derived_values(item):
+    return (item.get("fee"), item.get("profit"), item.get("rate"))
+
+def run_recompute(job, sites=None):
+    """手数料・利益・利益率を現在の手数料ルールで再計算（sites 指定時はそのサイトの商品だけ）"""
+    if USE_DATABASE or USE_SQLITE:
+        # データベースでは1回のUPDATEでまとめて計算し、結果を読み直す
+        job_progress(job, 0, 1, "計算中")
+        with ACCOUNT.WRITE_LOCK, ACCOUNT.DATA_LOCK:
+            flush_pending()
+            before = {d.get("id"): derived_values(d) for d in ACCOUNT.DATA}
+            recompute_derived(FEE_SETTINGS["rules"], sites)
+            load_data()
+        rebuild_indexes()
+        changed = [d for d in ACCOUNT.DATA if before.get(d["id"]) != derived_values(d)]
+        for d in changed:
+            audit("recompute", d["id"], dict(zip(("fee", "profit", "rate"), before.get(d["id"], ()))),
+                  dict(zip(("fee", "profit", "rate"), derived_values(d))))
+        changed = [d["id"] for d in changed]
+        if changed:
+            persist(versions=record_changes(changed), wait=True)
+        return {"updated": len(changed)}
+    
+    changed = []
+    updates = []
+    for i, item in enumerate(ACCOUNT.DATA):
+        if sites and item.get("sell_site") not in sites:
+            continue
+        values = calculate_profit(item.get("buy_price") or 0, item.get("sell_price") or 0, item.get("shipping") or 0,
+                                  item.get("sell_site"), item.get("sell_date"))
+        if values != derived_values(item):
+            updates.append((item, values))
+        if i % 1000 == 0:
+            job_progress(job, i, len(ACCOUNT.DATA), "計算中")
+    # キャンセルされなかった場合だけ反映する（変わった商品だけを新しい辞書に差し替えて1回で書き込む）
+    with ACCOUNT.DATA_LOCK:
+        current = {d.get("id"): d for d in ACCOUNT.DATA}
+        replaced = {}
+        for item, (fee, profit, rate) in updates:
+            # 計算中に編集・削除された商品はそのまま
+            if current.get(item.get("id")) is item:
+                replaced[item["id"]] = dict(item, fee=fee, profit=profit, rate=rate)
+                audit_edit("recompute", item, replaced[item["id"]])
+        if replaced:
+            ACCOUNT.DATA = [replaced.get(d.get("id"), d) for d in ACCOUNT.DATA]
+            changed = list(replaced)
+            seq = persist(puts=list(replaced.values()), versions=record_changes(changed), wait=False)
+    if changed:
+        wait_written(seq, wait=True)
+    return {"updated": len(changed)}
+
+def run_recompute_all(job, sites=None):
+    """手数料ルールは全アカウント共通なので、データのある全アカウントを順に再計算する"""
+    updated = 0
+    for account_id in list_accounts():
+        account = acquire_account(account_id)
         try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                DATA = json.load(f)
-        except FileNotFoundError:
-            DATA = []
+            with use_account(account):
+                updated += run_recompute(job, sites)["updated"]
+        finally:
+            release_account(account)
+    return {"updated": updated}
 
-# 初期データ読み込み
-load_data()
+def load_account():
+    """現在のアカウントの商品データ・変更履歴・アーカイブ集計を読み込み、集計用の索引を作る"""
+    if ACCOUNT.id != DEFAULT_ACCOUNT and not USE_DATABASE:
+        os.makedirs(os.path.dirname(account_path(SQLITE_PATH if USE_SQLITE else DATA_FILE)), exist_ok=True)
+        if USE_SQLITE:
+            init_sqlite()
+    load_data()
+    # 商品ごとのバージョン（差分同期用）
+    # CHANGE_LOG: (バージョン, 商品ID) をバージョン順に並べたもの。since 以降を二分探索で取り出す
+    load_versions()
+    ACCOUNT.CHANGE_LOG = sorted((v["version"], item_id) for item_id, v in ACCOUNT.VERSIONS.items())
+    ACCOUNT.VERSION = ACCOUNT.CHANGE_LOG[-1][0] if ACCOUNT.CHANGE_LOG else 0
+    ACCOUNT.ARCHIVE_SUMMARY = load_archive_summary() or empty_archive_summary()
+    rebuild_indexes()
 
-SELL_FEES = {
-    "ラクマ": 0.10,
-    "ヤフーフリマ": 0.05,
-    "メルカリ": 0.10
-}
+DEFAULT_ACCOUNT_STATE.ensure_loaded()
 
 # カテゴリカラー設定
 CATEGORY_COLORS = {
@@ -423,6 +3028,41 @@ td:last-child {
     transform: scale(0.95);
 }
 
+/* 一括操作 */
+.bulk-check {
+    width: 20px;
+    height: 20px;
+    accent-color: #ff4d94;
+    margin: 0;
+}
+
+.bulk-bar {
+    display: none;
+    position: fixed;
+    bottom: 20px;
+    left: 12px;
+    right: 92px;
+    background: white;
+    border-radius: 16px;
+    box-shadow: 0 4px 20px rgba(255, 105, 180, 0.4);
+    padding: 10px 12px;
+    z-index: 998;
+    font-size: 13px;
+    align-items: center;
+    gap: 8px;
+}
+
+.bulk-bar.active {
+    display: flex;
+}
+
+.bulk-bar button {
+    flex: 1;
+    margin: 0;
+    padding: 10px 8px;
+    font-size: 13px;
+}
+
 /* フローティングボタン */
 .floating-add {
     position: fixed;
@@ -607,19 +3247,40 @@ td:last-child {
         {% if use_db %}
         <div class="db-status">
             🔗 PostgreSQL接続済み（データは永続保存されます）<br>
-            登録件数: {{ data_count }}件 | 
-            <a href="/backup" style="color: white; text-decoration: underline;">💾 バックアップ</a> | 
-            <a href="#" onclick="document.getElementById('restoreInput').click(); return false;" style="color: white; text-decoration: underline;">📥 復元</a>
+            登録件数: {{ data_count }}件{% if archive_count %}（アーカイブ {{ archive_count }}件）{% endif %} | 
+            <a href="/backup" onclick="startBackupJob(); return false;" style="color: white; text-decoration: underline;">💾 バックアップ</a> | 
+            <a href="/export" style="color: white; text-decoration: underline;">📄 CSV出力</a> | 
+            <a href="#" onclick="document.getElementById('restoreInput').click(); return false;" style="color: white; text-decoration: underline;">📥 復元</a> | 
+            <a href="#" onclick="startRecomputeJob(); return false;" style="color: white; text-decoration: underline;">🔄 再計算</a>
+            <form id="restoreForm" action="/restore" method="post" enctype="multipart/form-data" style="display: none;">
+                <input type="file" id="restoreInput" name="backup_file" accept=".json" onchange="if(confirm('バックアップファイルからデータを復元しますか？現在のデータは上書きされます。')) startRestoreJob(this.form);">
+            </form>
+        </div>
+        {% elif use_sqlite %}
+        <div class="db-status">
+            🗄️ SQLite保存 | 登録件数: {{ data_count }}件{% if archive_count %}（アーカイブ {{ archive_count }}件）{% endif %} | 
+            <a href="/backup" onclick="startBackupJob(); return false;" style="color: white; text-decoration: underline;">💾 バックアップ</a> | 
+            <a href="/export" style="color: white; text-decoration: underline;">📄 CSV出力</a> | 
+            <a href="#" onclick="document.getElementById('restoreInput').click(); return false;" style="color: white; text-decoration: underline;">📥 復元</a> | 
+            <a href="#" onclick="startRecomputeJob(); return false;" style="color: white; text-decoration: underline;">🔄 再計算</a>
             <form id="restoreForm" action="/restore" method="post" enctype="multipart/form-data" style="display: none;">
-                <input type="file" id="restoreInput" name="backup_file" accept=".json" onchange="if(confirm('バックアップファイルからデータを復元しますか？現在のデータは上書きされます。')) this.form.submit();">
+                <input type="file" id="restoreInput" name="backup_file" accept=".json" onchange="if(confirm('バックアップファイルからデータを復元しますか？現在のデータは上書きされます。')) startRestoreJob(this.form);">
             </form>
         </div>
         {% else %}
         <div class="db-status">
-            📁 ローカルファイル保存 | 登録件数: {{ data_count }}件 | 
-            <a href="/backup" style="color: white; text-decoration: underline;">💾 バックアップ</a>
+            📁 ローカルファイル保存 | 登録件数: {{ data_count }}件{% if archive_count %}（アーカイブ {{ archive_count }}件）{% endif %} | 
+            <a href="/backup" onclick="startBackupJob(); return false;" style="color: white; text-decoration: underline;">💾 バックアップ</a> | 
+            <a href="/export" style="color: white; text-decoration: underline;">📄 CSV出力</a> | 
+            <a href="#" onclick="startRecomputeJob(); return false;" style="color: white; text-decoration: underline;">🔄 再計算</a>
         </div>
         {% endif %}
+        <div class="db-status">
+            <a href="#" onclick="showImportModal(); return false;" style="color: white; text-decoration: underline;">📄 売上CSV取込</a> | 
+            <a href="#" onclick="startArchiveJob(); return false;" style="color: white; text-decoration: underline;">🗃️ アーカイブ</a> | 
+            <a href="#" onclick="startUnarchiveJob(); return false;" style="color: white; text-decoration: underline;">↩️ アーカイブ解除</a>
+        </div>
+        <div id="jobStatus" class="db-status" style="display: none;"></div>
     </div>
 
     <!-- 統計情報 -->
@@ -631,7 +3292,8 @@ td:last-child {
         <div class="stat-box expected-profit">
             <div class="stat-label">見込み利益</div>
             <div class="stat-value">¥{{ "{:,}".format(expected_profit|int) }}</div>
-            <div class="stat-sublabel">手数料7.5%・送料300円で概算</div>
+            <div class="stat-sublabel">{{ estimate_note }}</div>
+            <div class="stat-sublabel" id="forecast"></div>
         </div>
     </div>
 
@@ -653,6 +3315,28 @@ td:last-child {
     </div>
     {% endfor %}
 
+    <!-- グラフ: 期間別の推移 -->
+    <div class="card">
+        <div class="card-title">📈 利益の推移
+            <select id="rollupPeriod" onchange="loadTrend(this.value)" style="width: auto; margin: 0 0 0 auto; padding: 6px 36px 6px 12px; font-size: 13px;">
+                <option value="month">月別</option>
+                <option value="week">週別</option>
+            </select>
+        </div>
+        <div class="chart-container">
+            <canvas id="trend"></canvas>
+        </div>
+    </div>
+
+    <!-- 在庫の滞留 -->
+    <div class="card">
+        <div class="card-title">⏳ 在庫の滞留</div>
+        <div class="chart-container">
+            <canvas id="aging"></canvas>
+        </div>
+        <div id="inventorySummary" style="font-size: 12px; color: #666;"></div>
+    </div>
+
     <!-- 商品リスト -->
     <div class="card">
         <div class="card-title">📦 商品一覧（{{ data|length }}件）</div>
@@ -661,6 +3345,7 @@ td:last-child {
             <tr>
                 <td>
                     <div style="display: flex; align-items: center; gap: 8px; flex-wrap: wrap;">
+                        <input type="checkbox" class="bulk-check" value="{{ d.id }}" onchange="updateBulkBar()">
                         <span class="badge" style="background: {{ platform_colors[d.buy_platform] }}">{{ d.buy_platform }}</span>
                         <span class="badge" style="background: {{ category_colors[d.category] }}">{{ d.category }}</span>
                         {% if d.buy_date %}
@@ -696,6 +3381,60 @@ td:last-child {
     </div>
 </div>
 
+<!-- 一括操作バー -->
+<div id="bulkBar" class="bulk-bar">
+    <span id="bulkCount" style="white-space: nowrap; color: #d63384; font-weight: bold;"></span>
+    <button class="btn btn-primary" onclick="showBulkModal()">一括操作</button>
+    <button class="btn btn-cancel" onclick="clearBulkSelection()">解除</button>
+</div>
+
+<!-- 一括操作モーダル -->
+<div id="bulkModal" class="modal">
+    <div class="modal-content">
+        <div class="modal-header">
+            <div class="modal-title">☑️ まとめて変更</div>
+            <button class="close-btn" onclick="closeBulkModal()">×</button>
+        </div>
+        
+        <span class="date-guide">操作</span>
+        <select id="bulk_op" onchange="toggleBulkFields(this.value)">
+            <option value="mark_sold">売却済みにする</option>
+            <option value="update">分類・購入先を変更</option>
+            <option value="delete">削除</option>
+        </select>
+        
+        <div id="bulk_sold_fields">
+            <span class="date-guide">販売サイト</span>
+            <select id="bulk_sell_site">
+                <option>ラクマ</option><option>ヤフーフリマ</option><option>メルカリ</option>
+            </select>
+            <span class="date-guide">売却日</span>
+            <input type="date" id="bulk_sell_date">
+            <span class="date-guide">販売価格（空欄なら各商品の予定価格）</span>
+            <input type="number" id="bulk_sell_price" step="1">
+            <span class="date-guide">送料（自己負担分）</span>
+            <input type="number" id="bulk_shipping" placeholder="空欄なら変更しない">
+        </div>
+        
+        <div id="bulk_update_fields" style="display: none;">
+            <span class="date-guide">商品分類</span>
+            <select id="bulk_category">
+                <option value="">変更しない</option>
+                <option>ガチャ</option><option>ステッカー</option><option>服</option><option>文房具</option><option>雑貨</option>
+            </select>
+            <span class="date-guide">購入先</span>
+            <select id="bulk_buy_platform">
+                <option value="">変更しない</option>
+                <option>お店</option><option>SHEIN</option><option>TEMU</option><option>アリエク</option><option>百均</option>
+            </select>
+        </div>
+        
+        <div id="bulkResult" style="font-size: 12px; color: #dc3545;"></div>
+        <button type="button" class="btn btn-primary" onclick="submitBulk()">✅ 実行する</button>
+        <button type="button" class="btn btn-cancel" onclick="closeBulkModal()">キャンセル</button>
+    </div>
+</div>
+
 <!-- フローティング追加ボタン -->
 <button class="floating-add" onclick="showAddModal()">+</button>
 
@@ -730,7 +3469,7 @@ td:last-child {
             <span class="date-guide">販売価格（予定価格でも入力可）</span>
             <input type="number" name="sell_price" placeholder="800" step="1">
             <div style="font-size: 11px; color: #ff8c00; margin: -8px 0 12px 0;">
-                💡 未売却でも入力すると見込み利益が計算されます（手数料7.5%・送料300円で概算）
+                💡 未売却でも入力すると見込み利益が計算されます（{{ estimate_note }}）
             </div>
             
             <span class="date-guide">販売状況</span>
@@ -786,7 +3525,7 @@ td:last-child {
             <span class="date-guide">販売価格（予定価格でも入力可）</span>
             <input type="number" id="edit_sell_price" name="sell_price" step="1">
             <div style="font-size: 11px; color: #ff8c00; margin: -8px 0 12px 0;">
-                💡 未売却でも入力すると見込み利益が計算されます（手数料7.5%・送料300円で概算）
+                💡 未売却でも入力すると見込み利益が計算されます（{{ estimate_note }}）
             </div>
             
             <span class="date-guide">販売状況</span>
@@ -809,6 +3548,41 @@ td:last-child {
     </div>
 </div>
 
+<!-- CSV取り込みモーダル -->
+<div id="importModal" class="modal">
+    <div class="modal-content">
+        <div class="modal-header">
+            <div class="modal-title">📄 売上CSVを取り込む</div>
+            <button class="close-btn" onclick="closeImportModal()">×</button>
+        </div>
+        
+        <form id="importForm" onsubmit="submitImport(this); return false;">
+            <span class="date-guide">販売サイト</span>
+            <select name="site" required>
+                <option>メルカリ</option><option>ラクマ</option><option>ヤフーフリマ</option>
+            </select>
+            
+            <span class="date-guide">文字コード</span>
+            <select name="encoding">
+                <option value="utf-8-sig">UTF-8</option>
+                <option value="cp932">Shift_JIS</option>
+            </select>
+            
+            <span class="date-guide">新しい商品の分類（一致する商品がない場合）</span>
+            <select name="category">
+                <option>ガチャ</option><option>ステッカー</option><option>服</option><option>文房具</option><option selected>雑貨</option>
+            </select>
+            
+            <span class="date-guide">CSVファイル</span>
+            <input type="file" name="csv_file" accept=".csv,text/csv" required style="margin-bottom: 12px;">
+            
+            <div id="importResult" style="font-size: 12px; color: #666;"></div>
+            <button type="submit" class="btn btn-primary">✅ 取り込む</button>
+            <button type="button" class="btn btn-cancel" onclick="closeImportModal()">キャンセル</button>
+        </form>
+    </div>
+</div>
+
 <!-- AI提案モーダル -->
 <div id="aiModal" class="modal">
     <div class="modal-content">
@@ -894,7 +3668,7 @@ function showAISuggestion(item) {
                     <strong style="font-size: 20px; color: #6d28d9;">¥${data.suggested_price.toLocaleString()}</strong><br>
                     <div style="margin-top: 8px;">
                         予想利益: <strong style="color: ${data.expected_profit > 0 ? '#28a745' : '#dc3545'};">¥${data.expected_profit.toLocaleString()}</strong> (${data.expected_rate}%)<br>
-                        <span style="font-size: 11px; color: #888;">※手数料7.5%・送料300円で概算</span>
+                        <span style="font-size: 11px; color: #888;">※${data.estimate_note}</span>
                     </div>
                 </div>
             </div>
@@ -914,6 +3688,106 @@ function showAISuggestion(item) {
     });
 }
 
+function showImportModal() {
+    document.getElementById('importResult').innerHTML = '';
+    document.getElementById('importModal').classList.add('active');
+    document.body.style.overflow = 'hidden';
+}
+
+function closeImportModal() {
+    document.getElementById('importModal').classList.remove('active');
+    document.body.style.overflow = '';
+}
+
+function submitImport(form) {
+    const result = document.getElementById('importResult');
+    result.innerHTML = '取り込み中...';
+    fetch('/import/csv', {method: 'POST', body: new FormData(form)})
+    .then(response => response.json())
+    .then(data => {
+        if (data.error) {
+            result.innerHTML = '❌ ' + data.error;
+            return;
+        }
+        alert('✅ 新規 ' + data.inserted + '件・更新 ' + data.updated + '件・スキップ ' + data.skipped + '件');
+        location.reload();
+    })
+    .catch(error => {
+        result.innerHTML = 'エラーが発生しました';
+    });
+}
+
+// 一括操作
+function selectedIds() {
+    return Array.from(document.querySelectorAll('.bulk-check:checked')).map(c => c.value);
+}
+
+function updateBulkBar() {
+    const count = selectedIds().length;
+    document.getElementById('bulkCount').textContent = count + '件選択中';
+    document.getElementById('bulkBar').classList.toggle('active', count > 0);
+}
+
+function clearBulkSelection() {
+    document.querySelectorAll('.bulk-check:checked').forEach(c => c.checked = false);
+    updateBulkBar();
+}
+
+function toggleBulkFields(op) {
+    document.getElementById('bulk_sold_fields').style.display = op === 'mark_sold' ? 'block' : 'none';
+    document.getElementById('bulk_update_fields').style.display = op === 'update' ? 'block' : 'none';
+}
+
+function showBulkModal() {
+    document.getElementById('bulk_sell_date').value = '{{ today }}';
+    document.getElementById('bulkResult').innerHTML = '';
+    document.getElementById('bulkModal').classList.add('active');
+    document.body.style.overflow = 'hidden';
+}
+
+function closeBulkModal() {
+    document.getElementById('bulkModal').classList.remove('active');
+    document.body.style.overflow = '';
+}
+
+function submitBulk() {
+    const op = document.getElementById('bulk_op').value;
+    const ids = selectedIds();
+    if (op === 'delete' && !confirm(ids.length + '件を本当に削除しますか？')) {
+        return;
+    }
+    const operations = ids.map(id => {
+        const operation = {op: op, id: id};
+        if (op === 'mark_sold') {
+            operation.sell_site = document.getElementById('bulk_sell_site').value;
+            operation.sell_date = document.getElementById('bulk_sell_date').value;
+            const price = document.getElementById('bulk_sell_price').value;
+            const shipping = document.getElementById('bulk_shipping').value;
+            if (price) operation.sell_price = Number(price);
+            if (shipping) operation.shipping = Number(shipping);
+        } else if (op === 'update') {
+            const category = document.getElementById('bulk_category').value;
+            const platform = document.getElementById('bulk_buy_platform').value;
+            if (category) operation.category = category;
+            if (platform) operation.buy_platform = platform;
+        }
+        return operation;
+    });
+    fetch('/bulk', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({operations: operations})
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.error) {
+            document.getElementById('bulkResult').innerHTML = '❌ ' + data.error + (data.details ? '<br>' + data.details.join('<br>') : '');
+        } else {
+            location.reload();
+        }
+    });
+}
+
 function closeAIModal() {
     document.getElementById('aiModal').classList.remove('active');
     document.body.style.overflow = '';
@@ -935,6 +3809,68 @@ document.querySelectorAll('.modal').forEach(modal => {
     });
 });
 
+// バックグラウンドジョブの進捗表示
+function pollJob(job, onDone) {
+    const box = document.getElementById('jobStatus');
+    box.style.display = 'inline-block';
+    const labels = {restore: '復元', backup: 'バックアップ', recompute: '再計算', archive: 'アーカイブ', unarchive: 'アーカイブ解除'};
+    const tick = () => fetch('/jobs/' + job.id).then(r => r.json()).then(j => {
+        if (j.status === 'queued' || j.status === 'running') {
+            box.innerHTML = '⏳ ' + labels[j.kind] + '中... ' + Math.round(j.progress * 100) + '% ' +
+                '<a href="#" onclick="fetch(\'/jobs/' + j.id + '/cancel\', {method: \'POST\'}); return false;" style="color: white; text-decoration: underline;">中止</a>';
+            setTimeout(tick, 1000);
+        } else if (j.status === 'done') {
+            box.innerHTML = '✅ ' + labels[j.kind] + 'が完了しました';
+            onDone(j);
+        } else if (j.status === 'cancelled') {
+            box.innerHTML = '🚫 ' + labels[j.kind] + 'を中止しました';
+        } else {
+            box.innerHTML = '❌ ' + labels[j.kind] + 'エラー: ' + j.error;
+        }
+    });
+    tick();
+}
+
+function startJob(url, options, onDone) {
+    fetch(url, options).then(r => r.json()).then(job => {
+        if (job.error) {
+            alert(job.error);
+        } else {
+            pollJob(job, onDone);
+        }
+    });
+}
+
+function startRestoreJob(form) {
+    startJob('/restore?async=1', {method: 'POST', body: new FormData(form)}, () => location.href = '/?restored=true');
+}
+
+function startBackupJob() {
+    startJob('/backup?async=1', {}, j => location.href = '/jobs/' + j.id + '/download');
+}
+
+function startRecomputeJob() {
+    if (confirm('全商品の手数料・利益を現在の手数料率で再計算しますか？')) {
+        startJob('/recompute', {method: 'POST'}, () => location.reload());
+    }
+}
+
+function startArchiveJob() {
+    const d = new Date();
+    d.setDate(d.getDate() - {{ archive_after_days }});
+    const before = prompt('この日より前に売却した商品をアーカイブします（一覧から外れますが、集計には含まれます）', d.toISOString().slice(0, 10));
+    if (before) {
+        startJob('/archive?before=' + encodeURIComponent(before), {method: 'POST'}, () => location.reload());
+    }
+}
+
+function startUnarchiveJob() {
+    const since = prompt('この日以降に売却した商品をアーカイブから戻します（YYYY-MM-DD）');
+    if (since) {
+        startJob('/unarchive?since=' + encodeURIComponent(since), {method: 'POST'}, () => location.reload());
+    }
+}
+
 // 復元成功時の通知
 if (window.location.search.includes('restored=true')) {
     alert('✅ バックアップからデータを復元しました！');
@@ -977,6 +3913,75 @@ new Chart(document.getElementById("bar"), {
     }
 });
 
+// 期間別の推移（/rollups から取得）
+let trendChart = null;
+function loadTrend(period) {
+    fetch('/rollups?period=' + period).then(r => r.json()).then(data => {
+        const buckets = data.buckets.slice(period === 'week' ? -26 : -24);
+        if (trendChart) {
+            trendChart.destroy();
+        }
+        trendChart = new Chart(document.getElementById("trend"), {
+            type: "bar",
+            data: {
+                labels: buckets.map(b => b.bucket),
+                datasets: [
+                    {label: "売上", data: buckets.map(b => b.revenue), backgroundColor: "#ffb3d9", borderRadius: 6},
+                    {label: "利益", data: buckets.map(b => b.profit), backgroundColor: "#ff4d94", borderRadius: 6},
+                    {label: "仕入れ", data: buckets.map(b => b.spend), type: "line", borderColor: "#a55eea", backgroundColor: "#a55eea", tension: 0.3}
+                ]
+            },
+            options: {
+                responsive: true,
+                maintainAspectRatio: false,
+                scales: {
+                    y: { ticks: { callback: v => '¥' + v.toLocaleString(), font: { size: 11 } } },
+                    x: { ticks: { font: { size: 10 } } }
+                },
+                plugins: {
+                    legend: { display: true, position: 'bottom', labels: { font: { size: 10 }, boxWidth: 12 } }
+                }
+            }
+        });
+    });
+}
+loadTrend('month');
+
+// 売れる確率を考えた30/60/90日の見込み利益
+fetch('/forecast').then(r => r.json()).then(data => {
+    document.getElementById('forecast').innerHTML = data.horizons.map(h =>
+        h.days + '日以内: ¥' + h.expected_profit.toLocaleString() +
+        '（90%区間 ¥' + h.p05.toLocaleString() + '〜¥' + h.p95.toLocaleString() + '）'
+    ).join('<br>');
+});
+
+// 在庫の滞留（/inventory から取得）
+fetch('/inventory').then(r => r.json()).then(data => {
+    const categories = Object.keys(data.by_category);
+    new Chart(document.getElementById("aging"), {
+        type: "bar",
+        data: {
+            labels: data.age_buckets,
+            datasets: categories.map(c => ({
+                label: c,
+                data: data.by_category[c].aging,
+                backgroundColor: {{ category_colors|tojson }}[c] || "#ccc",
+                borderRadius: 4
+            }))
+        },
+        options: {
+            responsive: true,
+            maintainAspectRatio: false,
+            scales: { x: { stacked: true, ticks: { font: { size: 10 } } }, y: { stacked: true, beginAtZero: true } },
+            plugins: { legend: { display: true, position: 'bottom', labels: { font: { size: 9 }, boxWidth: 12 } } }
+        }
+    });
+    document.getElementById('inventorySummary').innerHTML = categories.map(c => {
+        const r = data.by_category[c];
+        return c + ': 売却率 ' + r.sell_through + '%' + (r.median_days_to_sell !== null ? '・売れるまで約' + Math.round(r.median_days_to_sell) + '日' : '');
+    }).join('<br>');
+});
+
 {% for site, pdata in sell_pies.items() %}
 new Chart(document.getElementById("sell_{{ loop.index }}"), {
     type: "doughnut",
@@ -1010,61 +4015,83 @@ new Chart(document.getElementById("sell_{{ loop.index }}"), {
 """
 
 @app.route("/", methods=["GET"])
+@profiled
 def index():
+    with stage("aggregate"):
+        page = summarize()
+    with stage("render"):
+        return render_template_string(HTML, 
+                                     data=ACCOUNT.DATA, 
+                                     platform_colors=PLATFORM_COLORS, 
+                                     category_colors=CATEGORY_COLORS,
+                                     use_db=USE_DATABASE,
+                                     use_sqlite=USE_SQLITE,
+                                     estimate_note=estimate_note(),
+                                     data_count=len(ACCOUNT.DATA),
+                                     archive_count=ACCOUNT.ARCHIVE_SUMMARY["count"],
+                                     archive_after_days=ARCHIVE_AFTER_DAYS,
+                                     today=datetime.now().strftime("%Y-%m-%d"),
+                                     **page)
+
+def summarize():
+    """ダッシュボード用の集計"""
     # 売却済みの商品のみ計算対象とする
-    sold_items = [d for d in DATA if d.get("sell_site")]
-    unsold_items = [d for d in DATA if not d.get("sell_site")]
+    sold_items = [d for d in ACCOUNT.DATA if d.get("sell_site")]
+    unsold_items = [d for d in ACCOUNT.DATA if not d.get("sell_site")]
     
-    total_profit = sum(d.get("profit", 0) for d in sold_items)
+    archive = ACCOUNT.ARCHIVE_SUMMARY
+    total_profit = sum(d.get("profit", 0) for d in sold_items) + archive["profit"]
     
-    # 見込み利益の計算（手数料7.5%、送料300円で計算）
+    # 見込み利益の計算（見込み手数料・見込み送料で計算）
     expected_profit = 0
     for item in unsold_items:
         sell_price = item.get("sell_price", 0)
         if sell_price > 0:  # 販売価格が入力されている場合のみ計算
-            estimated_fee = sell_price * 0.075  # 手数料7.5%
-            estimated_shipping = 300  # 暫定送料300円
-            expected_profit += sell_price - item.get("buy_price", 0) - estimated_fee - estimated_shipping
+            expected_profit += estimate_profit(sell_price, item.get("buy_price", 0), item.get("category"))
     
-    platforms = list(set(d.get("buy_platform") for d in DATA if d.get("buy_platform")))
+    platforms = list(set(d.get("buy_platform") for d in ACCOUNT.DATA if d.get("buy_platform")) | set(archive["platform_rates"]))
     
     rates = []
     for p in platforms:
         p_sold = [x for x in sold_items if x.get("buy_platform") == p]
-        rates.append(round(sum(x.get("rate", 0) for x in p_sold)/len(p_sold), 1) if p_sold else 0)
+        rate_sum, count = archive["platform_rates"].get(p, (0, 0))
+        rate_sum += sum(x.get("rate", 0) for x in p_sold)
+        count += len(p_sold)
+        rates.append(round(rate_sum / count, 1) if count else 0)
 
     sell_pies = {}
     for d in sold_items:
-        sell_pies.setdefault(d.get("sell_site"), {}).setdefault(d.get("category"), []).append(1)
-
-    formatted_pies = {s: {"labels": list(cats.keys()), "ratios": [len(v) for v in cats.values()]} for s, cats in sell_pies.items()}
-
-    return render_template_string(HTML, 
-                                 data=DATA, 
-                                 platforms=platforms, 
-                                 rates=rates, 
-                                 sell_pies=formatted_pies, 
-                                 total_profit=total_profit,
-                                 expected_profit=expected_profit,
-                                 platform_colors=PLATFORM_COLORS, 
-                                 category_colors=CATEGORY_COLORS,
-                                 use_db=USE_DATABASE,
-                                 data_count=len(DATA),
-                                 today=datetime.now().strftime("%Y-%m-%d"))
+        cats = sell_pies.setdefault(d.get("sell_site"), {})
+        cats[d.get("category")] = cats.get(d.get("category"), 0) + 1
+    for site, pie in archive["pies"].items():
+        cats = sell_pies.setdefault(site, {})
+        for category, count in pie.items():
+            cats[category] = cats.get(category, 0) + count
+
+    formatted_pies = {s: {"labels": list(cats.keys()), "ratios": list(cats.values())} for s, cats in sell_pies.items()}
+
+    return {
+        "platforms": platforms,
+        "rates": rates,
+        "sell_pies": formatted_pies,
+        "total_profit": total_profit,
+        "expected_profit": expected_profit,
+    }
 
 @app.route("/backup")
 def backup():
-    """データベースのバックアップをJSON形式でダウンロード"""
-    from flask import Response
-    import json
-    from datetime import datetime
+    """データベースのバックアップをJSON形式でダウンロード（?async=1 ならジョブとして実行）"""
+    if request.args.get("async"):
+        return jsonify(job_public(submit_job("backup", run_backup))), 202
     
     backup_data = {
         "backup_date": datetime.now().isoformat(),
-        "items": DATA
+        "items": ACCOUNT.DATA,
+        "archived_items": load_archive()
     }
     
-    json_str = json.dumps(backup_data, ensure_ascii=False, indent=2)
+    with stage("render"):
+        json_str = json.dumps(backup_data, ensure_ascii=False, indent=2)
     
     return Response(
         json_str,
@@ -1072,10 +4099,115 @@ def backup():
         headers={'Content-Disposition': f'attachment;filename=furima_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'}
     )
 
+# エクスポート（表計算ソフト・分析用。全件を文字列にまとめず、少しずつ書き出して返す）
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '1000'))
+EXPORT_FORMATS = ("csv", "ndjson")
+
+def export_filters(args):
+    """エクスポートの絞り込み条件（不正なら ValueError）
+    category / platform / site は複数指定可、status=sold|unsold、from・to は date（buy_date か sell_date）の範囲、q は商品名に含む文字列"""
+    filters = {
+        "categories": args.getlist("category"),
+        "platforms": args.getlist("platform"),
+        "sites": args.getlist("site"),
+        "status": args.get("status", "all"),
+        "date": args.get("date", "buy_date"),
+        "from": args.get("from", ""),
+        "to": args.get("to", ""),
+        "q": args.get("q", ""),
+    }
+    if filters["status"] not in ("all", "sold", "unsold"):
+        raise ValueError("status は all・sold・unsold のどれかを指定してください")
+    if filters["date"] not in ("buy_date", "sell_date"):
+        raise ValueError("date は buy_date か sell_date を指定してください")
+    return filters
+
+def item_matches(item, filters):
+    """商品が絞り込み条件に合うか（iter_items() の条件と同じ）"""
+    if filters["categories"] and item.get("category") not in filters["categories"]:
+        return False
+    if filters["platforms"] and item.get("buy_platform") not in filters["platforms"]:
+        return False
+    if filters["sites"] and item.get("sell_site") not in filters["sites"]:
+        return False
+    if filters["status"] != "all" and bool(item.get("sell_site")) != (filters["status"] == "sold"):
+        return False
+    date = item.get(filters["date"])
+    if filters["from"] and not (date and date >= filters["from"]):
+        return False
+    if filters["to"] and not (date and date <= filters["to"]):
+        return False
+    return filters["q"] in (item.get("name") or "")
+
+def export_items(filters):
+    """条件に合う商品を順に返す（PostgreSQLはサーバー側カーソル、それ以外はメモリ上の DATA から）"""
+    if USE_DATABASE:
+        return iter_items(filters)
+    # 書き込みで DATA が差し替えられても、書き出し中は読み始めたときのリストをたどる
+    items = ACCOUNT.DATA
+    return (item for item in items if item_matches(item, filters))
+
+def export_chunks(items, columns, fmt):
+    """商品を CSV / NDJSON の文字列にして EXPORT_CHUNK_ROWS 件ごとに返す"""
+    buffer = io.StringIO()
+    if fmt == "csv":
+        # Excel で文字化けしないよう BOM を付ける
+        buffer.write("\ufeff")
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = lambda item: writer.writerow([item.get(c) for c in columns])
+    else:
+        write = lambda item: buffer.write(json.dumps({c: item.get(c) for c in columns}, ensure_ascii=False) + "\n")
+    
+    def drain():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+    
+    # 見出しはすぐに返す（件数が多くてもダウンロードがすぐ始まる）
+    yield drain()
+    rows = 0
+    for rows, item in enumerate(items, 1):
+        write(item)
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield drain()
+    yield drain()
+    increment("furima_export_rows_total", rows, format=fmt)
+
+@app.route("/export")
+def export():
+    """商品をCSV（?format=ndjson でNDJSON）で少しずつ書き出す
+    columns=name,buy_price,... で列を選び、絞り込みは export_filters() の条件"""
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format は csv か ndjson を指定してください"}), 400
+    columns = [c for c in request.args.get("columns", "").split(",") if c] or list(ITEM_COLUMNS)
+    unknown = [c for c in columns if c not in ITEM_COLUMNS]
+    if unknown:
+        return jsonify({"error": f"不明な列です: {', '.join(unknown)}"}), 400
+    try:
+        filters = export_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if USE_DATABASE:
+        # 書き込みキューに残っている変更も含めて読む
+        flush_pending()
+    account = current_account()
+    
+    def generate():
+        with use_account(account):
+            yield from export_chunks(export_items(filters), columns, fmt)
+    
+    increment("furima_exports_total", format=fmt)
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    filename = f'furima_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{fmt}'
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment;filename={filename}'})
+
 @app.route("/restore", methods=["POST"])
 def restore():
     """バックアップファイルからデータを復元"""
-    global DATA
     try:
         if 'backup_file' not in request.files:
             return jsonify({"error": "ファイルが選択されていません"}), 400
@@ -1084,13 +4216,31 @@ def restore():
         if file.filename == '':
             return jsonify({"error": "ファイルが選択されていません"}), 400
         
+        if request.args.get("async"):
+            # ファイルの中身だけ受け取って、復元はジョブで行う
+            mark_write()
+            return jsonify(job_public(submit_job("restore", run_restore, file.read()))), 202
+        
         # JSONファイルを読み込み
         backup_data = json.load(file)
         
         # データを復元
         if 'items' in backup_data:
-            DATA = backup_data['items']
-            save_data()
+            with ACCOUNT.WRITE_LOCK, ACCOUNT.DATA_LOCK:
+                old_data = ACCOUNT.DATA
+                old_ids = {d.get("id") for d in old_data}
+                ACCOUNT.DATA = backup_data['items']
+                try:
+                    full_save()
+                except Exception:
+                    ACCOUNT.DATA = old_data
+                    raise
+                restore_archive(backup_data.get('archived_items', []))
+                rebuild_indexes()
+                new_ids = {d.get("id") for d in ACCOUNT.DATA}
+                seq = persist(versions=record_changes(old_ids - new_ids, deleted=True) + record_changes(new_ids), wait=False)
+                audit_restore(old_ids, new_ids, len(backup_data.get('archived_items', [])))
+            wait_written(seq)
             return redirect("/?restored=true")
         else:
             return jsonify({"error": "無効なバックアップファイル形式です"}), 400
@@ -1098,6 +4248,262 @@ def restore():
     except Exception as e:
         return jsonify({"error": f"復元エラー: {str(e)}"}), 500
 
+# CSV取り込み（各フリマサイトの売上CSV）
+# 項目ごとに列名の候補を持ち、CSVに最初に見つかった列を使う。サイト別の候補が優先
+CSV_COLUMNS = {
+    "id": ["id", "管理ID"],
+    "name": ["商品名", "タイトル", "name"],
+    "sell_price": ["販売価格", "価格", "落札価格", "sell_price"],
+    "sell_date": ["売却日", "取引完了日", "購入日時", "落札日", "sell_date"],
+    "shipping": ["送料", "配送料", "送料（出品者負担）", "shipping"],
+    "buy_date": ["仕入日", "buy_date"],
+    "buy_price": ["仕入れ価格", "仕入価格", "buy_price"],
+    "category": ["商品分類", "category"],
+    "buy_platform": ["購入先", "buy_platform"],
+}
+CSV_SITE_COLUMNS = {
+    "メルカリ": {"sell_date": ["取引完了日", "購入日時"], "shipping": ["配送料"]},
+    "ラクマ": {"sell_date": ["取引日", "購入日"], "sell_price": ["商品価格", "販売価格"]},
+    "ヤフーフリマ": {"sell_date": ["取引完了日時", "落札日"], "sell_price": ["落札価格", "販売価格"]},
+}
+
+def csv_mapping(site, headers, overrides=None):
+    """CSVの列名 → 項目名の対応を決める"""
+    site_columns = dict(CSV_SITE_COLUMNS.get(site, {}), **(load_setting("csv_mappings") or {}).get(site, {}))
+    mapping = {}
+    for field, candidates in CSV_COLUMNS.items():
+        if overrides and field in overrides:
+            candidates = [overrides[field]]
+        else:
+            candidates = site_columns.get(field, []) + candidates
+        column = next((c for c in candidates if c in headers), None)
+        if column:
+            mapping[field] = column
+    return mapping
+
+def parse_yen(value):
+    """「¥1,200」「1200円」などを数値に"""
+    digits = re.sub(r"[^0-9.\-]", "", value or "")
+    return float(digits) if digits not in ("", "-", ".") else 0.0
+
+def parse_csv_date(value):
+    """「2024/05/01 12:34」「2024年5月1日」などを YYYY-MM-DD に"""
+    m = re.match(r"\s*(\d{4})[/\-年](\d{1,2})[/\-月](\d{1,2})", value or "")
+    return f"{int(m.group(1)):04d}-{int(m.group(2)):02d}-{int(m.group(3)):02d}" if m else ""
+
+def import_sales_csv(stream, site, defaults, overrides=None):
+    """売上CSVを1行ずつ読み、既存商品（ID → 商品名+売却日 → 商品名+購入日 → 同名の未売却商品）に
+    売却情報を反映、見つからなければ新規登録する。全行を読み終えてからまとめて反映・保存する
+    （途中で読み込みエラーになったら何も変更しない）"""
+    reader = csv.DictReader(stream)
+    mapping = csv_mapping(site, reader.fieldnames or [], overrides)
+    if "name" not in mapping or "sell_price" not in mapping:
+        raise ValueError(f"商品名と販売価格の列が見つかりません（列: {', '.join(reader.fieldnames or [])}）")
+    
+    # 取り込み中は他の書き込みを待たせる（既存商品の照合に使う索引が古くならないように）
+    with ACCOUNT.DATA_LOCK:
+        # 照合用の索引は商品IDを持ち、商品そのものは items（ID → 最新の辞書）から引く
+        items = {d.get("id"): d for d in ACCOUNT.DATA}
+        by_name_sold = {(d.get("name"), d.get("sell_date")): d.get("id") for d in ACCOUNT.DATA if d.get("sell_site")}
+        by_name_bought = {}
+        unsold_by_name = {}
+        for d in sorted((d for d in ACCOUNT.DATA if not d.get("sell_site")), key=lambda d: d.get("buy_date") or ""):
+            by_name_bought.setdefault((d.get("name"), d.get("buy_date")), d.get("id"))
+            unsold_by_name.setdefault(d.get("name"), []).append(d.get("id"))
+        
+        def take_unsold(item_id):
+            """売却済みにする商品を未売却の索引から外す（同名の別の行で二重に売れないように）"""
+            item = items[item_id]
+            key = (item.get("name"), item.get("buy_date"))
+            if by_name_bought.get(key) == item_id:
+                del by_name_bought[key]
+            if item_id in unsold_by_name.get(item.get("name"), ()):
+                unsold_by_name[item.get("name")].remove(item_id)
+        
+        result = {"inserted": 0, "updated": 0, "skipped": 0, "errors": [], "columns": mapping}
+        changes = []  # (変更前の辞書 or None, 変更後の辞書)。ACCOUNT.DATA にはまだ反映しない
+        
+        for line_no, row in enumerate(reader, start=2):
+            value = lambda field: (row.get(mapping[field]) or "").strip() if field in mapping else ""
+            name = value("name")
+            sell = parse_yen(value("sell_price"))
+            if not name or sell <= 0:
+                result["skipped"] += 1
+                if len(result["errors"]) < 20:
+                    result["errors"].append(f"{line_no}行目: 商品名または販売価格がありません")
+                continue
+            sell_date = parse_csv_date(value("sell_date")) or datetime.now().strftime("%Y-%m-%d")
+            buy_date = parse_csv_date(value("buy_date"))
+            
+            # ID・商品名+売却日は売却済みの商品にも当たる（同じCSVの取り込み直し）。それ以外は未売却の商品だけ
+            item_id = value("id") if value("id") in items else None
+            if item_id is None:
+                item_id = by_name_sold.get((name, sell_date))
+            if item_id is None and buy_date:
+                item_id = by_name_bought.get((name, buy_date))
+            if item_id is None and unsold_by_name.get(name):
+                item_id = unsold_by_name[name][0]
+            
+            if item_id is None:
+                before = None
+                item = {
+                    "id": str(uuid.uuid4()),
+                    "buy_platform": value("buy_platform") or defaults["buy_platform"],
+                    "category": value("category") or defaults["category"],
+                    "name": name,
+                    "buy_date": buy_date or sell_date,
+                    "sell_date": "",
+                    "buy_price": parse_yen(value("buy_price")),
+                    "sell_price": 0.0,
+                    "shipping": 0.0,
+                    "fee": 0,
+                    "profit": 0,
+                    "rate": 0,
+                    "sell_site": "",
+                }
+                result["inserted"] += 1
+            else:
+                take_unsold(item_id)
+                before = items[item_id]
+                item = dict(before)
+                if "buy_price" in mapping:
+                    item["buy_price"] = parse_yen(value("buy_price"))
+                result["updated"] += 1
+            
+            # 商品の辞書は書き換えず、新しい辞書を作って差し替える（読み手に途中の状態を見せない）
+            item["sell_site"] = site
+            item["sell_date"] = sell_date
+            item["sell_price"] = sell
+            item["shipping"] = parse_yen(value("shipping")) if "shipping" in mapping else item.get("shipping") or 0
+            item["fee"], item["profit"], item["rate"] = calculate_profit(
+                item.get("buy_price") or 0, sell, item["shipping"], site, sell_date)
+            items[item["id"]] = item
+            by_name_sold[(name, sell_date)] = item["id"]
+            changes.append((before, item))
+        
+        # 全行を読めたので、まとめて反映する
+        position = {d.get("id"): i for i, d in enumerate(ACCOUNT.DATA)}
+        puts = {}
+        for before, item in changes:
+            if item["id"] in position:
+                ACCOUNT.DATA[position[item["id"]]] = item
+                audit_edit("import", before, item)
+            else:
+                position[item["id"]] = len(ACCOUNT.DATA)
+                ACCOUNT.DATA.append(item)
+                audit("import", item["id"], None, dict(item))
+            puts[item["id"]] = item
+        seq = persist(puts=list(puts.values()), versions=record_changes(list(puts)), wait=False) if puts else None
+    if seq is not None:
+        wait_written(seq, wait=True)
+    return result
+
+@app.route("/import/csv", methods=["POST"])
+def import_csv():
+    """売上CSVの取り込み（site: 販売サイト、encoding: 文字コード、mapping: 列名の指定（JSON））"""
+    site = request.form.get("site") or request.args.get("site")
+    if site not in SELL_FEES and site not in FEE_RULE_INDEX:
+        return jsonify({"error": "販売サイトを指定してください"}), 400
+    file = request.files.get("csv_file")
+    if file is None or file.filename == '':
+        return jsonify({"error": "ファイルが選択されていません"}), 400
+    try:
+        overrides = json.loads(request.form.get("mapping") or "{}")
+        if not isinstance(overrides, dict) or not all(isinstance(v, str) for v in overrides.values()):
+            return jsonify({"error": "mapping は項目名 → 列名の JSON オブジェクトで指定してください"}), 400
+        encoding = request.form.get("encoding") or "utf-8-sig"
+        # アップロードを丸ごと読み込まずに1行ずつデコードしながら処理する
+        stream = io.TextIOWrapper(file.stream, encoding=encoding, newline="")
+        defaults = {
+            "category": request.form.get("category") or "雑貨",
+            "buy_platform": request.form.get("buy_platform") or "お店",
+        }
+        return jsonify(import_sales_csv(stream, site, defaults, overrides))
+    except (ValueError, UnicodeDecodeError, LookupError, csv.Error) as e:
+        return jsonify({"error": f"取り込みエラー: {str(e)}"}), 400
+
+BULK_OPS = ("mark_sold", "update", "delete")
+
+def apply_bulk(operations):
+    """複数の操作を検証してからまとめて適用（1件でも不正なら何も変更しない）"""
+    with ACCOUNT.DATA_LOCK:
+        by_id = {d.get("id"): d for d in ACCOUNT.DATA}
+        errors = []
+        planned = {}  # 商品ID → 変更後の商品（削除は None）
+        for i, op in enumerate(operations):
+            kind = op.get("op") if isinstance(op, dict) else None
+            item_id = op.get("id") if kind else None
+            if kind not in BULK_OPS:
+                errors.append(f"{i + 1}件目: 不明な操作です")
+                continue
+            # id は文字列だけ（リストなどは辞書を引けない）
+            if not isinstance(item_id, str) or item_id not in by_id or (item_id in planned and planned[item_id] is None):
+                errors.append(f"{i + 1}件目: 商品が見つかりません（{item_id}）")
+                continue
+            if kind == "delete":
+                planned[item_id] = None
+                continue
+            item = dict(planned.get(item_id) or by_id[item_id])
+            try:
+                if kind == "mark_sold":
+                    site = op.get("sell_site")
+                    if not site or not isinstance(site, str):
+                        raise ValueError("販売サイトがありません")
+                    sell = float(op.get("sell_price") or item.get("sell_price") or 0)
+                    if sell <= 0:
+                        raise ValueError("販売価格がありません")
+                    item["sell_site"] = site
+                    item["sell_price"] = sell
+                    if op.get("sell_date") is not None and not isinstance(op["sell_date"], str):
+                        raise ValueError("売却日の形式が正しくありません")
+                    item["sell_date"] = op.get("sell_date") or datetime.now().strftime("%Y-%m-%d")
+                    if op.get("shipping") is not None:
+                        item["shipping"] = float(op["shipping"])
+                else:
+                    for field in ("category", "buy_platform"):
+                        if op.get(field):
+                            if not isinstance(op[field], str):
+                                raise ValueError(f"{field} は文字列で指定してください")
+                            item[field] = op[field]
+            except (TypeError, ValueError) as e:
+                errors.append(f"{i + 1}件目: {e}")
+                continue
+            item["fee"], item["profit"], item["rate"] = calculate_profit(
+                item.get("buy_price") or 0, item.get("sell_price") or 0, item.get("shipping") or 0,
+                item.get("sell_site"), item.get("sell_date"))
+            planned[item_id] = item
+        if errors:
+            raise ValueError(errors)
+        
+        deleted = [item_id for item_id, item in planned.items() if item is None]
+        updated = [item for item in planned.values() if item is not None]
+        for item_id, item in planned.items():
+            if item is None:
+                audit("bulk", item_id, dict(by_id[item_id]), None)
+            else:
+                audit_edit("bulk", by_id[item_id], item)
+        # 変更した商品は新しい辞書に差し替える（削除は None なので除く）
+        if planned:
+            ACCOUNT.DATA = [planned.get(d.get("id"), d) for d in ACCOUNT.DATA if planned.get(d.get("id"), d) is not None]
+        # 全ての変更を1回の書き込みにまとめる
+        seq = persist(puts=updated, deletes=deleted,
+                      versions=record_changes([item["id"] for item in updated]) + record_changes(deleted, deleted=True),
+                      wait=False)
+    wait_written(seq)
+    return {"updated": len(updated), "deleted": len(deleted)}
+
+@app.route("/bulk", methods=["POST"])
+def bulk():
+    """まとめて変更（operations: [{"op": "mark_sold" | "update" | "delete", "id": ..., ...}]）"""
+    body = request.get_json(silent=True)
+    operations = body.get("operations") if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations を指定してください"}), 400
+    try:
+        return jsonify(apply_bulk(operations))
+    except ValueError as e:
+        return jsonify({"error": "変更できない操作があるため、何も変更していません", "details": e.args[0]}), 400
+
 @app.route("/add", methods=["POST"])
 def add():
     buy = float(request.form.get("buy_price") or 0)
@@ -1106,16 +4512,9 @@ def add():
     site = request.form.get("sell_site")
     
     # 利益計算
-    if site and sell > 0:
-        # 売却済みの場合：実際の手数料と送料で計算
-        fee = round(sell * SELL_FEES.get(site, 0), 0)
-        profit = round(sell - buy - ship - fee, 0)
-        rate = round((profit / buy * 100), 1) if buy > 0 else 0
-    else:
-        # 未売却の場合：利益は0（見込み利益は別途計算）
-        fee, profit, rate = 0, 0, 0
+    fee, profit, rate = calculate_profit(buy, sell, ship, site, request.form.get("sell_date"))
 
-    DATA.append({
+    item = {
         "id": str(uuid.uuid4()),
         "buy_platform": request.form.get("buy_platform"),
         "category": request.form.get("category"),
@@ -1129,15 +4528,24 @@ def add():
         "profit": profit,
         "rate": rate,
         "sell_site": site
-    })
-    save_data()
+    }
+    with ACCOUNT.DATA_LOCK:
+        ACCOUNT.DATA.append(item)
+        seq = persist(puts=[item], versions=record_changes([item["id"]]), wait=False)
+        audit("add", item["id"], None, dict(item))
+    wait_written(seq)
     return redirect("/")
 
 @app.route("/edit", methods=["POST"])
 def edit():
     item_id = request.form.get("id")
-    for item in DATA:
-        if item.get("id") == item_id:
+    seq = None
+    with ACCOUNT.DATA_LOCK:
+        for i, old in enumerate(ACCOUNT.DATA):
+            if old.get("id") != item_id:
+                continue
+            # 読み取り中のリクエストが書き換え途中の商品を見ないように、新しい辞書に差し替える
+            item = dict(old)
             item["name"] = request.form.get("name")
             item["buy_date"] = request.form.get("buy_date")
             item["buy_price"] = float(request.form.get("buy_price") or 0)
@@ -1149,62 +4557,105 @@ def edit():
             item["sell_date"] = request.form.get("sell_date") if item["sell_site"] else ""
             
             # 再計算
-            if item.get("sell_site") and item.get("sell_price") > 0:
-                # 売却済みの場合：実際の手数料と送料で計算
-                item["fee"] = round(item["sell_price"] * SELL_FEES.get(item["sell_site"], 0), 0)
-                item["profit"] = round(item["sell_price"] - item["buy_price"] - item.get("shipping", 0) - item["fee"], 0)
-                item["rate"] = round((item["profit"] / item["buy_price"] * 100), 1) if item["buy_price"] > 0 else 0
-            else:
-                # 未売却の場合：利益は0
-                item["fee"], item["profit"], item["rate"] = 0, 0, 0
+            item["fee"], item["profit"], item["rate"] = calculate_profit(
+                item["buy_price"], item["sell_price"], item["shipping"], item["sell_site"], item["sell_date"])
+            ACCOUNT.DATA[i] = item
+            seq = persist(puts=[item], versions=record_changes([item_id]), wait=False)
+            audit_edit("edit", old, item)
             break
-    save_data()
+    if seq is not None:
+        wait_written(seq)
     return redirect("/")
 
 @app.route("/delete/<id>")
 def delete(id):
-    global DATA
-    DATA = [d for d in DATA if d.get("id") != id]
-    save_data()
+    seq = None
+    with ACCOUNT.DATA_LOCK:
+        removed = next((d for d in ACCOUNT.DATA if d.get("id") == id), None)
+        if removed is not None:
+            ACCOUNT.DATA = [d for d in ACCOUNT.DATA if d.get("id") != id]
+            seq = persist(deletes=[id], versions=record_changes([id], deleted=True), wait=False)
+            audit("delete", id, dict(removed), None)
+    if seq is not None:
+        wait_written(seq)
     return redirect("/")
 
+@app.route("/changes")
+def changes():
+    """差分同期用：指定バージョン以降に変更された商品と削除されたIDを返す"""
+    account = current_account()
+    since = request.args.get("since", 0, type=int)
+    if since <= 0 or since > account.VERSION:
+        # 初回同期（または不明なバージョン）は全件を返す
+        return jsonify({"version": account.VERSION, "full": True, "items": account.DATA, "deleted": []})
+    
+    start = bisect.bisect_right(account.CHANGE_LOG, (since, chr(0x10ffff)))
+    changed = {item_id for v, item_id in account.CHANGE_LOG[start:] if account.VERSIONS[item_id]["version"] == v}
+    deleted = [item_id for item_id in changed if account.VERSIONS[item_id]["deleted"]]
+    items = [d for d in account.DATA if d.get("id") in changed]
+    return jsonify({"version": account.VERSION, "full": False, "items": items, "deleted": deleted})
+
+@app.route("/history")
+@app.route("/history/<item_id>")
+def history(item_id=None):
+    """変更履歴を新しい順に返す（item_id 指定時はその商品の履歴と全体の復元、limit: 件数）"""
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    # キューに残っている分も含めて返す（書き込んだばかりの分がまだ届いていないレプリカではなくプライマリから読む）
+    flush_audit()
+    return jsonify({"item_id": item_id, "events": load_events(item_id, limit, primary=True)})
+
 @app.route("/ai-suggest", methods=["POST"])
+@profiled
+@timed("aggregate")
 def ai_suggest():
     """AI価格提案エンドポイント"""
     item = request.json
     
-    # 同カテゴリの売却済み商品を分析
-    sold_items = [d for d in DATA if d.get("sell_site") and d.get("category") == item.get("category")]
+    # 同カテゴリの売却済み商品を分析（外れ値に強い中央値・パーセンタイルを価格の索引から引く）
+    stats = price_stats(("category", item.get("category")))
     
-    if sold_items:
-        # 平均売却倍率を計算
-        avg_multiplier = sum(d.get("sell_price", 0) / d.get("buy_price", 1) for d in sold_items) / len(sold_items)
-        avg_rate = sum(d.get("rate", 0) for d in sold_items) / len(sold_items)
-        max_price = max(d.get("sell_price", 0) for d in sold_items)
-        min_price = min(d.get("sell_price", 0) for d in sold_items)
+    if stats and stats["multipliers"]["median"] is not None:
+        median_multiplier = stats["multipliers"]["median"]
+        median_rate = stats["rates"]["median"]
     else:
-        avg_multiplier = 1.8
-        avg_rate = 40
-        max_price = 0
-        min_price = 0
+        median_multiplier = 1.8
+        median_rate = 40
+    
+    # 販売サイト別の相場
+    by_site = {}
+    for site in FEE_RULE_INDEX:
+        site_stats = price_stats(("category_site", item.get("category"), site))
+        if site_stats:
+            by_site[site] = {"count": site_stats["count"], "prices": site_stats["prices"], "multipliers": site_stats["multipliers"]}
+    
+    # 商品名が似ている売却済み商品（3件以上あればカテゴリ全体より優先する）
+    similar = similar_items(item.get("name"), exclude=item.get("id"))
+    similar_prices = sorted(sell for _, _, sell, _ in similar)
+    similar_days = sorted(days for _, _, _, days in similar if days is not None)
     
     # 推奨価格を計算
     buy_price = item.get("buy_price", 0)
-    suggested_price = round(buy_price * avg_multiplier, -1)  # 10円単位で丸める
+    if len(similar_prices) >= 3:
+        suggested_price = round(quantile(similar_prices, 0.5), -1)  # 10円単位で丸める
+    else:
+        suggested_price = round(buy_price * median_multiplier, -1)  # 10円単位で丸める
     
-    # 予想利益を計算（手数料7.5%、送料300円で計算）
-    estimated_fee = suggested_price * 0.075
-    estimated_shipping = 300
-    expected_profit = round(suggested_price - buy_price - estimated_fee - estimated_shipping, 0)
+    # 予想利益を計算（見込み手数料・見込み送料で計算）
+    expected_profit = round(estimate_profit(suggested_price, buy_price, item.get("category")), 0)
     expected_rate = round((expected_profit / buy_price * 100), 1) if buy_price > 0 else 0
     
     # 分析メッセージ
-    if sold_items:
-        analysis = f"同じカテゴリ「{item.get('category')}」の過去{len(sold_items)}件の販売実績から、平均{avg_multiplier:.1f}倍の価格で売却されています。平均利益率は{avg_rate:.1f}%です。"
-        if len(sold_items) >= 3:
-            analysis += f"<br>価格帯：¥{min_price:,}〜¥{max_price:,}"
+    if stats:
+        analysis = f"同じカテゴリ「{item.get('category')}」の過去{stats['count']}件の販売実績から、中央値で{median_multiplier:.1f}倍の価格で売却されています。利益率の中央値は{median_rate:.1f}%です。"
+        if stats["count"] >= 3:
+            prices = stats["prices"]
+            analysis += f"<br>価格帯（中央50%）：¥{prices['p25']:,.0f}〜¥{prices['p75']:,.0f}（中央値 ¥{prices['median']:,.0f}）"
+        for site, site_stats in sorted(by_site.items(), key=lambda kv: -kv[1]["count"]):
+            analysis += f"<br>・{site}：中央値 ¥{site_stats['prices']['median']:,.0f}（{site_stats['count']}件）"
     else:
         analysis = f"「{item.get('category')}」カテゴリの販売実績がまだありません。一般的な利益率から価格を算出しています。"
+    if len(similar_prices) >= 3:
+        analysis = f"商品名が似ている売却済み商品{len(similar_prices)}件の売却価格の中央値（¥{quantile(similar_prices, 0.5):,.0f}、¥{similar_prices[0]:,.0f}〜¥{similar_prices[-1]:,.0f}）をもとに価格を提案しています。<br>" + analysis
     
     # アドバイス
     if expected_rate > 50:
@@ -1216,29 +4667,390 @@ def ai_suggest():
     else:
         advice = "⚠️ 利益率が低めです。価格を少し上げるか、まとめ売りで付加価値をつけることも検討してみてください。"
     
-    # 売却期間の分析（売却日がある場合）
-    sold_with_dates = [d for d in sold_items if d.get("buy_date") and d.get("sell_date")]
-    if sold_with_dates:
-        from datetime import datetime
-        total_days = 0
-        for d in sold_with_dates:
-            try:
-                buy = datetime.strptime(d.get("buy_date"), "%Y-%m-%d")
-                sell = datetime.strptime(d.get("sell_date"), "%Y-%m-%d")
-                total_days += (sell - buy).days
-            except:
-                pass
-        if total_days > 0:
-            avg_days = round(total_days / len(sold_with_dates))
-            advice += f"<br><br>⏱️ このカテゴリの平均売却期間は約{avg_days}日です。"
+    # 売却期間の分析（売却日がある場合、似ている商品→在庫の索引の順に中央値を引く）
+    if len(similar_days) >= 3:
+        advice += f"<br><br>⏱️ 似ている商品は購入から約{round(quantile(similar_days, 0.5))}日で売れています（中央値）。"
+    else:
+        with ACCOUNT.INVENTORY_LOCK:
+            days = median_days(("category", item.get("category")))
+        if days:
+            advice += f"<br><br>⏱️ このカテゴリは購入から約{round(days)}日で売れています（中央値）。"
     
     return jsonify({
         "suggested_price": int(suggested_price),
         "expected_profit": int(expected_profit),
         "expected_rate": expected_rate,
         "analysis": analysis,
-        "advice": advice
+        "advice": advice,
+        "estimate_note": estimate_note(),
+        "percentiles": stats,
+        "by_site": by_site,
+        "similar": [
+            {"id": item_id, "similarity": round(score, 2), "sell_price": sell, "days_to_sell": days}
+            for score, item_id, sell, days in similar
+        ]
+    })
+
+@app.route("/archive", methods=["GET"])
+def archive_status():
+    """アーカイブ済みの件数と利益合計"""
+    return jsonify({
+        "count": ACCOUNT.ARCHIVE_SUMMARY["count"],
+        "profit": ACCOUNT.ARCHIVE_SUMMARY["profit"],
+        "after_days": ARCHIVE_AFTER_DAYS,
+    })
+
+@app.route("/archive", methods=["POST"])
+def archive():
+    """売却日が ?before=YYYY-MM-DD（省略時は ARCHIVE_AFTER_DAYS 日前）より前の商品をアーカイブするジョブを開始"""
+    before = request.args.get("before") or (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d")
+    if date_ordinal(before) is None:
+        return jsonify({"error": "before は YYYY-MM-DD で指定してください"}), 400
+    mark_write()
+    return jsonify(job_public(submit_job("archive", run_archive, before))), 202
+
+@app.route("/unarchive", methods=["POST"])
+def unarchive():
+    """アーカイブから商品を戻すジョブを開始（?since=YYYY-MM-DD 以降に売却した商品、または {"ids": [...]}）"""
+    since = request.args.get("since")
+    ids = (request.get_json(silent=True) or {}).get("ids")
+    if since and date_ordinal(since) is None:
+        return jsonify({"error": "since は YYYY-MM-DD で指定してください"}), 400
+    if not since and not ids:
+        return jsonify({"error": "since か ids を指定してください"}), 400
+    mark_write()
+    return jsonify(job_public(submit_job("unarchive", run_unarchive, since, ids))), 202
+
+@app.route("/recompute", methods=["POST"])
+def recompute():
+    """手数料・利益・利益率の再計算をジョブとして開始（?site=メルカリ で対象サイトを限定）"""
+    sites = request.args.getlist("site") or None
+    return jsonify(job_public(submit_job("recompute", run_recompute, sites))), 202
+
+@app.route("/fee-rules", methods=["GET"])
+def get_fee_rules():
+    return jsonify(FEE_SETTINGS)
+
+@app.route("/fee-rules", methods=["POST"])
+def update_fee_rules():
+    """手数料ルールを更新し、変更のあったサイトの商品を再計算するジョブを開始
+    手数料ルールは全アカウント共通なので、アカウントを分けているときは管理者（X-Admin-Token）だけが変えられる"""
+    if not admin_authorized():
+        return jsonify({"error": "手数料ルールの変更は管理者だけができます"}), 403
+    try:
+        settings = parse_fee_settings(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    old_rules = {(r["site"], r["since"], r["percent"], r["fixed"]) for r in FEE_SETTINGS["rules"]}
+    new_rules = {(r["site"], r["since"], r["percent"], r["fixed"]) for r in settings["rules"]}
+    affected = sorted({rule[0] for rule in old_rules ^ new_rules})
+    save_setting("fee_rules", settings)
+    mark_write()
+    apply_fee_settings(settings)
+    if USE_DATABASE:
+        save_fee_rules(settings["rules"])
+    result = {"settings": settings, "affected_sites": affected, "job": None}
+    if affected:
+        result["job"] = job_public(submit_job("recompute", run_recompute_all, affected))
+    return jsonify(result)
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = JOBS.get(job_id)
+    if job is not None and job.get("account", DEFAULT_ACCOUNT) != ACCOUNT.id:
+        job = None
+    if job is None:
+        # 別のワーカーで実行中のジョブはフラグだけ立てる（進捗更新時に検知される）
+        stored = load_job(job_id, primary=True)
+        if stored is None or stored.get("account", DEFAULT_ACCOUNT) != ACCOUNT.id:
+            return jsonify({"error": "ジョブが見つかりません"}), 404
+        if stored["status"] in ("queued", "running"):
+            stored["cancel_requested"] = True
+            save_job(stored)
+        return jsonify(stored)
+    if job["status"] in ("queued", "running"):
+        job["cancel_requested"] = True
+        future = JOB_FUTURES.get(job_id)
+        if future is not None and future.cancel():
+            job["status"] = "cancelled"
+            release_account(job.pop("_account"))
+        save_job(job)
+        forget_finished_jobs()
+    return jsonify(job_public(job))
+
+@app.route("/jobs/<job_id>/download")
+def download_job_result(job_id):
+    """バックアップジョブの結果をダウンロード"""
+    job = get_job(job_id)
+    path = os.path.join(JOB_RESULT_DIR, f"{job_id}.json")
+    if job is None or job["kind"] != "backup" or job["status"] != "done" or not os.path.exists(path):
+        return jsonify({"error": "ダウンロードできるバックアップがありません"}), 404
+    return send_file(path, mimetype='application/json', as_attachment=True, download_name=job["result"]["filename"])
+
+@app.route("/rollups")
+def rollups():
+    """月別・週別の集計（?period=month|week&from=2024-01&to=2024-12）。cumulative_profit は累計利益"""
+    period = request.args.get("period", "month")
+    if period not in ROLLUP_PERIODS:
+        return jsonify({"error": "period は month か week を指定してください"}), 400
+    start = request.args.get("from", "")
+    end = request.args.get("to", "")
+    with ACCOUNT.ROLLUP_LOCK:
+        rows = [dict(totals, bucket=bucket) for bucket, totals in sorted(ACCOUNT.ROLLUPS[period].items())]
+    cumulative = 0
+    buckets = []
+    for row in rows:
+        # 寄与がなくなったバケットは出さない
+        if not row["sold"] and not row["bought"]:
+            continue
+        cumulative += row["profit"]
+        row["cumulative_profit"] = cumulative
+        if (not start or row["bucket"] >= start) and (not end or row["bucket"][:len(end)] <= end):
+            buckets.append(row)
+    return jsonify({"period": period, "buckets": buckets})
+
+# 在庫のキャッシュフロー予測（/forecast）
+# 未売却の商品ごとに、カテゴリの売却率と売却までの日数の分布から「購入からの経過日数を踏まえて各期間内に売れる確率」を、
+# 売却倍率の分布から「売れたときの利益の候補」を前計算し、forecast.simulate をプロセスプールで並列に回す
+FORECAST_HORIZONS = (30, 60, 90)
+FORECAST_TRIALS = int(os.environ.get('FORECAST_TRIALS', '2000'))
+FORECAST_WORKERS = int(os.environ.get('FORECAST_WORKERS', str(min(4, os.cpu_count() or 1))))
+FORECAST_MIN_HISTORY = 5  # 売却実績がこれより少ないカテゴリは全体の分布を使う
+FORECAST_PRICE_SAMPLES = 50  # 売却倍率の分布から取る分位点の数
+FORECAST_EXECUTOR = None
+FORECAST_LOCK = threading.Lock()
+
+def forecast_executor():
+    global FORECAST_EXECUTOR
+    with FORECAST_LOCK:
+        if FORECAST_EXECUTOR is None:
+            # fork だと書き込みスレッドなどのロックを抱えたまま複製されるので spawn で起動する
+            FORECAST_EXECUTOR = ProcessPoolExecutor(FORECAST_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return FORECAST_EXECUTOR
+
+def sell_probabilities(key, age):
+    """購入から age 日たっても売れていない商品が、各期間内に売れる確率（INVENTORY_LOCK を持って呼ぶ）"""
+    days = ACCOUNT.DAYS_TO_SELL.get(key)
+    sold, total = ACCOUNT.SELL_THROUGH.get(key, (0, 0))
+    if not days or not total:
+        return tuple(0.0 for _ in FORECAST_HORIZONS)
+    rate = sold / total
+    base = bisect.bisect_right(days, age) / len(days)
+    remaining = 1 - rate * base
+    if remaining <= 0:
+        return tuple(0.0 for _ in FORECAST_HORIZONS)
+    return tuple(min(1.0, rate * (bisect.bisect_right(days, age + h) / len(days) - base) / remaining)
+                 for h in FORECAST_HORIZONS)
+
+def multiplier_samples(values):
+    """売却倍率の分位点（中央値で割った相対値も返す）"""
+    if not values:
+        return None, None
+    samples = [quantile(values, (i + 0.5) / FORECAST_PRICE_SAMPLES) for i in range(FORECAST_PRICE_SAMPLES)]
+    median = quantile(values, 0.5)
+    return samples, [m / median for m in samples]
+
+def forecast_params(today):
+    """未売却の商品ごとの (各期間内に売れる確率, 売れたときの利益の候補)"""
+    unsold = [d for d in ACCOUNT.DATA if not d.get("sell_site")]
+    with ACCOUNT.PRICE_LOCK:
+        multipliers = {key[1]: index["multipliers"] for key, index in ACCOUNT.PRICE_INDEX.items() if key[0] == "category"}
+        all_multipliers = sorted(m for values in multipliers.values() for m in values)
+        samples = {category: multiplier_samples(values) for category, values in multipliers.items()
+                   if len(values) >= FORECAST_MIN_HISTORY}
+    fallback = multiplier_samples(all_multipliers)
+    params = []
+    with ACCOUNT.INVENTORY_LOCK:
+        for item in unsold:
+            key = ("category", item.get("category"))
+            if len(ACCOUNT.DAYS_TO_SELL.get(key, ())) < FORECAST_MIN_HISTORY:
+                key = "all"
+            buy_ordinal = date_ordinal(item.get("buy_date"))
+            probs = sell_probabilities(key, max(0, today - buy_ordinal) if buy_ordinal else 0)
+            if not probs[-1]:
+                continue
+            buy = item.get("buy_price") or 0
+            listed = item.get("sell_price") or 0
+            absolute, relative = samples.get(item.get("category"), fallback)
+            if absolute is None:
+                prices = [listed or buy * 1.8]
+            elif listed > 0:
+                # 販売価格が入力済みなら、それを中央値として倍率のばらつきを掛ける
+                prices = [listed * r for r in relative]
+            else:
+                prices = [buy * m for m in absolute]
+            profits = [estimate_profit(price, buy, item.get("category")) for price in prices if price > 0]
+            if profits:
+                params.append((probs, profits))
+    return params
+
+def run_forecast(trials=FORECAST_TRIALS):
+    """30/60/90日以内に売れる見込みの利益（期待値と90%区間）と売却件数"""
+    now = datetime.now()
+    today = now.toordinal()
+    cache_key = (ACCOUNT.VERSION, len(ACCOUNT.DATA), id(FEE_SETTINGS), today, trials)
+    cached = ACCOUNT.FORECAST_CACHE.get(cache_key)
+    if cached:
+        return cached
+    params = forecast_params(today)
+    results = []
+    if params:
+        workers = max(1, min(FORECAST_WORKERS, trials // 100))
+        chunks = [trials // workers + (1 if i < trials % workers else 0) for i in range(workers)]
+        seeds = [today * 100 + i for i in range(workers)]
+        with stage("simulate"):
+            try:
+                for chunk in forecast_executor().map(simulate_forecast, [params] * workers, [FORECAST_HORIZONS] * workers, chunks, seeds):
+                    results.extend(chunk)
+            except Exception as e:
+                # プロセスを起動できない環境ではこのプロセスで計算する
+                global FORECAST_EXECUTOR
+                print(f"Forecast pool error: {e}")
+                increment("furima_forecast_pool_errors_total")
+                FORECAST_EXECUTOR = None
+                results = simulate_forecast(params, FORECAST_HORIZONS, trials, seeds[0])
+    horizons = []
+    for h, days in enumerate(FORECAST_HORIZONS):
+        profits = sorted(totals[h] for totals, _ in results) or [0]
+        counts = [sold[h] for _, sold in results] or [0]
+        horizons.append({
+            "days": days,
+            "expected_profit": round(sum(profits) / len(profits)),
+            "p05": round(quantile(profits, 0.05)),
+            "p95": round(quantile(profits, 0.95)),
+            "expected_sold": round(sum(counts) / len(counts), 1),
+        })
+    result = {
+        "as_of": now.strftime("%Y-%m-%d"),
+        "trials": trials,
+        "unsold": sum(1 for d in ACCOUNT.DATA if not d.get("sell_site")),
+        "simulated": len(params),
+        "horizons": horizons,
+        "estimate_note": estimate_note(),
+    }
+    ACCOUNT.FORECAST_CACHE.clear()
+    ACCOUNT.FORECAST_CACHE[cache_key] = result
+    return result
+
+@app.route("/forecast")
+@profiled
+@timed("aggregate")
+def cash_forecast():
+    """未売却在庫の30/60/90日の見込み利益（?trials= でシミュレーション回数を指定）"""
+    trials = min(max(request.args.get("trials", FORECAST_TRIALS, type=int), 100), 20000)
+    return jsonify(run_forecast(trials))
+
+@app.route("/inventory")
+def inventory():
+    """在庫レポート：未売却の滞留日数の区分、売却率、売却までの日数の中央値（全体・カテゴリ別・購入先別）"""
+    today = datetime.now()
+    labels = [f"{lo + 1 if lo else 0}-{hi}日" for lo, hi in zip((0,) + AGE_BUCKETS, AGE_BUCKETS)] + [f"{AGE_BUCKETS[-1] + 1}日以上"]
+    
+    def report(key):
+        sold, total = ACCOUNT.SELL_THROUGH.get(key, (0, 0))
+        return {
+            "aging": age_counts(key, today),
+            "unsold": total - sold,
+            "sold": sold,
+            "total": total,
+            "sell_through": round(sold / total * 100, 1) if total else 0,
+            "median_days_to_sell": median_days(key),
+        }
+    
+    with ACCOUNT.INVENTORY_LOCK:
+        keys = list(ACCOUNT.SELL_THROUGH)
+        result = {
+            "as_of": today.strftime("%Y-%m-%d"),
+            "age_buckets": labels,
+            "all": report("all"),
+            "by_category": {k[1]: report(k) for k in keys if k[0] == "category" and ACCOUNT.SELL_THROUGH[k][1]},
+            "by_platform": {k[1]: report(k) for k in keys if k[0] == "platform" and ACCOUNT.SELL_THROUGH[k][1]},
+        }
+    return jsonify(result)
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus テキスト形式で計測値を出力"""
+    lines = []
+    with METRICS_LOCK:
+        histograms = {k: list(v) for k, v in HISTOGRAMS.items()}
+        counters = dict(COUNTERS)
+    
+    seen = set()
+    for (name, labels), h in sorted(histograms.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} histogram")
+            seen.add(name)
+        buckets = HISTOGRAM_BUCKETS[name]
+        for b, count in zip(buckets, h):
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', b)])} {count}")
+        lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {h[-1]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {h[-2]}")
+        lines.append(f"{name}_count{format_labels(labels)} {h[-1]}")
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    
+    # 商品数などはメモリに読み込んでいるアカウントごとに出す
+    with ACCOUNTS_LOCK:
+        accounts = [a for a in ACCOUNTS.values() if a.loaded]
+    lines.append("# TYPE furima_accounts_loaded gauge")
+    lines.append(f"furima_accounts_loaded {len(accounts)}")
+    lines.append("# TYPE furima_items gauge")
+    for account in accounts:
+        lines.append(f"furima_items{format_labels([('account', account.id)])} {len(account.DATA)}")
+    lines.append("# TYPE furima_items_sold gauge")
+    for account in accounts:
+        sold = sum(1 for d in account.DATA if d.get('sell_site'))
+        lines.append(f"furima_items_sold{format_labels([('account', account.id)])} {sold}")
+    lines.append("# TYPE furima_change_version gauge")
+    for account in accounts:
+        lines.append(f"furima_change_version{format_labels([('account', account.id)])} {account.VERSION}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route("/profiles")
+def profiles():
+    """保存されているプロファイルの一覧"""
+    if not profile_authorized():
+        return jsonify({"error": "not found"}), 404
+    return jsonify({
+        "enabled": PROFILE_ENABLED,
+        "profiles": [{k: v for k, v in p.items() if k not in ("pstats", "collapsed")} for p in PROFILES],
     })
 
+@app.route("/profiles/toggle", methods=["POST"])
+def toggle_profiling():
+    """再デプロイせずに常時プロファイリングを切り替える"""
+    global PROFILE_ENABLED
+    if not profile_authorized():
+        return jsonify({"error": "not found"}), 404
+    PROFILE_ENABLED = not PROFILE_ENABLED
+    return jsonify({"enabled": PROFILE_ENABLED})
+
+@app.route("/profiles/<int:profile_id>.<fmt>")
+def download_profile(profile_id, fmt):
+    """プロファイルをダウンロード（.pstats: pstats.Stats で読める形式 / .collapsed: flamegraph.pl 用）"""
+    if not profile_authorized():
+        return jsonify({"error": "not found"}), 404
+    profile = next((p for p in PROFILES if p["id"] == profile_id), None)
+    if profile is None or fmt not in ("pstats", "collapsed"):
+        return jsonify({"error": "not found"}), 404
+    filename = f"{profile['function']}_{profile_id}.{fmt}"
+    if fmt == "pstats":
+        body, mimetype = profile["pstats"], "application/octet-stream"
+    else:
+        body = "".join(f"{stack} {count}\n" for stack, count in profile["collapsed"].most_common())
+        mimetype = "text/plain"
+    return Response(body, mimetype=mimetype, headers={'Content-Disposition': f'attachment;filename={filename}'})
+
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0', port=5000)
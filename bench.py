@@ -0,0 +1,365 @@
+"""フリマ損益アプリのベンチマーク
+
+合成データ（1千〜50万件）を生成し、各エンドポイントのスループットと
+p50/p95/p99 レイテンシを計測する。
+
+使い方:
+    python bench.py --items 1000 10000                 # JSONファイルモード（Flaskテストクライアント）
+    python bench.py --items 10000 --database-url postgresql://localhost/furima_bench
+    python bench.py --items 10000 --sqlite            # SQLiteモード
+    python bench.py --items 10000 --gunicorn           # ローカルで gunicorn を起動して HTTP で計測
+    python bench.py --items 10000 --url http://127.0.0.1:8000   # 起動済みのサーバーを計測
+
+    # 遅い /backup を裏で叩き続けながら計測（同期ワーカーと gthread の比較）
+    python bench.py --items 20000 --gunicorn --routes /ai-suggest /add --concurrency 8 --background /backup
+    python bench.py --items 20000 --gunicorn --gunicorn-config gunicorn.conf.py --routes /ai-suggest /add --concurrency 8 --background /backup
+"""
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import threading
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 実データに近い分布（重み）
+CATEGORIES = {"ガチャ": 35, "ステッカー": 20, "服": 15, "文房具": 15, "雑貨": 15}
+PLATFORMS = {"お店": 30, "SHEIN": 25, "TEMU": 20, "アリエク": 10, "百均": 15}
+SELL_SITES = {"メルカリ": 55, "ラクマ": 25, "ヤフーフリマ": 20}
+SELL_FEES = {"ラクマ": 0.10, "ヤフーフリマ": 0.05, "メルカリ": 0.10}
+
+CHARACTERS = ["ちいかわ", "ハチワレ", "うさぎ", "ミッフィー", "すみっコぐらし", "ポケモン", "サンリオ", "キティ", "シナモロール", "リラックマ"]
+KINDS = {
+    "ガチャ": ["ガチャ キーホルダー", "ガチャ フィギュア", "ガチャ ミニチュア", "缶バッジ"],
+    "ステッカー": ["ステッカー", "シール セット", "フレークシール"],
+    "服": ["Tシャツ", "パーカー", "靴下", "ワンピース"],
+    "文房具": ["ボールペン", "メモ帳", "ノート", "マスキングテープ"],
+    "雑貨": ["ぬいぐるみ", "マグカップ", "ポーチ", "タオル"],
+}
+# 仕入れ価格の目安（円）
+PRICE_RANGE = {"ガチャ": (200, 500), "ステッカー": (100, 400), "服": (500, 3000), "文房具": (100, 800), "雑貨": (300, 2000)}
+
+
+def pick(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def generate_item(rng, start, days, sold_ratio=0.6):
+    """合成商品を1件生成"""
+    category = pick(rng, CATEGORIES)
+    buy = float(rng.randint(*PRICE_RANGE[category]) // 10 * 10)
+    buy_date = start + timedelta(days=rng.randrange(days))
+    item = {
+        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "buy_platform": pick(rng, PLATFORMS),
+        "category": category,
+        "name": f"{rng.choice(CHARACTERS)} {rng.choice(KINDS[category])}",
+        "buy_date": buy_date.isoformat(),
+        "sell_date": "",
+        "buy_price": buy,
+        "sell_price": 0.0,
+        "shipping": 0.0,
+        "fee": 0,
+        "profit": 0,
+        "rate": 0,
+        "sell_site": "",
+    }
+    if rng.random() < sold_ratio:
+        site = pick(rng, SELL_SITES)
+        sell = float(round(buy * rng.lognormvariate(0.6, 0.35), -1))
+        ship = float(rng.choice([0, 120, 180, 210, 230, 380]))
+        fee = round(sell * SELL_FEES[site], 0)
+        profit = round(sell - buy - ship - fee, 0)
+        item.update({
+            "sell_site": site,
+            "sell_date": (buy_date + timedelta(days=int(rng.expovariate(1 / 20)))).isoformat(),
+            "sell_price": sell,
+            "shipping": ship,
+            "fee": fee,
+            "profit": profit,
+            "rate": round(profit / buy * 100, 1) if buy > 0 else 0,
+        })
+    elif rng.random() < 0.5:
+        # 未売却でも予定価格が入っている商品
+        item["sell_price"] = float(round(buy * rng.uniform(1.3, 2.5), -1))
+    return item
+
+
+def generate_ledger(n, seed=0, years=3):
+    """n件の合成台帳を生成"""
+    rng = random.Random(seed)
+    days = 365 * years
+    start = date.today() - timedelta(days=days)
+    return [generate_item(rng, start, days) for _ in range(n)]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def form_for(item):
+    return {k: str(item[k]) for k in ("name", "buy_date", "buy_price", "buy_platform", "category", "sell_price", "sell_site", "sell_date", "shipping")}
+
+
+class TestClientTarget:
+    """Flask テストクライアント経由で同一プロセス内の app を叩く"""
+
+    def __init__(self, module):
+        self.module = module
+        self.client = module.app.test_client()
+
+    def seed(self, items):
+        self.module.ACCOUNT.DATA = items
+        self.module.save_data()
+        # 保存した内容から読み直して集計用の索引（価格・類似商品・期間別集計）も作る
+        self.module.load_account()
+
+    def request(self, method, path, form=None, json_body=None, file_bytes=None):
+        if file_bytes is not None:
+            form = {"backup_file": (io.BytesIO(file_bytes), "backup.json")}
+        r = self.client.open(path, method=method, data=form, json=json_body)
+        r.close()
+        return r.status_code
+
+
+class HttpTarget:
+    """HTTP 経由で起動済みサーバー（gunicorn など）を叩く"""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(self.NoRedirect)
+
+    def seed(self, items):
+        body = json.dumps({"items": items}, ensure_ascii=False).encode("utf-8")
+        status = self.request("POST", "/restore", file_bytes=body)
+        if status >= 400:
+            raise RuntimeError(f"seed failed: HTTP {status}")
+
+    def request(self, method, path, form=None, json_body=None, file_bytes=None):
+        headers = {}
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        elif file_bytes is not None:
+            boundary = uuid.uuid4().hex
+            data = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"backup_file\"; filename=\"backup.json\"\r\n"
+                    f"Content-Type: application/json\r\n\r\n").encode() + file_bytes + f"\r\n--{boundary}--\r\n".encode()
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=600) as r:
+                r.read()
+                return r.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def build_scenarios(items, rng, restore_bytes):
+    """エンドポイントごとのリクエスト生成関数"""
+    def add():
+        return ("POST", "/add", {"form": form_for(generate_item(rng, date.today() - timedelta(days=30), 30))})
+
+    def edit():
+        item = dict(rng.choice(items))
+        item["sell_price"] = item["sell_price"] or item["buy_price"] * 2
+        return ("POST", "/edit", {"form": dict(form_for(item), id=item["id"])})
+
+    # シードした台帳の商品を重複なく削除する（台帳はエンドポイントごとにシードし直す）
+    deletable = [item["id"] for item in items]
+    rng.shuffle(deletable)
+
+    def delete():
+        if not deletable:
+            raise RuntimeError("/delete のリクエスト数が台帳の件数を超えています")
+        return ("GET", f"/delete/{deletable.pop()}", {})
+
+    def ai_suggest():
+        item = rng.choice(items)
+        return ("POST", "/ai-suggest", {"json_body": {"category": item["category"], "buy_price": item["buy_price"], "name": item["name"]}})
+
+    return {
+        "/": lambda: ("GET", "/", {}),
+        "/add": add,
+        "/edit": edit,
+        "/delete": delete,
+        "/ai-suggest": ai_suggest,
+        "/backup": lambda: ("GET", "/backup", {}),
+        "/restore": lambda: ("POST", "/restore", {"file_bytes": restore_bytes}),
+    }
+
+
+def start_background(target, make_request):
+    """計測中に別スレッドで make_request を叩き続ける。止める関数を返す"""
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            method, path, kwargs = make_request()
+            target.request(method, path, **kwargs)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+
+    def finish():
+        stop.set()
+        thread.join()
+    return finish
+
+
+def run_route(target, make_request, count, concurrency):
+    """1エンドポイントを count 回叩いてレイテンシを集計"""
+    def one(_):
+        method, path, kwargs = make_request()
+        t0 = time.perf_counter()
+        status = target.request(method, path, **kwargs)
+        return time.perf_counter() - t0, status
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(one, range(count)))
+    else:
+        results = [one(i) for i in range(count)]
+    wall = time.perf_counter() - started
+
+    latencies = sorted(r[0] * 1000 for r in results)
+    errors = sum(1 for r in results if r[1] >= 400)
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput": round(count / wall, 1) if wall > 0 else 0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, env, extra_args, config=None):
+    port = free_port()
+    # 設定ファイルを指定しないときは素の gunicorn（同期ワーカー1つ）で起動する（作業ディレクトリは一時ディレクトリ）
+    config_args = ["-c", os.path.abspath(config)] if config else []
+    cmd = [sys.executable, "-m", "gunicorn"] + config_args + ["--pythonpath", REPO_DIR, "-b", f"127.0.0.1:{port}", "--timeout", "600"] + extra_args + ["app:app"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + "/metrics", timeout=1).read()
+            return proc, url
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="フリマ損益アプリのベンチマーク")
+    parser.add_argument("--items", type=int, nargs="+", default=[1000], help="台帳の件数（複数指定可）")
+    parser.add_argument("--requests", type=int, default=100, help="エンドポイントごとのリクエスト数")
+    parser.add_argument("--restore-requests", type=int, default=3, help="/restore のリクエスト数（重いので少なめ）")
+    parser.add_argument("--routes", nargs="+", help="計測するエンドポイント（既定は全て）")
+    parser.add_argument("--concurrency", type=int, default=1, help="HTTP モードの同時接続数")
+    parser.add_argument("--database-url", help="PostgreSQL モードで計測する（ローカルのベンチ用DBを指定）")
+    parser.add_argument("--sqlite", action="store_true", help="SQLite モードで計測する")
+    parser.add_argument("--gunicorn", action="store_true", help="gunicorn を起動して HTTP 経由で計測")
+    parser.add_argument("--gunicorn-args", default="", help="gunicorn に渡す追加引数")
+    parser.add_argument("--gunicorn-config", help="gunicorn の設定ファイル（例: gunicorn.conf.py）")
+    parser.add_argument("--background", help="計測中に裏で叩き続けるエンドポイント（例: /backup）")
+    parser.add_argument("--url", help="起動済みサーバーのURL")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="furima_bench_")
+    env = dict(os.environ)
+    env.pop("DATABASE_URL", None)
+    env.pop("STORAGE", None)
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+        mode = "postgresql"
+    elif args.sqlite:
+        env["STORAGE"] = "sqlite"
+        mode = "sqlite"
+    else:
+        mode = "json"
+
+    proc = None
+    if args.url:
+        target = HttpTarget(args.url)
+        mode = "http"
+    elif args.gunicorn:
+        proc, url = start_gunicorn(workdir, env, args.gunicorn_args.split(), args.gunicorn_config)
+        target = HttpTarget(url)
+    else:
+        # app.py は import 時に DATABASE_URL とカレントディレクトリを見るので先に切り替える
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_DIR)
+        import app as module
+        target = TestClientTarget(module)
+
+    report = []
+    try:
+        for n in args.items:
+            rng = random.Random(args.seed + n)
+            items = generate_ledger(n, seed=args.seed + n)
+            restore_bytes = json.dumps({"items": items}, ensure_ascii=False).encode("utf-8")
+            scenarios = build_scenarios(items, rng, restore_bytes)
+            for route in args.routes or list(scenarios):
+                target.seed(items)
+                count = args.restore_requests if route == "/restore" else args.requests
+                stop_background = start_background(target, scenarios[args.background]) if args.background else None
+                try:
+                    result = run_route(target, scenarios[route], count, args.concurrency)
+                finally:
+                    if stop_background:
+                        stop_background()
+                result.update({"mode": mode, "items": n, "route": route, "background": args.background})
+                report.append(result)
+                if not args.json:
+                    print(f"{mode:>10} {n:>8} {route:<12} {result['throughput']:>9.1f} req/s  "
+                          f"p50 {result['p50_ms']:>9.2f}ms  p95 {result['p95_ms']:>9.2f}ms  p99 {result['p99_ms']:>9.2f}ms  "
+                          f"errors {result['errors']}", flush=True)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""未売却在庫のキャッシュフロー予測（モンテカルロ）
+
+app.py からプロセスプールで呼ばれる。Flask や商品データには依存せず、
+商品ごとに前計算したパラメータだけを受け取ってシミュレーションする。
+"""
+import random
+
+
+def simulate(items, horizons, trials, seed):
+    """trials 回シミュレーションして、試行ごとの期間別の利益合計と売却件数を返す
+
+    items: [(各期間までに売れる確率のタプル（昇順）, 売れたときの利益の候補リスト), ...]
+    返り値: [(期間ごとの利益合計のリスト, 期間ごとの売却件数のリスト), ...]（試行ごと）
+    """
+    rng = random.Random(seed)
+    rand = rng.random
+    n = len(horizons)
+    results = []
+    for _ in range(trials):
+        totals = [0.0] * n
+        counts = [0] * n
+        for probs, profits in items:
+            # 1つの乱数で「いつまでに売れるか」を決める（probs は期間が長いほど大きい）
+            u = rand()
+            if u >= probs[-1]:
+                continue
+            profit = profits[int(rand() * len(profits))]
+            for h in range(n - 1, -1, -1):
+                if u >= probs[h]:
+                    break
+                totals[h] += profit
+                counts[h] += 1
+        results.append((totals, counts))
+    return results
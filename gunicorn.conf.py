@@ -0,0 +1,27 @@
+"""gunicorn の設定（start.sh から gunicorn -c gunicorn.conf.py app:app で読み込む）
+
+商品データはプロセス内のメモリに持ち、書き込みはプロセス内の書き込みスレッドが
+まとめて行うので、1プロセス×複数スレッド（gthread）で動かす。
+遅い /restore や /backup の処理中も、他のリクエストは別スレッドで応答できる。
+
+ワーカーは1つに限る。各ワーカーが自分のメモリに商品データを持ち、他のワーカーの書き込みを
+知る仕組みがないので、複数にするとデータが食い違う（JSONの圧縮・versions.json の書き直しで
+他のワーカーの書き込みが消え、PostgreSQL でも古い内容で上書きしてしまう）。
+"""
+import multiprocessing
+import os
+
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+if workers != 1:
+    raise SystemExit("WEB_CONCURRENCY は 1 にしてください（同時に処理できる数は GUNICORN_THREADS で増やす）")
+# DB・ファイルの待ち時間の間に他のリクエストを処理できるよう、CPU数より多めにスレッドを用意する
+threads = int(os.environ.get("GUNICORN_THREADS", str(max(4, cpus * 4))))
+# 同期版の /restore は全件を書き直すので長めに待つ
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+accesslog = os.environ.get("GUNICORN_ACCESSLOG")
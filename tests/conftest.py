@@ -0,0 +1,77 @@
+"""テスト共通のフィクスチャ（python -m pytest -q で実行）
+
+app.py は読み込み時に環境変数を読み、カレントディレクトリのファイルにデータを保存するので、
+テストごとに一時ディレクトリへ移って JSON ファイル保存のまま読み込み直す。
+"""
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """環境変数を指定して app を新しく読み込む（同じテストの中で呼び直すと保存済みのデータから読み直す）"""
+    modules = []
+
+    def make(**env):
+        monkeypatch.chdir(tmp_path)
+        for name in ("DATABASE_URL", "STORAGE", "ACCOUNT_HEADER", "ADMIN_TOKEN", "MAX_ACCOUNTS", "WRITE_MODE", "PROXY_COUNT", "PROFILE", "PROFILE_TOKEN"):
+            monkeypatch.delenv(name, raising=False)
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        if modules:
+            shutdown(modules[-1])
+        sys.modules.pop("app", None)
+        module = importlib.import_module("app")
+        modules.append(module)
+        return module
+
+    yield make
+    if modules:
+        shutdown(modules[-1])
+    sys.modules.pop("app", None)
+
+
+def shutdown(module):
+    # 書き込みスレッドが後から別のディレクトリに書かないよう、キューを空にしておく
+    # （失敗させたままの書き込みは捨てる。書き込み中のものは WRITE_LOCK で終わるのを待つ）
+    module.JOB_EXECUTOR.shutdown(wait=True)
+    module.flush_accounts()
+    module.flush_audit()
+    for account in list(module.ACCOUNTS.values()):
+        with account.WRITE_LOCK, module.WRITE_COND:
+            account.PENDING_PUTS.clear()
+            account.PENDING_DELETES.clear()
+            account.PENDING_VERSIONS.clear()
+            module.DIRTY_ACCOUNTS.discard(account)
+
+
+@pytest.fixture
+def app_module(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def add_item(client):
+    """/add で商品を登録して、登録した商品を返す関数（account 指定時は X-Account ヘッダーで送る）"""
+
+    def add(account=None, **fields):
+        import app
+
+        form = {"name": "シャツ", "buy_price": "100", "category": "服", "buy_platform": "お店", "buy_date": "2024-01-01"}
+        form.update(fields)
+        headers = {"X-Account": account} if account else {}
+        response = client.post("/add", data=form, headers=headers)
+        assert response.status_code == 302
+        return app.ACCOUNTS[account or app.DEFAULT_ACCOUNT].DATA[-1]
+
+    return add
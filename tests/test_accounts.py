@@ -0,0 +1,80 @@
+"""アカウントごとのデータの分離・切り替え・追い出し"""
+import os
+import time
+
+import pytest
+
+FORM = {"name": "シャツ", "buy_price": "100", "category": "服", "buy_platform": "お店", "buy_date": "2024-01-01"}
+
+
+@pytest.fixture
+def app_module(make_app):
+    return make_app(ACCOUNT_HEADER="X-Account", ADMIN_TOKEN="secret", MAX_ACCOUNTS="2")
+
+
+def as_account(account_id, **headers):
+    return dict(headers, **{"X-Account": account_id})
+
+
+def names(client, account_id):
+    body = client.get("/changes", headers=as_account(account_id)).get_json()
+    return sorted(d["name"] for d in body["items"])
+
+
+def test_accounts_see_only_their_own_items(client):
+    client.post("/add", data=dict(FORM, name="Aの商品"), headers=as_account("a"))
+    client.post("/add", data=dict(FORM, name="Bの商品"), headers=as_account("b"))
+
+    assert names(client, "a") == ["Aの商品"]
+    assert names(client, "b") == ["Bの商品"]
+    assert names(client, "default") == []
+    export = client.get("/export?columns=name", headers=as_account("b")).get_data(as_text=True)
+    assert "Bの商品" in export and "Aの商品" not in export
+    assert os.path.exists(os.path.join("accounts", "a", "data.journal"))
+
+
+def test_account_header_is_required_and_validated(client):
+    assert client.get("/changes").status_code == 401
+    assert client.get("/changes", headers=as_account("../other")).status_code == 400
+
+
+def test_without_account_header_only_default_account_is_used(make_app):
+    module = make_app()
+    client = module.app.test_client()
+
+    client.post("/add?account=b", data=FORM, headers=as_account("b"))
+
+    assert list(module.ACCOUNTS) == [module.DEFAULT_ACCOUNT]
+    assert len(module.DEFAULT_ACCOUNT_STATE.DATA) == 1
+    assert not os.path.exists("accounts")
+
+
+def test_inactive_accounts_are_evicted_and_reloaded(app_module, client):
+    client.post("/add", data=dict(FORM, name="Aの商品"), headers=as_account("a"))
+    client.post("/add", data=dict(FORM, name="Bの商品"), headers=as_account("b"))
+
+    # 既定のアカウントと最後に使った b だけが残る
+    assert list(app_module.ACCOUNTS) == [app_module.DEFAULT_ACCOUNT, "b"]
+    assert names(client, "a") == ["Aの商品"]
+    assert "b" not in app_module.ACCOUNTS
+
+
+def test_jobs_are_visible_only_from_their_account(client):
+    client.post("/add", data=FORM, headers=as_account("a"))
+    job = client.get("/backup?async=1", headers=as_account("a")).get_json()
+    for _ in range(100):
+        if client.get(f"/jobs/{job['id']}", headers=as_account("a")).get_json()["status"] == "done":
+            break
+        time.sleep(0.01)
+
+    assert client.get(f"/jobs/{job['id']}", headers=as_account("b")).status_code == 404
+    assert client.get(f"/jobs/{job['id']}/download", headers=as_account("b")).status_code == 404
+    assert client.get(f"/jobs/{job['id']}/download", headers=as_account("a")).status_code == 200
+
+
+def test_shared_fee_rules_need_admin_token(client):
+    body = {"rules": [{"site": "メルカリ", "percent": 0.08}]}
+
+    assert client.post("/fee-rules", json=body, headers=as_account("a")).status_code == 403
+    assert client.post("/fee-rules", json=body, headers=as_account("a", **{"X-Admin-Token": "wrong"})).status_code == 403
+    assert client.post("/fee-rules", json=body, headers=as_account("a", **{"X-Admin-Token": "secret"})).status_code == 200
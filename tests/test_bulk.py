@@ -0,0 +1,48 @@
+"""まとめて変更（/bulk）の検証と一括適用"""
+
+
+def test_bulk_applies_all_operations(app_module, client, add_item):
+    first = add_item(name="シャツ")
+    second = add_item(name="ノート")
+    third = add_item(name="ペン")
+
+    response = client.post("/bulk", json={"operations": [
+        {"op": "mark_sold", "id": first["id"], "sell_site": "メルカリ", "sell_price": 1000, "sell_date": "2024-05-01"},
+        {"op": "update", "id": second["id"], "category": "文房具"},
+        {"op": "delete", "id": third["id"]},
+    ]})
+
+    assert response.status_code == 200
+    assert response.get_json() == {"updated": 2, "deleted": 1}
+    items = {d["id"]: d for d in app_module.ACCOUNT.DATA}
+    assert set(items) == {first["id"], second["id"]}
+    assert (items[first["id"]]["sell_site"], items[first["id"]]["sell_price"]) == ("メルカリ", 1000.0)
+    assert items[first["id"]]["profit"] > 0
+    assert items[second["id"]]["category"] == "文房具"
+
+
+def test_bulk_with_invalid_operation_changes_nothing(app_module, client, add_item):
+    item = add_item()
+    before = list(app_module.ACCOUNT.DATA)
+    version = app_module.ACCOUNT.VERSION
+
+    response = client.post("/bulk", json={"operations": [
+        {"op": "update", "id": item["id"], "category": "雑貨"},
+        {"op": "mark_sold", "id": item["id"]},  # 販売サイトがない
+        {"op": "delete", "id": "missing"},
+    ]})
+
+    assert response.status_code == 400
+    assert len(response.get_json()["details"]) == 2
+    assert app_module.ACCOUNT.DATA == before
+    assert app_module.ACCOUNT.VERSION == version
+
+
+def test_bulk_rejects_malformed_bodies(client, add_item):
+    item = add_item()
+
+    assert client.post("/bulk", json=[{"op": "delete", "id": item["id"]}]).status_code == 400
+    assert client.post("/bulk", data="not json", content_type="application/json").status_code == 400
+    assert client.post("/bulk", json={"operations": []}).status_code == 400
+    assert client.post("/bulk", json={"operations": [{"op": "delete", "id": [item["id"]]}]}).status_code == 400
+    assert client.post("/bulk", json={"operations": [{"op": "update", "id": item["id"], "category": ["服"]}]}).status_code == 400
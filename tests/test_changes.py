@@ -0,0 +1,87 @@
+"""差分同期（/changes）のバージョンと削除の記録（tombstone）"""
+
+import time
+
+
+def test_first_sync_returns_everything(client, add_item):
+    item = add_item()
+
+    body = client.get("/changes").get_json()
+
+    assert body["full"] is True
+    assert [d["id"] for d in body["items"]] == [item["id"]]
+    assert body["version"] >= 1
+
+
+def test_delta_returns_only_changes_since_version(client, add_item):
+    add_item(name="シャツ")
+    version = client.get("/changes").get_json()["version"]
+    added = add_item(name="ノート")
+
+    body = client.get(f"/changes?since={version}").get_json()
+
+    assert body["full"] is False
+    assert [d["id"] for d in body["items"]] == [added["id"]]
+    assert body["deleted"] == []
+    assert body["version"] > version
+
+
+def test_deleted_item_is_reported_as_tombstone(client, add_item):
+    item = add_item()
+    version = client.get("/changes").get_json()["version"]
+
+    assert client.get(f"/delete/{item['id']}").status_code == 302
+    body = client.get(f"/changes?since={version}").get_json()
+
+    assert body["items"] == []
+    assert body["deleted"] == [item["id"]]
+
+
+def test_tombstones_survive_restart(make_app, client, add_item):
+    item = add_item()
+    version = client.get("/changes").get_json()["version"]
+    client.get(f"/delete/{item['id']}")
+
+    reloaded = make_app()
+    body = reloaded.app.test_client().get(f"/changes?since={version}").get_json()
+
+    assert body["deleted"] == [item["id"]]
+
+
+def wait_job(client, job):
+    for _ in range(200):
+        job = client.get(f"/jobs/{job['id']}").get_json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(job)
+
+
+def test_archive_and_unarchive_are_reported(client, add_item):
+    item = add_item()
+    client.post("/bulk", json={"operations": [
+        {"op": "mark_sold", "id": item["id"], "sell_site": "メルカリ", "sell_price": 500, "sell_date": "2024-05-01"}]})
+    version = client.get("/changes").get_json()["version"]
+
+    assert wait_job(client, client.post("/archive?before=2025-01-01").get_json())["result"]["archived"] == 1
+    archived = client.get(f"/changes?since={version}").get_json()
+    assert (archived["items"], archived["deleted"]) == ([], [item["id"]])
+
+    assert wait_job(client, client.post("/unarchive?since=2024-01-01").get_json())["result"]["unarchived"] == 1
+    unarchived = client.get(f"/changes?since={archived['version']}").get_json()
+    assert ([d["id"] for d in unarchived["items"]], unarchived["deleted"]) == ([item["id"]], [])
+
+
+def test_versions_journal_is_compacted_and_replayed(make_app):
+    module = make_app(JOURNAL_COMPACT="3")
+    client = module.app.test_client()
+    for name in ("シャツ", "ノート", "ペン", "本"):
+        client.post("/add", data={"name": name, "buy_price": "100", "category": "服",
+                                  "buy_platform": "お店", "buy_date": "2024-01-01"})
+    versions = dict(module.ACCOUNT.VERSIONS)
+
+    # 3件目で versions.json に書き直し、4件目はジャーナルに残る
+    with open("versions.journal", encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+    reloaded = make_app(JOURNAL_COMPACT="3")
+    assert reloaded.DEFAULT_ACCOUNT_STATE.VERSIONS == versions
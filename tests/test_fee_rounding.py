@@ -0,0 +1,47 @@
+"""手数料の計算（登録時と再計算で同じ丸めになる）と手数料ルールの更新"""
+import time
+
+import pytest
+
+PRICES = [105, 125, 135, 1005, 2455, 9995]
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def app_module(request, make_app):
+    return make_app(STORAGE=request.param)
+
+
+def wait_job(client, job):
+    for _ in range(200):
+        job = client.get(f"/jobs/{job['id']}").get_json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(job)
+
+
+def test_half_yen_fee_rounds_up(app_module):
+    # ¥125 の10% は 12.5 円 → 13 円（偶数丸めの 12 円ではない）
+    assert app_module.calculate_profit(100, 125, 0, "メルカリ", "2024-05-01") == (13.0, 12.0, 12.0)
+
+
+def test_recompute_keeps_values_computed_when_added(app_module, client, add_item):
+    for price in PRICES:
+        item = add_item(buy_price="99")
+        response = client.post("/bulk", json={"operations": [
+            {"op": "mark_sold", "id": item["id"], "sell_site": "メルカリ", "sell_price": price,
+             "sell_date": "2024-05-01", "shipping": 0}]})
+        assert response.status_code == 200
+    added = {d["id"]: (d["fee"], d["profit"], d["rate"]) for d in app_module.ACCOUNT.DATA}
+
+    job = wait_job(client, client.post("/recompute").get_json())
+
+    assert job["status"] == "done" and job["result"]["updated"] == 0
+    assert {d["id"]: (d["fee"], d["profit"], d["rate"]) for d in app_module.ACCOUNT.DATA} == added
+
+
+def test_fee_rules_rejects_malformed_bodies(client):
+    assert client.post("/fee-rules", json=[{"site": "メルカリ", "percent": 0.1}]).status_code == 400
+    assert client.post("/fee-rules", json={"rules": 5}).status_code == 400
+    assert client.post("/fee-rules", json={"rules": ["メルカリ"]}).status_code == 400
+    assert client.post("/fee-rules", json={"estimate": 5}).status_code == 400
@@ -0,0 +1,46 @@
+"""変更履歴（/history）の操作者と読み込み"""
+import json
+
+FORM = {"name": "シャツ", "buy_price": "100", "category": "服", "buy_platform": "お店", "buy_date": "2024-01-01"}
+
+
+def actors(client):
+    return [e["actor"] for e in client.get("/history").get_json()["events"]]
+
+
+def test_actor_ignores_client_forwarded_for(client):
+    client.post("/add", data=FORM, headers={"X-Forwarded-For": "203.0.113.9"})
+
+    assert actors(client) == ["127.0.0.1"]
+
+
+def test_actor_uses_address_added_by_trusted_proxy(make_app):
+    client = make_app(PROXY_COUNT="1").app.test_client()
+
+    # 先頭はクライアントが書いた値、最後がプロキシの付け足した送信元
+    client.post("/add", data=FORM, headers={"X-Forwarded-For": "203.0.113.9, 198.51.100.7"})
+
+    assert actors(client) == ["198.51.100.7"]
+
+
+def test_reversed_lines_reads_from_the_end(app_module, tmp_path):
+    path = tmp_path / "lines.log"
+    lines = [json.dumps({"n": i, "name": "シャツ" * (i % 5)}, ensure_ascii=False) for i in range(50)]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    assert list(app_module.reversed_lines(str(path), block_size=7)) == lines[::-1]
+
+
+def test_load_events_stops_before_older_files(app_module, client, monkeypatch):
+    for _ in range(3):
+        client.post("/add", data=FORM)
+    app_module.flush_audit()
+    with open("events.log.1", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"ts": "2000-01-01T00:00:00", "actor": "old", "op": "add", "item_id": "x"}) + "\n")
+    opened = []
+    reversed_lines = app_module.reversed_lines
+    monkeypatch.setattr(app_module, "reversed_lines", lambda path: opened.append(path) or reversed_lines(path))
+
+    assert len(app_module.load_events(limit=2)) == 2
+    assert opened == ["events.log"]
+    assert [e["actor"] for e in app_module.load_events(limit=10)][-1] == "old"
@@ -0,0 +1,87 @@
+"""売上CSVの取り込み（import_sales_csv）の照合"""
+import io
+
+
+def import_csv(client, text, site="メルカリ"):
+    response = client.post("/import/csv", data={"site": site, "csv_file": (io.BytesIO(text.encode("utf-8")), "sales.csv")})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_same_name_rows_sell_different_unsold_items(app_module, client, add_item):
+    first = add_item(buy_date="2024-01-01")
+    second = add_item(buy_date="2024-01-02")
+
+    # 1行目は購入日で、2行目は同名の未売却商品として照合される
+    result = import_csv(client, "商品名,販売価格,売却日,仕入日\nシャツ,800,2024/05/01,2024/01/01\nシャツ,900,2024/05/03,\n")
+
+    assert result["updated"] == 2 and result["inserted"] == 0
+    items = {d["id"]: d for d in app_module.ACCOUNT.DATA}
+    # 購入日の古い順に売れ、先に売れた商品が後の行で上書きされない
+    assert (items[first["id"]]["sell_date"], items[first["id"]]["sell_price"]) == ("2024-05-01", 800.0)
+    assert (items[second["id"]]["sell_date"], items[second["id"]]["sell_price"]) == ("2024-05-03", 900.0)
+
+
+def test_row_matching_buy_date_skips_item_sold_earlier_in_same_csv(app_module, client, add_item):
+    item = add_item(buy_date="2024-01-01")
+
+    result = import_csv(client, "商品名,販売価格,売却日,仕入日\nシャツ,800,2024/05/01,2024/01/01\nシャツ,900,2024/05/03,2024/01/01\n")
+
+    # 売れた商品は購入日でも同名でも照合されず、2行目は新しい商品として登録される
+    assert (result["updated"], result["inserted"]) == (1, 1)
+    sold = next(d for d in app_module.ACCOUNT.DATA if d["id"] == item["id"])
+    assert (sold["sell_date"], sold["sell_price"]) == ("2024-05-01", 800.0)
+
+
+def test_reimporting_same_csv_updates_instead_of_inserting(app_module, client, add_item):
+    add_item()
+    text = "商品名,販売価格,売却日\nシャツ,800,2024/05/01\n"
+
+    import_csv(client, text)
+    result = import_csv(client, text)
+
+    assert result == dict(result, updated=1, inserted=0)
+    assert len(app_module.ACCOUNT.DATA) == 1
+
+
+def test_unknown_name_is_inserted_as_sold_item(app_module, client):
+    result = import_csv(client, "商品名,販売価格,売却日\nノート,500,2024/05/01\n")
+
+    assert result["inserted"] == 1
+    item = app_module.ACCOUNT.DATA[0]
+    assert (item["name"], item["sell_site"], item["sell_price"]) == ("ノート", "メルカリ", 500.0)
+
+
+def test_import_replaces_item_dicts_instead_of_mutating(app_module, client, add_item):
+    item = add_item()
+    original = dict(item)
+
+    import_csv(client, "商品名,販売価格,売却日\nシャツ,800,2024/05/01\n")
+
+    # 読み手が持っている辞書は変わらず、DATA には新しい辞書が入る
+    assert item == original
+    assert app_module.ACCOUNT.DATA[0] is not item
+    assert app_module.ACCOUNT.DATA[0]["sell_price"] == 800.0
+
+
+def test_decode_error_midway_changes_nothing(app_module, client, add_item):
+    item = add_item()
+    before = list(app_module.ACCOUNT.DATA)
+    version = app_module.ACCOUNT.VERSION
+    rows = "".join(f"ノート{i},500,2024/05/01\n" for i in range(600))
+    body = ("商品名,販売価格,売却日\nシャツ,800,2024/05/01\n" + rows).encode("utf-8")
+    body = body[:len(body) // 2] + b"\xff" + body[len(body) // 2:]
+
+    response = client.post("/import/csv", data={"site": "メルカリ", "csv_file": (io.BytesIO(body), "sales.csv")})
+
+    assert response.status_code == 400
+    assert app_module.ACCOUNT.DATA == before
+    assert app_module.ACCOUNT.VERSION == version
+    assert set(app_module.ACCOUNT.ROLLUP_CONTRIB) == {item["id"]}
+
+
+def test_mapping_must_be_object_of_column_names(client):
+    for mapping in ('["name"]', '5', '{"name": ["商品名"]}'):
+        response = client.post("/import/csv", data={"site": "メルカリ", "mapping": mapping,
+                                                    "csv_file": (io.BytesIO("商品名,販売価格\n".encode()), "sales.csv")})
+        assert response.status_code == 400
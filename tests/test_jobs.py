@@ -0,0 +1,48 @@
+"""バックグラウンドジョブ（復元など）の状態と後片付け"""
+import io
+import json
+import time
+
+
+def wait_job(client, job):
+    for _ in range(200):
+        job = client.get(f"/jobs/{job['id']}").get_json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(job)
+
+
+def restore_async(client, items):
+    backup = json.dumps({"items": items}).encode("utf-8")
+    response = client.post("/restore?async=1", data={"backup_file": (io.BytesIO(backup), "backup.json")})
+    assert response.status_code == 202
+    return response.get_json()
+
+
+def test_failed_restore_is_reported_and_keeps_old_data(app_module, client, add_item, monkeypatch):
+    add_item()
+    before = list(app_module.ACCOUNT.DATA)
+
+    def failing_save_data(progress=None):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(app_module, "save_data", failing_save_data)
+    job = wait_job(client, restore_async(client, [dict(before[0], id="other", name="ノート")]))
+
+    assert job["status"] == "failed" and "disk full" in job["error"]
+    assert app_module.ACCOUNT.DATA == before
+
+
+def test_finished_jobs_are_dropped_from_memory_but_still_readable(make_app):
+    module = make_app(JOBS_IN_MEMORY="1")
+    client = module.app.test_client()
+
+    jobs = [wait_job(client, client.get("/backup?async=1").get_json()) for _ in range(3)]
+    module.JOB_EXECUTOR.shutdown(wait=True)  # 後片付けまで終わらせる
+
+    assert [job["status"] for job in jobs] == ["done"] * 3
+    assert list(module.JOBS) == [jobs[-1]["id"]]
+    assert module.JOB_FUTURES == {}
+    for job in jobs:
+        assert client.get(f"/jobs/{job['id']}").get_json()["status"] == "done"
@@ -0,0 +1,19 @@
+"""プロファイルの閲覧権限"""
+
+
+def test_profiles_need_token_even_when_profiling_is_on(make_app):
+    client = make_app(PROFILE="1").app.test_client()
+    client.get("/")
+
+    assert client.get("/profiles").status_code == 404
+    assert client.get("/profiles/1.collapsed").status_code == 404
+
+
+def test_profiles_accept_token_only_in_header(make_app):
+    client = make_app(PROFILE="1", PROFILE_TOKEN="secret").app.test_client()
+    client.get("/")
+
+    assert client.get("/profiles?token=secret").status_code == 404
+    assert client.get("/profiles/1.collapsed?token=secret").status_code == 404
+    assert client.get("/profiles", headers={"X-Profile": "secret"}).status_code == 200
+    assert client.get("/profiles/1.collapsed", headers={"X-Profile": "secret"}).status_code == 200
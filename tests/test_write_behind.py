@@ -0,0 +1,67 @@
+"""書き込みキュー（write-behind）の失敗時の扱い"""
+import pytest
+
+
+@pytest.fixture
+def app_module(make_app):
+    # 書き込みスレッドの再試行はテストの中で明示的に行う
+    return make_app(WRITE_RETRY_MS="600000")
+
+
+def make_item(item_id, name):
+    return {"id": item_id, "name": name, "buy_platform": "お店", "category": "服", "buy_date": "2024-01-01",
+            "sell_date": "", "buy_price": 100.0, "sell_price": 0.0, "shipping": 0.0, "fee": 0, "profit": 0, "rate": 0,
+            "sell_site": ""}
+
+
+def failing_apply_changes(puts, deletes):
+    raise OSError("disk full")
+
+
+def test_failed_write_returns_503_and_stays_queued(make_app, app_module, client, monkeypatch):
+    apply_changes = app_module.apply_changes
+    monkeypatch.setattr(app_module, "apply_changes", failing_apply_changes)
+
+    response = client.post("/add", data={"name": "シャツ", "buy_price": "100", "category": "服",
+                                         "buy_platform": "お店", "buy_date": "2024-01-01"})
+
+    assert response.status_code == 503
+    account = app_module.DEFAULT_ACCOUNT_STATE
+    assert account.dirty() and len(account.PENDING_PUTS) == 1
+    assert account.FLUSHED_SEQ < account.WRITE_SEQ
+
+    # 保存先が直れば、キューに残った変更が書き込まれる
+    monkeypatch.setattr(app_module, "apply_changes", apply_changes)
+    with app_module.use_account(account):
+        app_module.flush_pending()
+    assert not account.dirty()
+    reloaded = make_app()
+    assert [d["name"] for d in reloaded.DEFAULT_ACCOUNT_STATE.DATA] == ["シャツ"]
+
+
+def test_wait_written_raises_for_failed_batch(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "apply_changes", failing_apply_changes)
+
+    with app_module.DEFAULT_ACCOUNT_STATE.WRITE_LOCK:
+        seq = app_module.persist(puts=[make_item("a", "シャツ")], wait=False)
+        with pytest.raises(app_module.WriteError):
+            app_module.flush_pending()
+    with pytest.raises(app_module.WriteError):
+        app_module.wait_written(seq, wait=True)
+
+
+def test_requeue_keeps_newer_change(app_module, monkeypatch):
+    def apply_changes(puts, deletes):
+        # 書き込み中に同じ商品がまた変更された
+        app_module.persist(puts=[make_item("a", "新しい")], wait=False)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(app_module, "apply_changes", apply_changes)
+    account = app_module.DEFAULT_ACCOUNT_STATE
+    # 書き込みスレッドが割り込まないよう、確認が終わるまで WRITE_LOCK を持っておく
+    with account.WRITE_LOCK:
+        app_module.persist(puts=[make_item("a", "古い"), make_item("b", "ほか")], wait=False)
+        with pytest.raises(app_module.WriteError):
+            app_module.flush_pending()
+        pending = {item_id: d["name"] for item_id, d in account.PENDING_PUTS.items()}
+    assert pending == {"a": "新しい", "b": "ほか"}